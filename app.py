@@ -1,28 +1,47 @@
 # file: app.py
 import os
 import time
+import asyncio
 import json
 import logging
+from contextlib import asynccontextmanager
 from typing import Optional
 
-from fake_useragent import UserAgent
-from fastapi import FastAPI, Request, HTTPException, Depends, Query
+from fastapi import FastAPI, Request, Response, HTTPException, Depends, Query
+from fastapi.responses import StreamingResponse, FileResponse
 from fastapi.params import Path
 from fastapi.security import APIKeyHeader
-import requests
+import httpx
+import orjson
 
-from models import BookMetadata, SearchResponse, SeriesMetadata
+from models import BookMetadata, SearchResponse, BatchSearchRequest
 from caching import (
-    get_cache_key, get_from_memory, get_from_file, store_in_memory
+    CacheEntry,
+    get_cached, store_cached, get_editions, store_editions, persist_memory, flush_cache
 )
-from rate_limit import rate_limit_check, clear_old_ips
-from retreive_api_keys import ApiKeys
+from rate_limit import rate_limit_check, batch_items_check
+from retreive_api_keys import get_api_keys
+from compression import accepted_encodings, decompress
+from coalescing import coalesce, is_in_flight, run_in_background, COVER_COALESCE_STATS, COVERS_IN_FLIGHT
+from upstream import (
+    post_search, post_graphql, close_clients, request_budget, is_available,
+    UpstreamUnavailable, DeadlineExceeded, GRAPHQL_UPSTREAM,
+)
+from queries import build_search_body, build_editions_body, build_identifier_body, build_cover_body
+from search_index import get_search_index
+from normalization import SearchRequest, canonical_search, get_edition_filter
+from metrics import timed, render as render_metrics, STAGE_LATENCY, REQUEST_LATENCY, UPSTREAM_ERRORS
+from structured_logging import setup_logging, stop_logging
+from warmup import WARMUP_ENABLED, WARMUP_STATE, warm_up, is_ready
+from authors import score_authors
+from user_agents import get_user_agents, random_user_agent
+from covers import COVER_PROXY_URL, COVER_MAX_AGE, proxy_url, load_cover_index, get_cover, cover_is_known
+from shaping import Shape, FULL, get_shape, shape_result
 
 logger = logging.getLogger("uvicorn")
 logging.basicConfig(level=logging.INFO)
 
 api_key_header = APIKeyHeader(name="AUTHORIZATION", auto_error=False)
-key = ApiKeys()
 
 def get_api_key(api_key: str = Depends(api_key_header)):
     if not api_key:
@@ -32,67 +51,130 @@ def get_api_key(api_key: str = Depends(api_key_header)):
     return api_key
 
 
-def search_for_books(query: str, author: Optional[str], lang: Optional[str], type: Optional[str]) -> list[BookMetadata]:
-    url = "	https://search.hardcover.app/multi_search?x-typesense-api-key=cf0jYiqkIXNYh2EnJr1RqHIYJbKOGoGk"
-    headers = {
-        'User-Agent': UserAgent().random,
-        'Content-Type': 'application/json'
-    }
-    graphql_query = '{"searches":[{"per_page":30,"prioritize_exact_match":true,"num_typos":5,"query_by":"title,isbns,series_names,author_names,alternative_titles","sort_by":"users_count:desc,_text_match:desc","query_by_weights":"5,5,3,2,1","collection":"Book_production","q":"[[1]]","page":1}]}'
+# Typesense accepts a limited number of searches per multi_search request
+SEARCHES_PER_REQUEST = int(os.getenv("SEARCHES_PER_REQUEST", "50"))
+# Books per FindEditionsForBook request
+BOOKS_PER_REQUEST = int(os.getenv("BOOKS_PER_REQUEST", "50"))
+# Books per search result, and editions per search result across all of its books
+SEARCH_MAX_BOOKS = int(os.getenv("SEARCH_MAX_BOOKS", "10"))
+SEARCH_MAX_EDITIONS = int(os.getenv("SEARCH_MAX_EDITIONS", "250"))
+# Maximum number of items in one /batch/search request
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "250"))
+
+
+def unavailable(e: UpstreamUnavailable) -> HTTPException:
+    logger.warning(f"Not calling Hardcover API: {e}")
+    return HTTPException(
+        status_code=503,
+        detail="External API is unavailable. Please try again later.",
+        headers={"Retry-After": str(int(e.retry_after))}
+    )
+
 
-    graphql_query = graphql_query.replace("[[1]]", query)
+def timed_out(upstream: str, e: Exception) -> HTTPException:
+    UPSTREAM_ERRORS.labels(upstream).inc()
+    logger.error(f"Timed out calling Hardcover API: {e!r}")
+    return HTTPException(
+        status_code=504,
+        detail="Timed out calling external API"
+    )
 
-    response = requests.post(url, headers=headers, json=json.loads(graphql_query))
 
+async def run_searches(queries: list[str], headers: dict) -> list[dict]:
+    """
+    Run all queries through Typesense in as few multi_search requests as possible.
+    Returns one result (with "hits") per query, in order.
+    """
+    results = []
+    for start in range(0, len(queries), SEARCHES_PER_REQUEST):
+        body = build_search_body(queries[start:start + SEARCHES_PER_REQUEST])
+        try:
+            with timed(STAGE_LATENCY, "typesense"):
+                response = await post_search(body, headers=headers)
+            response.raise_for_status()
+        except UpstreamUnavailable as e:
+            raise unavailable(e)
+        except (httpx.TimeoutException, DeadlineExceeded) as e:
+            raise timed_out("typesense", e)
+        except httpx.HTTPStatusError as e:
+            UPSTREAM_ERRORS.labels("typesense").inc()
+            logger.error(f"Error calling Hardcover API: {e}")
+            logger.error(f"Response: {e.response.text}")
+            raise HTTPException(
+                status_code=500,
+                detail="Error calling external API"
+            )
+        except httpx.RequestError as e:
+            UPSTREAM_ERRORS.labels("typesense").inc()
+            logger.error(f"Error calling Hardcover API: {e!r}")
+            raise HTTPException(
+                status_code=500,
+                detail="Error calling external API"
+            )
+        results.extend(response.json()["results"])
+
+    index = get_search_index()
+    if index:
+        for result in results:
+            index.learn(result)
+    return results
+
+
+def match_locally(query: str, author: Optional[str]) -> Optional[list[int]]:
+    """
+    Book ids for a query the local search index is confident about, or None if Typesense has to be asked.
+    """
+    index = get_search_index()
+    if index is None:
+        return None
+    with timed(STAGE_LATENCY, "local_index"):
+        result = index.search(query)
+    if result is None:
+        return None
     try:
-        response.raise_for_status()
-    except requests.exceptions.HTTPError as e:
-        logger.error(f"Error calling Hardcover API: {e}")
-        logger.error(f"Response: {response.text}")
+        return match_books(result, author)
+    except HTTPException:
+        # The author may just be missing from the books the index knows
+        return None
+
+
+def match_books(result: dict, author: Optional[str]) -> list[int]:
+    """
+    Filter the Typesense hits by author and return the ids of the books to fetch editions for.
+    """
+    if "hits" not in result:
+        # A single search of a multi_search can fail on its own
+        logger.error(f"Error in search result: {result.get('error')}")
         raise HTTPException(
             status_code=500,
             detail="Error calling external API"
         )
-    all_data = response.json()
-
-    data = {"data": all_data}
-    data["data"]["results"] = all_data["results"][0]
 
     # Ensure author is a valid non-empty string
-    if author and isinstance(author, str) and author.strip():
-        author_parts = [part.lower() for part in author.split()]
-    else:
-        author_parts = []
+    filter_by_author = bool(author and isinstance(author, str) and author.strip())
 
     matches = []
 
-    def name_matches(name, parts):
-        """
-        Check if a name matches any part of the given name parts.
-        Returns the number of parts that match.
-        """
-        name_parts = name.lower().split()
-        return sum(int(part in name_parts) for part in parts)
-
-    for book in data["data"]["results"]["hits"]:
-        scores = []
-
-        if author_parts:
-            author_names = book["document"].get("author_names", [])
-
-            # Calculate match score for each author name
-            scores = [name_matches(name, author_parts) for name in author_names]
+    # All hits are scored in one pass, see authors.py
+    hits = result["hits"]
+    if filter_by_author:
+        with timed(STAGE_LATENCY, "author_match"):
+            scores = score_authors(author, [hit["document"].get("author_names", []) for hit in hits])
+    else:
+        scores = [0] * len(hits)
 
-            if not any(scores):
-                continue
+    for book, score in zip(hits, scores):
+        if filter_by_author and not score:
+            continue
 
         # Store the book along with its highest match score, default to 0 if no author provided
         matches.append({
-            "score": max(scores) if scores else 0,
+            "score": score,
             "metadata": {
-                "id": book["document"]["id"],
+                "id": int(book["document"]["id"]),
                 "title": book["document"]["title"],
                 "author": ', '.join(book["document"].get("author_names", [])),
+                "users_count": book["document"].get("users_count", 0),
             },
         })
 
@@ -102,122 +184,422 @@ def search_for_books(query: str, author: Optional[str], lang: Optional[str], typ
     # Extract the sorted BookMetadata objects
     matches = [match["metadata"] for match in matches]
 
-    headers['Authorization'] = f'Bearer {key.get_key().key}'
-    headers['User-Agent'] = UserAgent().random
+    # Only the most read books are returned, so only those need editions
+    ids = list(dict.fromkeys(match["id"] for match in sorted(matches, key=lambda x: x["users_count"], reverse=True)))
+    ids = ids[:SEARCH_MAX_BOOKS]
 
-    ids = [match["id"] for match in matches]
-    ids = set(ids)
+    if len(ids) == 0:
+        raise HTTPException(
+            status_code=404,
+            detail="No books found"
+        )
+    return ids
+
+
+async def load_editions(ids: list[int], formats: tuple, language: Optional[str], headers: dict) -> dict[int, list[BookMetadata]]:
+    edition_filter = f"{formats}-{language}"
+
+    # Editions of books seen by earlier searches come from the entity cache
+    editions_by_book = {book_id: get_editions(book_id, edition_filter) for book_id in ids}
+    missing_ids = [book_id for book_id, editions in editions_by_book.items() if editions is None]
+
+    if missing_ids:
+        logger.info("Fetching editions for %d of %d books", len(missing_ids), len(ids))
+    for start in range(0, len(missing_ids), BOOKS_PER_REQUEST):
+        chunk = missing_ids[start:start + BOOKS_PER_REQUEST]
+        fetched = await fetch_editions(chunk, formats, language, headers)
+        for book_id in chunk:
+            # Books without matching editions are cached as empty as well
+            editions_by_book[book_id] = fetched.get(book_id, [])
+            store_editions(book_id, edition_filter, editions_by_book[book_id])
+
+    index = get_search_index()
+    if index:
+        for book_id in missing_ids:
+            identifiers = [edition.isbn for edition in editions_by_book[book_id]]
+            identifiers.extend(edition.asin for edition in editions_by_book[book_id])
+            index.learn_identifiers(book_id, identifiers)
+
+    return editions_by_book
+
+
+async def lookup_identifiers(identifiers: list[str], formats: tuple, language: Optional[str], headers: dict) -> dict[str, list[int]]:
+    """
+    Book ids per ISBN-13/ASIN, looked up on Hardcover's editions directly instead of through Typesense.
+    The same request returns the books' editions, which go to the edition cache, and the search index
+    learns the identifiers so the next lookup needs no request at all.
+    """
+    edition_filter = f"{formats}-{language}"
+    index = get_search_index()
+    ids_by_identifier = {}
+    for start in range(0, len(identifiers), BOOKS_PER_REQUEST):
+        chunk = identifiers[start:start + BOOKS_PER_REQUEST]
+        books = await query_books(build_identifier_body(chunk, formats, language), headers)
+        for book, editions in books:
+            book_id = int(book["id"])
+            store_editions(book_id, edition_filter, editions)
+            identified = [value for edition in book.get("identified") or []
+                          for value in (edition.get("isbn13"), edition.get("asin")) if value]
+            for identifier in identified:
+                if identifier in chunk:
+                    ids_by_identifier.setdefault(identifier, []).append(book_id)
+            if index:
+                identified.extend(value for edition in editions for value in (edition.isbn, edition.asin) if value)
+                document = {"id": book_id, "title": book.get("title") or "",
+                            "author_names": author_names(book.get("contributions")),
+                            "users_count": book.get("usersCount") or 0}
+                index.learn_identifiers(book_id, identified, document=document)
+    return ids_by_identifier
+
+
+def order_books(
+        ids: list[int],
+        editions_by_book: dict[int, list[BookMetadata]],
+        identifier: Optional[str],
+) -> list[list[BookMetadata]]:
+    """
+    The editions of each book in result order, at most SEARCH_MAX_EDITIONS across all books.
+    """
+    books = [editions_by_book[book_id] for book_id in ids if editions_by_book[book_id]]
+    if identifier is not None:
+        # The edition the client asked for by ISBN/ASIN leads, the other editions of its book follow
+        def requested(edition: BookMetadata) -> bool:
+            return identifier in (edition.isbn, edition.asin)
+
+        books.sort(key=lambda editions: not any(map(requested, editions)))
+        books = [sorted(editions, key=lambda edition: not requested(edition)) for editions in books]
+
+    limited = []
+    remaining = SEARCH_MAX_EDITIONS
+    for editions in books:
+        if remaining <= 0:
+            break
+        limited.append(editions[:remaining])
+        remaining -= len(limited[-1])
+    return limited
+
+
+def serialize_books(books: list[list[BookMetadata]]) -> bytes:
+    # Serialize once, the same bytes are cached and sent
+    with timed(STAGE_LATENCY, "serialize"):
+        return SearchResponse(
+            matches=[edition for editions in books for edition in editions],
+            editionsPerBook=[len(editions) for editions in books],
+        ).model_dump_json().encode("utf-8")
+
+
+async def search_for_books(search: SearchRequest, local: bool = True) -> list[list[BookMetadata]]:
+    """
+    local=False skips the local index, so refreshing a result asks Typesense again.
+    """
+    headers = {
+        'User-Agent': random_user_agent(),
+        'Content-Type': 'application/json'
+    }
 
-    payload = "{\n  \"query\": \"query FindEditionsForBook($bookId: [Int!]!, $limit: Int!, $offset: Int!, $formats: [Int!]!, $userId: Int, $includeCurrentUser: Boolean!) {\\n  books(\\n    where: {\\n      id: { _in: $bookId }\\n    }\\n    limit: 10\\n    order_by: { users_count: desc }\\n  ) {\\n    title\\n    description\\n    id\\n    contributions {\\n      author {\\n        name\\n      }\\n    }\\n\\t\\ttaggings {\\n      tag {\\n        tag\\n      }\\n    }\\n\\t\\tbook_series {\\n      position\\n\\t\\t\\tseries {\\n\\t\\t\\t\\tname\\n\\t\\t\\t}\\n    }\\n    editions(\\n      where: { book_id: { _in: $bookId }, reading_format_id: { _in: $formats }[[2]]}\\n      order_by: { users_count: desc }\\n      limit: $limit\\n      offset: $offset\\n    ) {\\n    ...EditionFragment\\n    list_books(where: {list: {user_id: {_eq: $userId}, slug: {_eq: \\\"owned\\\"}}}) @include(if: $includeCurrentUser) {\\n      ...ListBookFragment\\n      __typename\\n    }\\n    __typename\\n    }\\n  }\\n}\\n\\nfragment EditionFragment on editions {\\n  id\\n  title\\n\\tpages\\n  asin\\n  isbn13: isbn_13\\n  releaseYear: release_year\\n  pages\\n  audioSeconds: audio_seconds\\n  cachedImage: cached_image\\n  editionFormat: edition_format\\n  language {\\n    language\\n code2 \\n }\\n  readingFormat: reading_format {\\n    format\\n  }\\n  country {\\n    name\\n  }\\n\\tcontributions {\\n\\t\\tauthor {\\n\\t\\t\\tname\\n\\t\\t}\\n\\t}\\n  publisher {\\n    ...PublisherFragment\\n  }\\n}\\n\\nfragment ListBookFragment on list_books {\\n  id\\n  position\\n}\\n\\nfragment PublisherFragment on publishers {\\n  id\\n  name\\n}\\n\",\n  \"operationName\": \"FindEditionsForBook\",\n  \"variables\": {\n    \"bookId\": [[0]],\n    \"formats\": [[1]],\n    \"limit\": 25,\n    \"offset\": 0,\n    \"userId\": 0,\n    \"includeCurrentUser\": false\n  }\n}"
+    ids = match_locally(search.text, search.author) if local else None
+    if ids is not None:
+        logger.info("Search answered by the local index")
+    elif search.identifier:
+        ids = (await lookup_identifiers([search.identifier], search.formats, search.language, headers)).get(search.identifier)
+        if ids:
+            logger.info("Search answered by an identifier lookup")
+    if ids is None:
+        # Unknown identifiers may still be found by Typesense, it also matches alternative titles
+        results = await run_searches([search.query], headers)
+        ids = match_books(results[0], search.author)
 
-    if lang is not None and len(lang) == 2:
-        payload = payload.replace("[[2]]", f", language: {{ code2: {{ _eq: \\\"{lang}\\\" }} }}")
-    else:
-        payload = payload.replace("[[2]]", "")
+    editions_by_book = await load_editions(ids, search.formats, search.language, headers)
+    return order_books(ids, editions_by_book, search.identifier)
 
-    if (lang is not None and len(lang) > 2 and lang == "book") or type == "book":
-        payload = payload.replace("[[1]]", "[1,4]")
-    elif (lang is not None and len(lang) > 2 and lang == "abook") or type == "abook":
-        payload = payload.replace("[[1]]", "[2,3]")
-    else:
-        payload = payload.replace("[[1]]", "[1,2,3,4]")
 
-    if len(ids) == 0:
+async def fetch_editions(ids: list[int], formats: tuple, language: Optional[str], headers: dict) -> dict[int, list[BookMetadata]]:
+    books = await query_books(build_editions_body(ids, formats, language), headers)
+    return {int(book["id"]): editions for book, editions in books}
+
+
+async def query_books(payload: bytes, headers: dict) -> list[tuple[dict, list[BookMetadata]]]:
+    """
+    Send a books query to the GraphQL API. Returns each book of the response with its parsed editions.
+    """
+    response = await query_graphql(payload, headers)
+    try:
+        with timed(STAGE_LATENCY, "parse"):
+            # Decoded straight from the raw bytes, once
+            data = orjson.loads(response.content)
+            return [(book, parse_editions(book)) for book in data["data"]["books"]]
+    except Exception as e:
+        logger.error(f"Error parsing response: {e}")
+        logger.error(f"Response: {response.text}")
         raise HTTPException(
-            status_code=404,
-            detail="No books found"
+            status_code=500,
+            detail="Error parsing response"
         )
-    else:
-        payload = payload.replace("[[0]]", str(ids).replace("'", "").replace('{', '[').replace('}', ']'))
 
-    url = "https://api.hardcover.app/v1/graphql"
 
-    response = requests.post(url, headers=headers, data=payload)
+async def query_graphql(payload: bytes, headers: dict) -> httpx.Response:
+    """
+    Send a query to the GraphQL API with the next available API key.
+    """
+    # Before taking a key: a request the breaker refuses would waste it
+    try:
+        GRAPHQL_UPSTREAM.breaker.fail_fast()
+    except UpstreamUnavailable as e:
+        raise unavailable(e)
+    # Time spent here is time the key pool was saturated
+    try:
+        with timed(STAGE_LATENCY, "key_wait"):
+            api_key = await get_api_keys().acquire()
+    except DeadlineExceeded as e:
+        raise timed_out("graphql", e)
+    headers['Authorization'] = f'Bearer {api_key.key}'
+    headers['User-Agent'] = random_user_agent()
 
     try:
+        with timed(STAGE_LATENCY, "graphql"):
+            response = await post_graphql(payload, headers=headers)
         response.raise_for_status()
-    except requests.exceptions.HTTPError as e:
+    except UpstreamUnavailable as e:
+        raise unavailable(e)
+    except (httpx.TimeoutException, DeadlineExceeded) as e:
+        raise timed_out("graphql", e)
+    except httpx.HTTPStatusError as e:
+        UPSTREAM_ERRORS.labels("graphql").inc()
         logger.error(f"Error calling Hardcover API: {e}")
-        logger.error(f"Payload: {payload}")
-        logger.error(f"Response: {response.text}")
+        logger.error(f"Payload: {payload.decode('utf-8')}")
+        logger.error(f"Response: {e.response.text}")
+        raise HTTPException(
+            status_code=500,
+            detail="Error calling external API"
+        )
+    except httpx.RequestError as e:
+        UPSTREAM_ERRORS.labels("graphql").inc()
+        logger.error(f"Error calling Hardcover API: {e!r}")
         raise HTTPException(
             status_code=500,
             detail="Error calling external API"
         )
+    return response
 
-    data = response.json()
 
-    matches = []
+async def find_cover_url(edition_id: int) -> Optional[str]:
+    """
+    Cover URL of an edition that is not in a recent search result, e.g. after a restart.
+    """
+    headers = {'Content-Type': 'application/json'}
+    with request_budget():
+        response = await query_graphql(build_cover_body(edition_id), headers)
     try:
-        for book in data["data"]["books"]:
-            for edition in book.get("editions", {}):
-
-                series_list = edition.get("book_series", [])
-                authors_edition = [contribution["author"]["name"]
-                                   for contribution in edition.get("contributions", [])
-                                   if "author" in contribution and "name" in contribution["author"]]
-                authors_book = None
-                if not authors_edition:
-                    authors_book = [contribution["author"]["name"]
-                                    for contribution in book.get("contributions", [])
-                                    if "author" in contribution and "name" in contribution["author"]]
-
-                author = ", ".join(authors_edition) if authors_edition else ", ".join(authors_book)
-
-                matches.append(BookMetadata(
-                    title=edition.get("title") or book.get("title"),
-                    subtitle=edition.get("subtitle"),
-                    author=author,
-                    publisher=edition.get("publisher", {}).get("name") if edition.get("publisher") else None,
-                    publishedYear=edition.get("releaseYear"),
-                    description=edition.get("description") or book.get("description"),
-                    cover=edition.get("cachedImage", {}).get("url") if edition.get("cachedImage") else None,
-                    isbn=edition.get("isbn13"),
-                    asin=edition.get("asin"),
-                    tags=[tag["tag"]["tag"] for tag in edition.get("taggings", []) if tag.get("tag")],
-                    series=[SeriesMetadata(series=series["series"]["name"], sequence=series["position"]) for series in
-                            series_list] if series_list else [],
-                    language=edition.get("language", {}).get("language") if edition.get("language") else None,
-                    duration=int(str(edition.get("audioSeconds"))) / 60 if edition.get("audioSeconds") else None
-                ))
+        editions = orjson.loads(response.content)["data"]["editions"]
     except Exception as e:
         logger.error(f"Error parsing response: {e}")
-        logger.error(f"Response: {data}")
         raise HTTPException(
             status_code=500,
             detail="Error parsing response"
         )
+    return (editions[0].get("cachedImage") or {}).get("url") if editions else None
+
 
+def author_names(contributions: Optional[list]) -> list[str]:
+    return [contribution["author"]["name"]
+            for contribution in contributions or []
+            if contribution.get("author") and contribution["author"].get("name")]
+
+
+def parse_editions(book: dict) -> list[BookMetadata]:
+    """
+    Map one book of the GraphQL response to BookMetadata. The values are typed here
+    already, so the models are constructed without a second validation pass.
+    """
+    matches = []
+    book_authors = None
+    for edition in book.get("editions") or []:
+        authors = author_names(edition.get("contributions"))
+        if not authors:
+            if book_authors is None:
+                book_authors = author_names(book.get("contributions"))
+            authors = book_authors
+
+        release_year = edition.get("releaseYear")
+        audio_seconds = edition.get("audioSeconds")
+
+        matches.append(BookMetadata.model_construct(
+            title=edition.get("title") or book.get("title") or "",
+            subtitle=edition.get("subtitle"),
+            author=", ".join(authors),
+            narrator=None,
+            publisher=(edition.get("publisher") or {}).get("name"),
+            publishedYear=str(release_year) if release_year is not None else None,
+            description=edition.get("description") or book.get("description"),
+            cover=proxy_url(edition.get("id"), (edition.get("cachedImage") or {}).get("url")),
+            isbn=edition.get("isbn13"),
+            asin=edition.get("asin"),
+            genres=None,
+            tags=[],
+            series=[],
+            language=(edition.get("language") or {}).get("language"),
+            duration=round(int(audio_seconds) / 60) if audio_seconds else None
+        ))
     return matches
 
 
+def get_etag(cache_key: str, entry: CacheEntry, encoding: str, shape: Shape = FULL) -> str:
+    # The store time changes whenever the entry is refreshed
+    tag = f"{cache_key}-{int(entry.stored_at)}"
+    if shape != FULL:
+        tag = f"{tag}-{shape.key}"
+    if encoding != "identity":
+        tag = f"{tag}-{encoding}"
+    return f'"{tag}"'
+
+
+def cached_response(request: Request, cache_key: str, entry: CacheEntry, shape: Shape = FULL) -> Response:
+    """
+    Send the cached bytes as they are, without parsing and re-validating them.
+    Compressed entries are only decompressed for clients that do not accept their encoding.
+    Shaped results are cut from the entry (see shaping.py) and sent uncompressed.
+    """
+    shaped = entry.status == 200 and shape != FULL
+    if shaped:
+        content, encoding = None, "identity"
+    elif entry.encoding in accepted_encodings(request.headers.get("Accept-Encoding", "")):
+        content, encoding = entry.data, entry.encoding
+    else:
+        content, encoding = decompress(entry.data, entry.encoding), "identity"
+
+    headers = {"Vary": "Accept-Encoding"}
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+
+    if entry.status != 200:
+        return Response(content=content, status_code=entry.status, media_type="application/json", headers=headers)
+
+    etag = get_etag(cache_key, entry, encoding, shape)
+    headers["ETag"] = etag
+    if_none_match = request.headers.get("If-None-Match")
+    # Proxies may have weakened the tag on the way
+    if if_none_match and (
+            if_none_match.strip() == "*"
+            or etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    ):
+        headers.pop("Content-Encoding", None)
+        return Response(status_code=304, headers=headers)
+    if shaped:
+        content = shape_result(cache_key, entry, shape)
+    return Response(content=content, media_type="application/json", headers=headers)
+
+
+def validate_filters(lang_code: Optional[str], content_type: Optional[str]):
+    if lang_code not in ["book", "abook", None] and len(lang_code) != 2:
+        raise HTTPException(
+            status_code=400,
+            detail="Invalid language code or content type. Must be a 2-letter language code or one of book, abook, None."
+        )
+
+    if content_type not in ["book", "abook", None]:
+        raise HTTPException(
+            status_code=400,
+            detail="Invalid content type. Must be one of: book, abook, None"
+        )
+
+
+def error_bytes(detail: str) -> bytes:
+    return json.dumps({"detail": detail}, separators=(",", ":")).encode("utf-8")
+
+
+def store_error(cache_key: str, e: HTTPException):
+    # Negative caching of "No books found" and upstream failures. An open circuit breaker (503)
+    # already answers without calling upstream, and knows when to try again.
+    if e.status_code == 404 or (e.status_code >= 500 and e.status_code != 503):
+        store_cached(cache_key, error_bytes(e.detail), status=e.status_code)
+
+
+async def search_and_store(search: SearchRequest, has_stale: bool = False) -> CacheEntry:
+    try:
+        # All upstream calls of the search share one deadline
+        with request_budget():
+            # The local index only knows what Typesense answered before, a refresh must not be answered by it
+            books = await search_for_books(search, local=not has_stale)
+    except HTTPException as e:
+        # Negative caching, unless there is a stale result that is still worth serving
+        if e.status_code == 404 or not has_stale:
+            store_error(search.cache_key, e)
+        raise
+
+    return store_cached(search.cache_key, serialize_books(books))
+
+
+async def refresh_for_warmup(search: SearchRequest):
+    if is_in_flight(search.cache_key):
+        return
+    # The entry may be stale, warm-up only refreshes entries it could not load fresh
+    has_stale = await get_cached(search.cache_key) is not None
+    await coalesce(search.cache_key, lambda: search_and_store(search, has_stale=has_stale))
+
+
+def batch_line(index: int, status: int, body: bytes) -> bytes:
+    # body is already serialized JSON, so it is spliced in instead of being parsed again
+    return b'{"index":%d,"status":%d,"body":%b}\n' % (index, status, body)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Logging from requests only queues records from here on
+    setup_logging()
+    # Rotate Hardcover API keys ahead of expiry without a request waiting for it
+    key_refresh = asyncio.create_task(get_api_keys().refresh_keys_forever())
+    # Map the search index and load the user agents before the first request needs them
+    get_search_index()
+    get_user_agents()
+    if COVER_PROXY_URL:
+        load_cover_index()
+    # Requests are served while warming up, /ready tells load balancers when it is done
+    warmup = asyncio.create_task(warm_up(refresh_for_warmup)) if WARMUP_ENABLED else None
+    yield
+    if warmup:
+        warmup.cancel()
+    key_refresh.cancel()
+    # Release the pooled upstream connections
+    await close_clients()
+    # Keep what the search index learned for the next start
+    index = get_search_index()
+    saving = index.save() if index else None
+    if saving:
+        saving.result()
+    # Finish queued cache writes before the process exits
+    persist_memory()
+    flush_cache()
+    stop_logging()
+
+
 def create_app() -> FastAPI:
     app = FastAPI(
+        lifespan=lifespan,
         openapi_url="/openapi.json",
         servers=[{"url": "https://provider.vito0912.de/hardcover"}],
         title="Custom Metadata Provider",
         version="0.1.0"
     )
 
-    def search(
+    @app.middleware("http")
+    async def record_latency(request: Request, call_next):
+        start = time.perf_counter()
+        response = await call_next(request)
+        # Labelled by route template, so /en/book/search and /de/abook/search are the same endpoint
+        route = request.scope.get("route")
+        REQUEST_LATENCY.labels(route.path if route else "unmatched").observe(time.perf_counter() - start)
+        return response
+
+    async def search(
             request: Request,
             query: str = Query(..., description="Book to search for"),
             author: Optional[str] = Query(None, description="Author name"),
             lang_code: Optional[str] = None,
             content_type: Optional[str] = None,
+            shape: Shape = FULL,
             api_key: str = Depends(get_api_key),
     ):
-        if lang_code not in ["book", "abook", None] and len(lang_code) != 2:
-            raise HTTPException(
-                status_code=400,
-                detail="Invalid language code or content type. Must be a 2-letter language code or one of book, abook, None."
-            )
-
-        if content_type not in ["book", "abook", None]:
-            raise HTTPException(
-                status_code=400,
-                detail="Invalid content type. Must be one of: book, abook, None"
-            )
+        validate_filters(lang_code, content_type)
 
         if len(query) < 3:
             raise HTTPException(
@@ -228,37 +610,204 @@ def create_app() -> FastAPI:
         # Log IP and user agent
         ip_address = request.headers.get("X-Forwarded-For", request.client.host)
         user_agent = request.headers.get("User-Agent", "Unknown")
-        search_str = f"query={query}, author={author or ''}"
 
         # Time in format YYYY-MM-DD HH:MM:SS
         timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
 
-        logger.info(f"{timestamp} - Request from IP: {ip_address}, Agent: {user_agent}, Search: {search_str}")
+        # Formatted on the logging thread, the fields are kept as they are for JSON logs
+        logger.info(
+            "%s - Request from IP: %s, Agent: %s, Search: query=%s, author=%s",
+            timestamp, ip_address, user_agent, query, author or "",
+            extra={"fields": {"event": "search", "ip": ip_address, "agent": user_agent, "query": query,
+                              "author": author, "lang_code": lang_code, "content_type": content_type}}
+        )
+
+        # Check cache, under the key every spelling of this search shares
+        search_request = canonical_search(query, author, lang_code, content_type)
+        cache_key = search_request.cache_key
+        entry = await get_cached(cache_key)
 
-        # Check cache
-        cache_key = get_cache_key(query, author or "", lang_code, content_type)
-        response_bytes = get_from_memory(cache_key)
-        if not response_bytes:
-            response_bytes = get_from_file(cache_key)
-        if response_bytes:
+        async def fetch() -> CacheEntry:
+            # Actual search
+            logger.info("Cache miss - calling search_for_books")
+            return await search_and_store(search_request, has_stale=bool(entry))
+
+        if entry:
             # Cache HIT - do not count towards rate limit
             logger.info("Cache hit for request.")
-            content_dict = json.loads(response_bytes.decode("utf-8"))
-            return SearchResponse(**content_dict)
+            if entry.status == 200 and entry.is_stale() and not is_in_flight(cache_key) and is_available():
+                # Serve the stale result right away and refresh it in the background.
+                # While an upstream is down, the stale result is all there is.
+                logger.info("Cache entry is stale - refreshing in the background")
+                run_in_background(coalesce(cache_key, fetch))
+            return cached_response(request, cache_key, entry, shape)
+
+        # Cache MISS => rate limit check, unless an identical request is already in flight
+        # (joining it costs no upstream call)
+        if is_in_flight(cache_key):
+            logger.info("Cache miss - joining in-flight request")
+        else:
+            await rate_limit_check(ip_address, api_key)
+
+        return cached_response(request, cache_key, await coalesce(cache_key, fetch), shape)
+
+    async def batch_search(
+            request: Request,
+            body: BatchSearchRequest,
+            lang_code: Optional[str] = None,
+            content_type: Optional[str] = None,
+            api_key: Optional[str] = None,
+    ) -> StreamingResponse:
+        validate_filters(lang_code, content_type)
 
-        # Cache MISS => rate limit check
-        rate_limit_check(ip_address)
+        if len(body.items) > BATCH_MAX_ITEMS:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Too many items. At most {BATCH_MAX_ITEMS} items are allowed per request"
+            )
 
-        # Actual search
-        logger.info("Cache miss - calling search_for_books")
-        matches = search_for_books(query, author, lang_code, content_type)
-        response_obj = SearchResponse(matches=matches)
-        response_bytes = json.dumps(response_obj.model_dump()).encode("utf-8")
+        ip_address = request.headers.get("X-Forwarded-For", request.client.host)
+        user_agent = request.headers.get("User-Agent", "Unknown")
+        timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+        logger.info(
+            "%s - Batch request from IP: %s, Agent: %s, Items: %d",
+            timestamp, ip_address, user_agent, len(body.items),
+            extra={"fields": {"event": "batch_search", "ip": ip_address, "agent": user_agent,
+                              "items": len(body.items), "lang_code": lang_code, "content_type": content_type}}
+        )
 
-        # Store in memory
-        store_in_memory(cache_key, response_bytes)
+        # Answer what we can from the cache right away
+        ready = []
+        pending = []  # (index, SearchRequest, cache_key, has a stale entry to fall back to)
+        duplicates = {}  # { cache_key: [later items searching for the same] }
 
-        return response_obj
+        def answer(index: int, cache_key: str, status: int, body: bytes) -> bytes:
+            return b"".join(batch_line(i, status, body) for i in (index, *duplicates.get(cache_key, ())))
+
+        for index, item in enumerate(body.items):
+            if len(item.query) < 3:
+                ready.append(batch_line(index, 400, error_bytes("Query must be at least 3 characters long")))
+                continue
+            search_request = canonical_search(item.query, item.author, lang_code, content_type)
+            cache_key = search_request.cache_key
+            entry = await get_cached(cache_key)
+            if entry:
+                ready.append(batch_line(index, entry.status, decompress(entry.data, entry.encoding)))
+                if entry.status == 200 and entry.is_stale() and is_available() and cache_key not in duplicates:
+                    duplicates[cache_key] = []
+                    pending.append((index, search_request, cache_key, True))
+                continue
+            if cache_key in duplicates:
+                # Searched once, answered for every item
+                duplicates[cache_key].append(index)
+                continue
+            duplicates[cache_key] = []
+            pending.append((index, search_request, cache_key, False))
+
+        # Cache MISSES => one request against the API key limit, one item per distinct search
+        # against the IP's batch quota. Items beyond the quota are answered with 429 and not searched.
+        misses = [entry for entry in pending if not entry[3]]
+        if misses:
+            granted = await batch_items_check(ip_address, api_key, len(misses))
+            rejected = {cache_key for _, _, cache_key, _ in misses[granted:]}
+            for index, _, cache_key, _ in misses[granted:]:
+                ready.append(answer(index, cache_key, 429, error_bytes("Batch rate limit exceeded")))
+            pending = [entry for entry in pending if entry[2] not in rejected]
+
+        logger.info("Batch: %d cached, %d to search", len(body.items) - len(pending), len(pending))
+
+        async def lines():
+            for line in ready:
+                yield line
+            if not pending:
+                return
+
+            headers = {
+                'User-Agent': random_user_agent(),
+                'Content-Type': 'application/json'
+            }
+
+            def failed(index: int, cache_key: str, stale: bool, e: HTTPException) -> Optional[bytes]:
+                # Items that were already answered from a stale entry keep it
+                if stale:
+                    return None
+                store_error(cache_key, e)
+                return answer(index, cache_key, e.status_code, error_bytes(e.detail))
+
+            formats, language = get_edition_filter(lang_code, content_type)
+            identifiers = {index: search_request.identifier for index, search_request, _, _ in pending}
+            ids_by_item = {}
+            for index, search_request, _, stale in pending:
+                # Stale items are refreshed, which the local index cannot do
+                ids = None if stale else match_locally(search_request.text, search_request.author)
+                if ids is not None:
+                    ids_by_item[index] = ids
+
+            # Identifiers the local index does not know are looked up in one request,
+            # the items it finds nothing for are searched
+            unknown = [identifier for index, identifier in identifiers.items() if identifier and index not in ids_by_item]
+            if unknown:
+                try:
+                    with request_budget():
+                        found = await lookup_identifiers(list(dict.fromkeys(unknown)), formats, language, headers)
+                except HTTPException:
+                    found = {}
+                for index, identifier in identifiers.items():
+                    if index not in ids_by_item and found.get(identifier):
+                        ids_by_item[index] = found[identifier]
+            searching = [entry for entry in pending if entry[0] not in ids_by_item]
+
+            # All remaining searches of the batch go out in as few multi_search requests as possible
+            # A budget per upstream step: the response streams, there is no single deadline for all of it
+            try:
+                with request_budget():
+                    results = await run_searches([search_request.query for _, search_request, _, _ in searching], headers) if searching else []
+            except HTTPException as e:
+                for index, _, cache_key, stale in searching:
+                    line = failed(index, cache_key, stale, e)
+                    if line:
+                        yield line
+                results = []
+                searching = []
+
+            for (index, search_request, cache_key, stale), result in zip(searching, results):
+                try:
+                    ids_by_item[index] = match_books(result, search_request.author)
+                except HTTPException as e:
+                    line = failed(index, cache_key, stale, e)
+                    if line:
+                        yield line
+
+            # Editions for the combined book id set, streaming every item as soon as its books are loaded
+            all_ids = list(dict.fromkeys(book_id for ids in ids_by_item.values() for book_id in ids))
+            editions_by_book = {}
+            remaining = [entry for entry in pending if entry[0] in ids_by_item]
+            for start in range(0, len(all_ids), BOOKS_PER_REQUEST):
+                try:
+                    with request_budget():
+                        editions_by_book.update(
+                            await load_editions(all_ids[start:start + BOOKS_PER_REQUEST], formats, language, headers)
+                        )
+                except HTTPException as e:
+                    for index, _, cache_key, stale in remaining:
+                        line = failed(index, cache_key, stale, e)
+                        if line:
+                            yield line
+                    return
+
+                still_remaining = []
+                for index, search_request, cache_key, stale in remaining:
+                    ids = ids_by_item[index]
+                    if not all(book_id in editions_by_book for book_id in ids):
+                        still_remaining.append((index, search_request, cache_key, stale))
+                        continue
+                    response_bytes = serialize_books(order_books(ids, editions_by_book, identifiers.get(index)))
+                    store_cached(cache_key, response_bytes)
+                    if not stale:
+                        yield answer(index, cache_key, 200, response_bytes)
+                remaining = still_remaining
+
+        return StreamingResponse(lines(), media_type="application/x-ndjson")
 
     @app.get(
         "/{lang_code:path}/{content_type:path}/search",
@@ -270,21 +819,23 @@ def create_app() -> FastAPI:
                 "description": "OK"
             },
             400: {"description": "Bad Request"},
+            304: {"description": "Not Modified"},
             401: {"description": "Unauthorized"},
             500: {"description": "Internal Server Error"}
         },
         tags=["search"],
     )
-    def search_endpoint(
+    async def search_endpoint(
             request: Request,
             query: str = Query(..., description="Book to search for"),
             author: Optional[str] = Query(None, description="Author name"),
             lang_code: Optional[str] = Path(description="Language code"),
             content_type: Optional[str] = Path(description="Content type: book|abook|None"),
+            shape: Shape = Depends(get_shape),
             api_key: str = Depends(get_api_key),
     ) -> SearchResponse:
-        return search(request, query=query, author=author, lang_code=lang_code, content_type=content_type,
-                      api_key=api_key)
+        return await search(request, query=query, author=author, lang_code=lang_code, content_type=content_type,
+                      shape=shape, api_key=api_key)
 
     @app.get(
         "/{lang_code:path}/search",
@@ -296,19 +847,21 @@ def create_app() -> FastAPI:
                 "description": "OK"
             },
             400: {"description": "Bad Request"},
+            304: {"description": "Not Modified"},
             401: {"description": "Unauthorized"},
             500: {"description": "Internal Server Error"}
         },
         tags=["search"],
     )
-    def search_endpoint_lang_only(
+    async def search_endpoint_lang_only(
             request: Request,
             query: str = Query(..., description="Book to search for"),
             author: Optional[str] = Query(None, description="Author name"),
             lang_code: Optional[str] = Path(description="Language code"),
+            shape: Shape = Depends(get_shape),
             api_key: str = Depends(get_api_key),
     ) -> SearchResponse:
-        return search(request, query=query, author=author, lang_code=lang_code, api_key=api_key)
+        return await search(request, query=query, author=author, lang_code=lang_code, shape=shape, api_key=api_key)
 
     @app.get(
         "/search",
@@ -320,17 +873,126 @@ def create_app() -> FastAPI:
                 "description": "OK"
             },
             400: {"description": "Bad Request"},
+            304: {"description": "Not Modified"},
             401: {"description": "Unauthorized"},
             500: {"description": "Internal Server Error"}
         },
         tags=["search"],
     )
-    def search_endpoint_no_params(
+    async def search_endpoint_no_params(
             request: Request,
             query: str = Query(..., description="Book to search for"),
             author: Optional[str] = Query(None, description="Author name"),
+            shape: Shape = Depends(get_shape),
             api_key: str = Depends(get_api_key),
     ) -> SearchResponse:
-        return search(request, query=query, author=author, api_key=api_key)
+        return await search(request, query=query, author=author, shape=shape, api_key=api_key)
+
+    batch_responses = {
+        200: {
+            "description": "One JSON object per line: {\"index\", \"status\", \"body\"}, "
+                           "where body is the /search response (or error) for the item at index",
+            "content": {"application/x-ndjson": {}}
+        },
+        400: {"description": "Bad Request"},
+        401: {"description": "Unauthorized"},
+        429: {"description": "Too Many Requests"}
+    }
+
+    @app.post(
+        "/{lang_code}/{content_type}/batch/search",
+        summary="Search for many books at once",
+        description="Search for many books at once. Results are streamed back as NDJSON in completion order",
+        response_class=StreamingResponse,
+        responses=batch_responses,
+        tags=["search"],
+    )
+    async def batch_search_endpoint(
+            request: Request,
+            body: BatchSearchRequest,
+            lang_code: Optional[str] = Path(description="Language code"),
+            content_type: Optional[str] = Path(description="Content type: book|abook|None"),
+            api_key: str = Depends(get_api_key),
+    ) -> StreamingResponse:
+        return await batch_search(request, body, lang_code=lang_code, content_type=content_type, api_key=api_key)
+
+    @app.post(
+        "/{lang_code}/batch/search",
+        summary="Search for many books at once",
+        description="Search for many books at once. Results are streamed back as NDJSON in completion order",
+        response_class=StreamingResponse,
+        responses=batch_responses,
+        tags=["search"],
+    )
+    async def batch_search_endpoint_lang_only(
+            request: Request,
+            body: BatchSearchRequest,
+            lang_code: Optional[str] = Path(description="Language code"),
+            api_key: str = Depends(get_api_key),
+    ) -> StreamingResponse:
+        return await batch_search(request, body, lang_code=lang_code, api_key=api_key)
+
+    @app.post(
+        "/batch/search",
+        summary="Search for many books at once",
+        description="Search for many books at once. Results are streamed back as NDJSON in completion order",
+        response_class=StreamingResponse,
+        responses=batch_responses,
+        tags=["search"],
+    )
+    async def batch_search_endpoint_no_params(
+            request: Request,
+            body: BatchSearchRequest,
+            api_key: str = Depends(get_api_key),
+    ) -> StreamingResponse:
+        return await batch_search(request, body, api_key=api_key)
+
+    if COVER_PROXY_URL:
+        @app.get(
+            "/covers/{edition_id}",
+            summary="Cover image of an edition",
+            description="Cover image of an edition, optionally scaled down to about the given width",
+            response_class=FileResponse,
+            tags=["covers"],
+        )
+        async def cover_endpoint(
+                request: Request,
+                edition_id: int = Path(description="Hardcover edition id"),
+                width: Optional[int] = Query(None, gt=0, description="Width in pixels"),
+        ) -> Response:
+            # Cover links are followed by image loaders without the API key.
+            # Editions that were not in a recent search result cost a GraphQL request, every client
+            # asking for one is charged before joining the fetch, so nobody gets another client's 429.
+            if not await asyncio.to_thread(cover_is_known, edition_id):
+                await rate_limit_check(request.headers.get("X-Forwarded-For", request.client.host))
+
+            path = await coalesce(f"{edition_id}-{width}", lambda: get_cover(edition_id, width, find_cover_url),
+                                  COVERS_IN_FLIGHT, COVER_COALESCE_STATS)
+            # Files are named by their content hash
+            etag = f'"{os.path.basename(path).rsplit(".", 1)[0]}"'
+            headers = {"ETag": etag, "Cache-Control": f"public, max-age={COVER_MAX_AGE}"}
+            if_none_match = request.headers.get("If-None-Match")
+            if if_none_match and etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]:
+                return Response(status_code=304, headers=headers)
+            return FileResponse(path, headers=headers)
+
+    @app.get("/health", include_in_schema=False)
+    async def health_endpoint() -> Response:
+        return Response(content=b'{"status":"ok"}', media_type="application/json")
+
+    @app.get("/ready", include_in_schema=False)
+    async def ready_endpoint() -> Response:
+        # Not ready until the cache warm-up reached WARMUP_READY_THRESHOLD
+        ready = is_ready()
+        return Response(
+            content=orjson.dumps({"ready": ready, **WARMUP_STATE}),
+            status_code=200 if ready else 503,
+            media_type="application/json"
+        )
+
+    @app.get("/metrics", include_in_schema=False)
+    async def metrics_endpoint() -> Response:
+        content, media_type = render_metrics()
+        return Response(content=content, media_type=media_type)
 
     return app
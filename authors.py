@@ -0,0 +1,56 @@
+from functools import lru_cache
+
+from search_index import tokenize
+
+# Author names whose tokens are kept, most books share a handful of very common names
+AUTHOR_CACHE_SIZE = 50000
+
+# An initial matching the first letter of a full name ("J." and "John") counts for this much
+INITIAL_MATCH_SCORE = 0.5
+
+
+@lru_cache(maxsize=AUTHOR_CACHE_SIZE)
+def author_tokens(name: str) -> frozenset:
+    """
+    Words of an author name without case, diacritics and punctuation,
+    so "J.R.R. Tolkien", "J. R. R. Tolkien" and "j r r tolkien" are the same.
+    """
+    return frozenset(tokenize(name))
+
+
+def query_tokens(author: str) -> tuple[frozenset, frozenset]:
+    """
+    The full words and the initials of the author a search is filtered by.
+    """
+    tokens = author_tokens(author)
+    initials = frozenset(token for token in tokens if len(token) == 1)
+    return tokens - initials, initials
+
+
+def score_name(name: str, words: frozenset, initials: frozenset) -> float:
+    """
+    Number of query words in the name, plus partial credit for initials.
+    Only names sharing at least one full word with the query score above 0.
+    """
+    tokens = author_tokens(name)
+    matches = len(words & tokens)
+    if not matches:
+        # A query of nothing but initials can only match them exactly
+        return 0 if words else len(initials & tokens)
+    # Whole words the name has that the query only has the initial of, and the other way around
+    name_initials = {token for token in tokens if len(token) == 1}
+    partial = len(initials & tokens)
+    partial += len({word[0] for word in words - tokens} & name_initials)
+    partial += len(initials & {token[0] for token in tokens - name_initials} - tokens)
+    return matches + INITIAL_MATCH_SCORE * partial
+
+
+def score_authors(author: str, author_names: list[list[str]]) -> list[float]:
+    """
+    Score the author names of every hit against the author a search is filtered by, in one pass.
+    The query is only normalized once and every name's tokens come from the cache.
+    """
+    words, initials = query_tokens(author)
+    if not words and not initials:
+        return [0] * len(author_names)
+    return [max((score_name(name, words, initials) for name in names), default=0) for names in author_names]
@@ -0,0 +1,164 @@
+import asyncio
+import hashlib
+import random
+import struct
+import threading
+import socket
+import time
+import zlib
+from typing import Optional
+
+import orjson
+import uvicorn
+from fastapi import FastAPI, Request, Response
+
+
+class UpstreamStats:
+    def __init__(self):
+        self.search_requests = 0
+        self.searches = 0  # single searches inside multi_search requests
+        self.graphql_requests = 0
+        self.books = 0  # book ids asked for across all GraphQL requests
+        self.identifiers = 0  # ISBNs/ASINs looked up across all GraphQL requests
+        self.images = 0  # cover images served
+
+
+def stable_int(text: str) -> int:
+    return int.from_bytes(hashlib.md5(text.encode("utf-8")).digest()[:4], "big")
+
+
+def png(width: int, height: int, seed: int) -> bytes:
+    """
+    A valid single-colour RGB PNG, so cover thumbnails can be made without a real image host.
+    """
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack("!I", len(data)) + kind + data + struct.pack("!I", zlib.crc32(kind + data))
+
+    colour = seed.to_bytes(4, "big")[1:]
+    rows = b"".join(b"\x00" + colour * width for _ in range(height))
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack("!IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(rows)) + chunk(b"IEND", b""))
+
+
+def create_fake_upstream(
+        latency: float = 0.05,
+        jitter: float = 0.01,
+        hits: int = 10,
+        editions_per_book: int = 10,
+        description_bytes: int = 600,
+        image_base_url: Optional[str] = None,
+) -> tuple[FastAPI, UpstreamStats]:
+    """
+    Stand-in for search.hardcover.app (/multi_search), api.hardcover.app (/v1/graphql) and, with
+    image_base_url (its own URL), the image host (/images). Results are derived from the query and
+    book ids, so every run sees the same data.
+    """
+    image_base_url = image_base_url or "https://assets.example.invalid/images"
+    app = FastAPI()
+    stats = UpstreamStats()
+    description = ("Lorem ipsum dolor sit amet. " * (description_bytes // 28 + 1))[:description_bytes]
+
+    async def delay():
+        await asyncio.sleep(max(0.0, latency + random.uniform(-jitter, jitter)))
+
+    def search_result(query: str) -> dict:
+        first_id = stable_int(query) % 1_000_000
+        return {
+            "found": hits,
+            "hits": [{
+                "document": {
+                    "id": str(first_id + i),
+                    "title": query if i == 0 else f"{query} {i}",
+                    "author_names": [f"Author {(first_id + i) % 997}"],
+                    "series_names": [],
+                    "isbns": [f"978{(first_id + i):010d}"],
+                    "users_count": hits - i,
+                }
+            } for i in range(hits)]
+        }
+
+    def book(book_id: int) -> dict:
+        return {
+            "id": book_id,
+            "title": f"Book {book_id}",
+            "description": description,
+            "contributions": [{"author": {"name": f"Author {book_id % 997}"}}],
+            "editions": [{
+                "id": book_id * 100 + i,
+                "title": f"Book {book_id} edition {i}",
+                "asin": f"B0{book_id * 100 + i:08d}"[:10] if i % 2 else None,
+                "isbn13": f"979{book_id * 100 + i:010d}",
+                "releaseYear": 1990 + i,
+                "audioSeconds": 36000 + i if i % 2 else None,
+                "cachedImage": {"url": f"{image_base_url}/{book_id}/{i}.png"},
+                "language": {"language": "English"},
+                "contributions": [],
+                "publisher": {"name": "Publisher"},
+            } for i in range(editions_per_book)]
+        }
+
+    @app.post("/multi_search")
+    async def multi_search(request: Request) -> Response:
+        body = orjson.loads(await request.body())
+        stats.search_requests += 1
+        stats.searches += len(body["searches"])
+        await delay()
+        return Response(
+            orjson.dumps({"results": [search_result(search["q"]) for search in body["searches"]]}),
+            media_type="application/json"
+        )
+
+    @app.get("/images/{book_id}/{name}")
+    async def image(book_id: int, name: str) -> Response:
+        stats.images += 1
+        await delay()
+        return Response(png(600, 900, stable_int(f"{book_id}/{name}")), media_type="image/png")
+
+    @app.post("/v1/graphql")
+    async def graphql(request: Request) -> Response:
+        body = orjson.loads(await request.body())
+        stats.graphql_requests += 1
+        if body["operationName"] == "FindEditionCover":
+            # Edition ids are book id * 100 + edition number, see book()
+            edition_id = body["variables"]["id"]
+            await delay()
+            url = f"{image_base_url}/{edition_id // 100}/{edition_id % 100}.png"
+            return Response(orjson.dumps({"data": {"editions": [{"cachedImage": {"url": url}}]}}),
+                            media_type="application/json")
+        if "identifiers" in body["variables"]:
+            # FindEditionsByIdentifier: every identifier belongs to one book
+            identifiers = body["variables"]["identifiers"]
+            stats.identifiers += len(identifiers)
+            books = [{
+                **book(stable_int(identifier) % 1_000_000),
+                "usersCount": 1,
+                "identified": [{"isbn13": identifier, "asin": None}],
+            } for identifier in identifiers]
+        else:
+            book_ids = body["variables"]["bookIds"]
+            stats.books += len(book_ids)
+            books = [book(book_id) for book_id in book_ids]
+        await delay()
+        return Response(orjson.dumps({"data": {"books": books}}), media_type="application/json")
+
+    return app, stats
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def serve_in_thread(app: FastAPI, port: int) -> uvicorn.Server:
+    """
+    Run app on 127.0.0.1:port in a daemon thread, returning once it accepts connections.
+    """
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    deadline = time.monotonic() + 10
+    while not server.started:
+        if time.monotonic() > deadline:
+            raise RuntimeError("Fake upstream did not start")
+        time.sleep(0.01)
+    return server
@@ -0,0 +1,259 @@
+"""
+Offline load test of create_app() against a local stand-in for the Hardcover upstreams.
+
+    python -m benchmark.run                         # every workload, each in its own process
+    python -m benchmark.run --workload hit-heavy --requests 5000 --concurrency 100
+    python -m benchmark.run --workload replay --queries queries.txt
+    python -m benchmark.run --workload covers       # /covers, Pillow makes the thumbnails if installed
+
+Nothing leaves the machine: the fake upstream listens on 127.0.0.1, the app is called in-process
+and caches into a temporary directory. Set CACHE_BACKEND, CACHE_COMPRESSION etc. as usual to
+benchmark other configurations.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+WORKLOADS = ("hit-heavy", "miss-heavy", "batch", "replay", "covers")
+COVER_WIDTHS = (None, 160, 320)
+RESULT_PREFIX = "BENCHMARK_RESULT "
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workload", choices=WORKLOADS + ("all",), default="all")
+    parser.add_argument("--requests", type=int, default=2000, help="HTTP requests to send (batch: items)")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--distinct", type=int, default=100, help="Distinct queries of the hit-heavy and covers workloads")
+    parser.add_argument("--batch-size", type=int, default=50, help="Items per batch request")
+    parser.add_argument("--queries", help="Queries to replay: one per line, plain or JSON with query/author")
+    parser.add_argument("--latency", type=float, default=0.05, help="Upstream latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.01)
+    parser.add_argument("--hits", type=int, default=10, help="Typesense hits per search")
+    parser.add_argument("--editions-per-book", type=int, default=10)
+    parser.add_argument("--description-bytes", type=int, default=600)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--log-level", default="warning")
+    parser.add_argument("--json", help="Also write the results to this file")
+    return parser.parse_args(argv)
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def rss_kib() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except OSError:
+        return 0
+
+
+def load_queries(path: str) -> list[dict]:
+    queries = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("{"):
+                item = json.loads(line)
+                queries.append({"query": item["query"], "author": item.get("author")})
+            else:
+                queries.append({"query": line, "author": None})
+    return queries
+
+
+def request_mix(args: argparse.Namespace, rng: random.Random) -> list[dict]:
+    if args.workload == "covers":
+        return [{"query": f"bench title {i}", "author": None} for i in range(args.distinct)]
+    if args.workload == "hit-heavy":
+        distinct = [{"query": f"bench title {i}", "author": None} for i in range(args.distinct)]
+        # Zipf-like: a few titles get most of the traffic, like real clients matching popular books
+        weights = [1 / (rank + 1) for rank in range(len(distinct))]
+        return rng.choices(distinct, weights=weights, k=args.requests)
+    if args.workload == "replay":
+        if not args.queries:
+            raise SystemExit("--queries is required for the replay workload")
+        queries = load_queries(args.queries)
+        return [queries[i % len(queries)] for i in range(args.requests)]
+    # miss-heavy and batch: every query is new
+    return [{"query": f"bench miss {i} {rng.randrange(10 ** 9)}", "author": None} for i in range(args.requests)]
+
+
+def configure_environment(cache_dir: str, upstream_url: str):
+    """
+    Everything the app reads at import time. Settings already in the environment win.
+    """
+    api_keys_file = os.path.join(cache_dir, "api_keys.txt")
+    with open(api_keys_file, "w") as f:
+        f.write(f"benchmark,0,{int(time.time()) + 365 * 24 * 60 * 60},1000000\n")
+    os.environ["FILE_CACHE_DIR"] = cache_dir
+    os.environ["API_KEYS_FILE"] = api_keys_file
+    os.environ["HARDCOVER_SEARCH_URL"] = upstream_url
+    os.environ["HARDCOVER_GRAPHQL_URL"] = upstream_url
+    os.environ.setdefault("KEY_POOL_SIZE", "1")
+    os.environ.setdefault("RATE_LIMIT_PER_IP", str(10 ** 9))
+    os.environ.setdefault("RATE_LIMIT_BATCH_ITEMS_PER_IP", str(10 ** 9))
+
+
+async def run_workload(args: argparse.Namespace) -> dict:
+    import httpx
+    from benchmark.fake_upstream import create_fake_upstream, free_port, serve_in_thread
+
+    rng = random.Random(args.seed)
+    port = free_port()
+    upstream_app, stats = create_fake_upstream(
+        latency=args.latency, jitter=args.jitter, hits=args.hits,
+        editions_per_book=args.editions_per_book, description_bytes=args.description_bytes,
+        image_base_url=f"http://127.0.0.1:{port}/images",
+    )
+    server = serve_in_thread(upstream_app, port)
+
+    cache_dir = tempfile.mkdtemp(prefix="hardcover-benchmark-")
+    configure_environment(cache_dir, f"http://127.0.0.1:{port}")
+    if args.workload == "covers":
+        os.environ.setdefault("COVER_PROXY_URL", "http://benchmark")
+
+    # The app reads its configuration on import
+    from app import create_app
+    for name in ("", "uvicorn", "httpx"):
+        logging.getLogger(name).setLevel(args.log_level.upper())
+
+    app = create_app()
+    mix = request_mix(args, rng)
+    latencies = []
+    statuses = {}
+    rss_before = rss_kib()
+
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark",
+                                     headers={"AUTHORIZATION": "benchmark", "Accept-Encoding": "gzip"},
+                                     timeout=None) as client:
+            if args.workload == "batch":
+                requests = [mix[start:start + args.batch_size] for start in range(0, len(mix), args.batch_size)]
+            elif args.workload == "covers":
+                # Covers of the search results, the searches themselves are not measured
+                covers = []
+                for request in mix:
+                    response = await client.get("/search", params={"query": request["query"]})
+                    covers.extend(dict.fromkeys(match["cover"] for match in response.json()["matches"] if match["cover"]))
+                weights = [1 / (rank + 1) for rank in range(len(covers))]
+                requests = [{"cover": cover, "width": rng.choice(COVER_WIDTHS)}
+                            for cover in rng.choices(covers, weights=weights, k=args.requests)]
+            else:
+                requests = mix
+            queue = asyncio.Queue()
+            for request in requests:
+                queue.put_nowait(request)
+
+            async def send(request):
+                if args.workload == "batch":
+                    return await client.post("/batch/search", json={"items": request})
+                if args.workload == "covers":
+                    params = {"width": request["width"]} if request["width"] else {}
+                    return await client.get(request["cover"], params=params)
+                params = {"query": request["query"]}
+                if request["author"]:
+                    params["author"] = request["author"]
+                return await client.get("/search", params=params)
+
+            async def worker():
+                while not queue.empty():
+                    request = queue.get_nowait()
+                    start = time.perf_counter()
+                    response = await send(request)
+                    latencies.append(time.perf_counter() - start)
+                    statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+            started = time.perf_counter()
+            await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+            elapsed = time.perf_counter() - started
+
+    server.should_exit = True
+    return {
+        "workload": args.workload,
+        "requests": len(latencies),
+        "items": len(mix),
+        "statuses": statuses,
+        "seconds": round(elapsed, 3),
+        "throughput": round(len(latencies) / elapsed, 1) if elapsed else 0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p90_ms": round(percentile(latencies, 90) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "max_ms": round(max(latencies, default=0) * 1000, 2),
+        "upstream_search_requests": stats.search_requests,
+        "upstream_searches": stats.searches,
+        "upstream_graphql_requests": stats.graphql_requests,
+        "upstream_books": stats.books,
+        "upstream_images": stats.images,
+        "rss_kib": rss_kib(),
+        "rss_growth_kib": rss_kib() - rss_before,
+        "max_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def run_in_subprocess(workload: str, argv: list[str]) -> dict:
+    """
+    Each workload gets a fresh process, so caches and module state never carry over.
+    """
+    child_argv = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg in ("--workload", "--json"):
+            skip = True
+        elif not arg.startswith(("--workload=", "--json=")):
+            child_argv.append(arg)
+    output = subprocess.run(
+        [sys.executable, "-m", "benchmark.run", "--workload", workload, *child_argv],
+        capture_output=True, text=True, check=True
+    ).stdout
+    for line in output.splitlines():
+        if line.startswith(RESULT_PREFIX):
+            return json.loads(line[len(RESULT_PREFIX):])
+    raise RuntimeError(f"No result from the {workload} workload:\n{output}")
+
+
+def print_report(results: list[dict]):
+    columns = ("workload", "requests", "items", "throughput", "p50_ms", "p90_ms", "p99_ms", "max_ms",
+               "upstream_search_requests", "upstream_graphql_requests", "max_rss_kib")
+    print(" ".join(f"{column:>14}" for column in columns))
+    for result in results:
+        print(" ".join(f"{str(result[column]):>14}" for column in columns))
+    for result in results:
+        print(f"{result['workload']}: statuses {result['statuses']}")
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    args = parse_args(argv)
+    if args.workload == "all":
+        workloads = [workload for workload in WORKLOADS if workload != "replay" or args.queries]
+        results = [run_in_subprocess(workload, argv) for workload in workloads]
+        print_report(results)
+    else:
+        results = [asyncio.run(run_workload(args))]
+        print(RESULT_PREFIX + json.dumps(results[0]))
+        print_report(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
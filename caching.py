@@ -1,85 +1,573 @@
-# file: caching.py
 import os
+import asyncio
 import hashlib
 import json
+import logging
+import sqlite3
+import struct
+import threading
+import time
 from collections import OrderedDict
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import NamedTuple, Optional
+
+import orjson
+
+from compression import compress, ENCODINGS
+from metrics import timed, CACHE_LATENCY, CACHE_LOOKUPS, CACHE_EVICTIONS, EDITION_CACHE_LOOKUPS
+from models import BookMetadata, SeriesMetadata
+
+logger = logging.getLogger("uvicorn")
+
+# Where results are cached: "memory" (in-process LRU spilling to FILE_CACHE_DIR),
+# "sqlite" (one database shared by every local worker) or "redis" (shared by every replica)
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory").lower()
+CACHE_SQLITE_PATH = os.getenv("CACHE_SQLITE_PATH", os.path.join(os.getenv("FILE_CACHE_DIR", "file_cache"), "cache.sqlite3"))
+CACHE_SQLITE_LIMIT = int(os.getenv("CACHE_SQLITE_LIMIT", str(1 * 1024 * 1024 * 1024)))
+CACHE_REDIS_URL = os.getenv("CACHE_REDIS_URL", "redis://localhost:6379/0")
+CACHE_REDIS_PREFIX = os.getenv("CACHE_REDIS_PREFIX", "hardcover:search:")
+# Seconds to connect to and to wait for Redis. A server that stops answering must look like a miss, quickly.
+CACHE_REDIS_TIMEOUT = float(os.getenv("CACHE_REDIS_TIMEOUT", "0.25"))
 
 MEMORY_CACHE_LIMIT = 10 * 1024 * 1024
 FILE_CACHE_LIMIT = 1 * 1024 * 1024 * 1024
-FILE_CACHE_DIR = "file_cache"
-MEMORY_CACHE = OrderedDict()  # { cache_key: (size_in_bytes, response_bytes) }
+FILE_CACHE_DIR = os.getenv("FILE_CACHE_DIR", "file_cache")
+FILE_CACHE_SUFFIX = ".json"
+# Compressed entries get the encoding appended, e.g. ".json.gzip"
+# Write every new entry to disk right away (in the background) instead of only on eviction
+FILE_CACHE_WRITE_THROUGH = os.getenv("FILE_CACHE_WRITE_THROUGH", "true").lower() in ("1", "true", "yes")
+
+# Time to live in seconds
+CACHE_TTL = int(os.getenv("CACHE_TTL", str(7 * 24 * 60 * 60)))
+# How long after CACHE_TTL an entry is still served while it is refreshed in the background
+CACHE_STALE_TTL = int(os.getenv("CACHE_STALE_TTL", str(30 * 24 * 60 * 60)))
+# "No books found" results
+CACHE_NEGATIVE_TTL = int(os.getenv("CACHE_NEGATIVE_TTL", str(10 * 60)))
+# Upstream failures
+CACHE_ERROR_TTL = int(os.getenv("CACHE_ERROR_TTL", "30"))
+
+
+class CacheEntry(NamedTuple):
+    data: bytes
+    stored_at: float
+    ttl: int = CACHE_TTL
+    status: int = 200  # negative entries keep the status of the error they cache
+    encoding: str = "identity"  # content coding of data
+
+    @property
+    def age(self) -> float:
+        return time.time() - self.stored_at
+
+    def is_stale(self) -> bool:
+        return self.age > self.ttl
+
+    def is_expired(self) -> bool:
+        # Only successful results are worth serving stale
+        if self.status != 200:
+            return self.is_stale()
+        return self.age > self.ttl + CACHE_STALE_TTL
+
+
+MEMORY_CACHE = OrderedDict()  # { cache_key: CacheEntry }
+MEMORY_CACHE_SIZE = 0  # running total of the sizes in MEMORY_CACHE
+
+# In-memory index of the file tier, least recently used first.
+# Only successful results are written to disk.
+FILE_CACHE_INDEX = OrderedDict()  # { cache_key: (size_in_bytes, stored_at, encoding) }
+FILE_CACHE_SIZE = 0  # running total of the sizes in FILE_CACHE_INDEX
+FILE_CACHE_LOCK = threading.Lock()
+
+# Disk/backend writes and evictions run here so they never block a request
+CACHE_WRITER = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cache-writer")
+
+# Entity tier: editions per Hardcover book id and edition filter (formats/language), stored serialized.
+# As models, the editions of one book took ~90 KB, mostly their copies of the book's description.
+EDITION_CACHE_LIMIT = int(os.getenv("EDITION_CACHE_LIMIT", "5000"))  # number of (book, filter) entries
+EDITION_CACHE_BYTES = int(os.getenv("EDITION_CACHE_BYTES", str(64 * 1024 * 1024)))
+EDITION_CACHE = OrderedDict()  # { "book_id-filter": (stored_at, JSON list of editions) }
+EDITION_CACHE_SIZE = 0  # running total of the sizes in EDITION_CACHE
 
 if not os.path.exists(FILE_CACHE_DIR):
     os.makedirs(FILE_CACHE_DIR)
 
 
-def get_cache_key(query: str, author: str, lang: Optional[str], retype: Optional[str]) -> str:
-    raw_key = f"{query}-{author}-{lang}-{retype}"
-    return hashlib.md5(raw_key.encode("utf-8")).hexdigest()
+@contextmanager
+def replacing(path: str):
+    """
+    Yields a temporary path next to path and moves it over path once the block succeeds,
+    so readers in any process see either the old or the new file, never a partial one.
+    """
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def get_cache_key(*parts: str) -> str:
+    """
+    Hash of the parts of a normalized search, see normalization.canonical_search.
+    """
+    raw_key = "\x1f".join(parts)
+    return hashlib.blake2b(raw_key.encode("utf-8"), digest_size=16).hexdigest()
 
 
 def calculate_size_in_bytes(data: bytes) -> int:
     return len(data)
 
 
+def get_file_path(cache_key: str, encoding: str = "identity") -> str:
+    suffix = FILE_CACHE_SUFFIX if encoding == "identity" else f"{FILE_CACHE_SUFFIX}.{encoding}"
+    return os.path.join(FILE_CACHE_DIR, cache_key + suffix)
+
+
+def load_file_index():
+    """
+    Rebuild the file tier index from disk. Only needed once at startup.
+    """
+    global FILE_CACHE_SIZE
+    entries = []
+    with os.scandir(FILE_CACHE_DIR) as it:
+        for entry in it:
+            cache_key, suffix, encoding = entry.name.partition(FILE_CACHE_SUFFIX)
+            if not entry.is_file() or not suffix:
+                continue
+            encoding = encoding.lstrip(".") or "identity"
+            if encoding not in ENCODINGS:
+                continue
+            stat = entry.stat()
+            # atime is not updated on noatime mounts, so fall back to mtime
+            entries.append((
+                max(stat.st_atime, stat.st_mtime),
+                cache_key,
+                stat.st_size,
+                stat.st_mtime,
+                encoding
+            ))
+    entries.sort()
+
+    with FILE_CACHE_LOCK:
+        FILE_CACHE_INDEX.clear()
+        for _, cache_key, size, stored_at, encoding in entries:
+            FILE_CACHE_INDEX[cache_key] = (size, stored_at, encoding)
+        FILE_CACHE_SIZE = sum(entry[2] for entry in entries)
+    logger.info(f"Loaded {len(entries)} file cache entries ({FILE_CACHE_SIZE} bytes)")
+
+
 def enforce_file_limit():
-    file_entries = sorted(
-        [
-            (f, os.path.getsize(os.path.join(FILE_CACHE_DIR, f)))
-            for f in os.listdir(FILE_CACHE_DIR)
-        ],
-        key=lambda x: os.path.getmtime(os.path.join(FILE_CACHE_DIR, x))
-    )
-    total_size = sum(x[1] for x in file_entries)
-    while total_size > FILE_CACHE_LIMIT and file_entries:
-        oldest_file, size = file_entries.pop(0)
-        os.remove(os.path.join(FILE_CACHE_DIR, oldest_file))
-        total_size -= size
-
-
-def store_in_file(cache_key: str, data: bytes):
-    file_path = os.path.join(FILE_CACHE_DIR, cache_key + ".json")
-    with open(file_path, "wb") as f:
-        f.write(data)
+    global FILE_CACHE_SIZE
+    while True:
+        with FILE_CACHE_LOCK:
+            if FILE_CACHE_SIZE <= FILE_CACHE_LIMIT or not FILE_CACHE_INDEX:
+                return
+            oldest_key, (size, _, encoding) = FILE_CACHE_INDEX.popitem(last=False)
+            FILE_CACHE_SIZE -= size
+        CACHE_EVICTIONS.labels("file").inc()
+        try:
+            os.remove(get_file_path(oldest_key, encoding))
+        except FileNotFoundError:
+            pass
+
+
+def write_file(cache_key: str, entry: CacheEntry):
+    global FILE_CACHE_SIZE
+    file_path = get_file_path(cache_key, entry.encoding)
+    try:
+        with timed(CACHE_LATENCY, "file", "set"), replacing(file_path) as tmp_path:
+            with open(tmp_path, "wb") as f:
+                f.write(entry.data)
+            # The modification time records when the entry was stored
+            os.utime(tmp_path, (entry.stored_at, entry.stored_at))
+    except OSError as e:
+        logger.error(f"Error writing cache file {file_path}: {e}")
+        return
+
+    size = calculate_size_in_bytes(entry.data)
+    with FILE_CACHE_LOCK:
+        old_size, _, old_encoding = FILE_CACHE_INDEX.pop(cache_key, (0, 0, entry.encoding))
+        FILE_CACHE_SIZE += size - old_size
+        FILE_CACHE_INDEX[cache_key] = (size, entry.stored_at, entry.encoding)
+    if old_encoding != entry.encoding:
+        # The previous version was stored with another encoding and therefore another name
+        try:
+            os.remove(get_file_path(cache_key, old_encoding))
+        except FileNotFoundError:
+            pass
     enforce_file_limit()
 
 
+def store_in_file(cache_key: str, entry: CacheEntry):
+    if entry.status != 200:
+        return
+    CACHE_WRITER.submit(write_file, cache_key, entry)
+
+
 def enforce_memory_limit():
-    global MEMORY_CACHE
-    current_size = sum(x[0] for x in MEMORY_CACHE.values())
-    while current_size > MEMORY_CACHE_LIMIT and MEMORY_CACHE:
+    global MEMORY_CACHE_SIZE
+    while MEMORY_CACHE_SIZE > MEMORY_CACHE_LIMIT and MEMORY_CACHE:
         # Move the oldest item to the file cache
-        oldest_key, oldest_value = MEMORY_CACHE.popitem(last=False)
-        store_in_file(oldest_key, oldest_value[1])
-        current_size = sum(x[0] for x in MEMORY_CACHE.values())
+        oldest_key, oldest_entry = MEMORY_CACHE.popitem(last=False)
+        MEMORY_CACHE_SIZE -= calculate_size_in_bytes(oldest_entry.data)
+        CACHE_EVICTIONS.labels("memory").inc()
+        on_disk = FILE_CACHE_INDEX.get(oldest_key)
+        if on_disk is None or on_disk[1] < oldest_entry.stored_at:
+            store_in_file(oldest_key, oldest_entry)
 
 
-def store_in_memory(cache_key: str, data: bytes):
-    global MEMORY_CACHE
+def remove_from_memory(cache_key: str):
+    global MEMORY_CACHE_SIZE
     if cache_key in MEMORY_CACHE:
-        del MEMORY_CACHE[cache_key]
-    MEMORY_CACHE[cache_key] = (calculate_size_in_bytes(data), data)
+        MEMORY_CACHE_SIZE -= calculate_size_in_bytes(MEMORY_CACHE.pop(cache_key).data)
+
+
+def store_in_memory(cache_key: str, entry: CacheEntry, write_through: bool = FILE_CACHE_WRITE_THROUGH):
+    global MEMORY_CACHE_SIZE
+    remove_from_memory(cache_key)
+    MEMORY_CACHE[cache_key] = entry
+    MEMORY_CACHE_SIZE += calculate_size_in_bytes(entry.data)
+    if write_through:
+        store_in_file(cache_key, entry)
     enforce_memory_limit()
 
 
-def get_from_memory(cache_key: str):
-    global MEMORY_CACHE
-    if cache_key in MEMORY_CACHE:
-        size, content = MEMORY_CACHE[cache_key]
-        # Reinsert to keep it as the newest
-        del MEMORY_CACHE[cache_key]
-        MEMORY_CACHE[cache_key] = (size, content)
-        return content
-    return None
-
-
-def get_from_file(cache_key: str):
-    file_path = os.path.join(FILE_CACHE_DIR, cache_key + ".json")
-    if os.path.exists(file_path):
-        with open(file_path, "rb") as f:
+def get_from_memory(cache_key: str) -> Optional[CacheEntry]:
+    entry = MEMORY_CACHE.get(cache_key)
+    if entry is None:
+        return None
+    if entry.is_expired():
+        remove_from_memory(cache_key)
+        return None
+    # Mark it as the newest
+    MEMORY_CACHE.move_to_end(cache_key)
+    return entry
+
+
+def read_from_file(cache_key: str) -> Optional[CacheEntry]:
+    """
+    Blocking, request handlers run it on a worker thread (see MemoryBackend.get_async).
+    """
+    with FILE_CACHE_LOCK:
+        if cache_key not in FILE_CACHE_INDEX:
+            return None
+        FILE_CACHE_INDEX.move_to_end(cache_key)
+        _, stored_at, encoding = FILE_CACHE_INDEX[cache_key]
+    if CacheEntry(b"", stored_at).is_expired():
+        # Left for eviction, the next successful search overwrites it
+        return None
+    try:
+        with open(get_file_path(cache_key, encoding), "rb") as f:
             content = f.read()
-        # Store it in memory
-        store_in_memory(cache_key, content)
-        return content
-    return None
+    except FileNotFoundError:
+        # Evicted in the meantime
+        return None
+    return CacheEntry(content, stored_at, encoding=encoding)
+
+
+def get_edition_cache_key(book_id: int, edition_filter: str) -> str:
+    return f"{book_id}-{edition_filter}"
+
+
+def remove_editions(edition_key: str):
+    global EDITION_CACHE_SIZE
+    if edition_key in EDITION_CACHE:
+        EDITION_CACHE_SIZE -= len(EDITION_CACHE.pop(edition_key)[1])
+
+
+def load_edition(edition: dict) -> BookMetadata:
+    # Serialized by the app itself, nothing to validate
+    edition["series"] = [SeriesMetadata.model_construct(**series) for series in edition.get("series") or []]
+    return BookMetadata.model_construct(**edition)
+
+
+def get_editions(book_id: int, edition_filter: str) -> Optional[list[BookMetadata]]:
+    edition_key = get_edition_cache_key(book_id, edition_filter)
+    cached = EDITION_CACHE.get(edition_key)
+    if cached is None:
+        EDITION_CACHE_LOOKUPS.labels("miss").inc()
+        return None
+    stored_at, data = cached
+    if time.time() - stored_at > CACHE_TTL:
+        remove_editions(edition_key)
+        EDITION_CACHE_LOOKUPS.labels("miss").inc()
+        return None
+    EDITION_CACHE.move_to_end(edition_key)
+    EDITION_CACHE_LOOKUPS.labels("hit").inc()
+    return [load_edition(edition) for edition in orjson.loads(data)]
+
+
+def store_editions(book_id: int, edition_filter: str, editions: list[BookMetadata]):
+    global EDITION_CACHE_SIZE
+    edition_key = get_edition_cache_key(book_id, edition_filter)
+    data = orjson.dumps([edition.model_dump() for edition in editions])
+    remove_editions(edition_key)
+    EDITION_CACHE[edition_key] = (time.time(), data)
+    EDITION_CACHE_SIZE += len(data)
+    while EDITION_CACHE and (len(EDITION_CACHE) > EDITION_CACHE_LIMIT or EDITION_CACHE_SIZE > EDITION_CACHE_BYTES):
+        remove_editions(next(iter(EDITION_CACHE)))
+        CACHE_EVICTIONS.labels("editions").inc()
+
+
+# stored_at, ttl, status, index into ENCODINGS
+ENTRY_HEADER = struct.Struct("!dIHB")
+
+
+def pack_entry(entry: CacheEntry) -> bytes:
+    return ENTRY_HEADER.pack(entry.stored_at, entry.ttl, entry.status, ENCODINGS.index(entry.encoding)) + entry.data
+
+
+def unpack_entry(value: bytes) -> CacheEntry:
+    stored_at, ttl, status, encoding = ENTRY_HEADER.unpack_from(value)
+    return CacheEntry(value[ENTRY_HEADER.size:], stored_at, ttl, status, ENCODINGS[encoding])
+
+
+def run_in_writer(func, *args):
+    """
+    Queue a backend write on the writer thread, logging instead of losing its errors.
+    """
+    def run():
+        try:
+            func(*args)
+        except Exception as e:
+            logger.error(f"Cache write failed: {e!r}")
+
+    CACHE_WRITER.submit(run)
+
+
+class CacheBackend:
+    """
+    Storage for serialized search results. get_async() may return expired entries,
+    callers go through get_cached() which filters them. It runs on the event loop,
+    blocking reads go to a worker thread.
+    """
+
+    async def get_async(self, cache_key: str) -> Optional[CacheEntry]:
+        raise NotImplementedError
+
+    def set(self, cache_key: str, entry: CacheEntry):
+        raise NotImplementedError
+
+
+class MemoryBackend(CacheBackend):
+    """
+    In-process LRU that spills to (and, with write-through, mirrors to) FILE_CACHE_DIR.
+    Every worker process has its own copy.
+    """
+
+    def __init__(self):
+        load_file_index()
+
+    async def get_async(self, cache_key: str) -> Optional[CacheEntry]:
+        with timed(CACHE_LATENCY, "memory", "get"):
+            entry = get_from_memory(cache_key)
+        if entry or cache_key not in FILE_CACHE_INDEX:
+            return entry
+        # Reading the file would block every other request, the memory tier is only changed on the loop
+        with timed(CACHE_LATENCY, "file", "get"):
+            entry = await asyncio.to_thread(read_from_file, cache_key)
+        if entry:
+            # Store it in memory, it is already on disk
+            store_in_memory(cache_key, entry, write_through=False)
+        return entry
+
+    def set(self, cache_key: str, entry: CacheEntry):
+        with timed(CACHE_LATENCY, "memory", "set"):
+            store_in_memory(cache_key, entry)
+
+
+class SQLiteBackend(CacheBackend):
+    """
+    Single database file in WAL mode, shared safely by every worker process on the host.
+    """
+
+    def __init__(self, path: str = CACHE_SQLITE_PATH, limit: int = CACHE_SQLITE_LIMIT):
+        self.path = path
+        self.limit = limit
+        self.local = threading.local()
+        self.writes = 0
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        connection = self.connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "key TEXT PRIMARY KEY, data BLOB NOT NULL, stored_at REAL NOT NULL, ttl INTEGER NOT NULL, "
+            "status INTEGER NOT NULL, size INTEGER NOT NULL, accessed_at REAL NOT NULL, "
+            "encoding TEXT NOT NULL DEFAULT 'identity')"
+        )
+        columns = [row[1] for row in connection.execute("PRAGMA table_info(cache)")]
+        if "encoding" not in columns:
+            connection.execute("ALTER TABLE cache ADD COLUMN encoding TEXT NOT NULL DEFAULT 'identity'")
+        connection.execute("CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at)")
+
+    def connection(self) -> sqlite3.Connection:
+        # sqlite3 connections must not be shared between threads
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    def get(self, cache_key: str) -> Optional[CacheEntry]:
+        with timed(CACHE_LATENCY, "sqlite", "get"):
+            row = self.connection().execute(
+                "SELECT data, stored_at, ttl, status, accessed_at, encoding FROM cache WHERE key = ?", (cache_key,)
+            ).fetchone()
+        if row is None:
+            return None
+        data, stored_at, ttl, status, accessed_at, encoding = row
+        now = time.time()
+        # Recording every single hit would turn reads into writes, a coarse LRU is enough
+        if now - accessed_at > 60:
+            run_in_writer(self.touch, cache_key, now)
+        return CacheEntry(bytes(data), stored_at, ttl, status, encoding)
+
+    async def get_async(self, cache_key: str) -> Optional[CacheEntry]:
+        # Reads wait for the database file, and for its lock while another process checkpoints
+        return await asyncio.to_thread(self.get, cache_key)
+
+    def set(self, cache_key: str, entry: CacheEntry):
+        run_in_writer(self.write, cache_key, entry)
+
+    def touch(self, cache_key: str, accessed_at: float):
+        self.connection().execute("UPDATE cache SET accessed_at = ? WHERE key = ?", (accessed_at, cache_key))
+
+    def write(self, cache_key: str, entry: CacheEntry):
+        with timed(CACHE_LATENCY, "sqlite", "set"):
+            self.connection().execute(
+                "INSERT OR REPLACE INTO cache (key, data, stored_at, ttl, status, size, accessed_at, encoding) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (cache_key, entry.data, entry.stored_at, entry.ttl, entry.status,
+                 calculate_size_in_bytes(entry.data), time.time(), entry.encoding)
+            )
+        self.writes += 1
+        # Summing sizes is a table scan, so only check the limit every 100 writes
+        if self.writes % 100 == 0:
+            self.enforce_limit()
+
+    def enforce_limit(self):
+        connection = self.connection()
+        now = time.time()
+        connection.execute(
+            "DELETE FROM cache WHERE stored_at + ttl + (CASE WHEN status = 200 THEN ? ELSE 0 END) < ?",
+            (CACHE_STALE_TTL, now)
+        )
+        total_size = connection.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+        while total_size > self.limit:
+            oldest = connection.execute("SELECT key, size FROM cache ORDER BY accessed_at LIMIT 100").fetchall()
+            if not oldest:
+                break
+            connection.executemany("DELETE FROM cache WHERE key = ?", [(key,) for key, _ in oldest])
+            total_size -= sum(size for _, size in oldest)
+            CACHE_EVICTIONS.labels("sqlite").inc(len(oldest))
+
+
+class RedisBackend(CacheBackend):
+    """
+    Any server speaking the Redis protocol, shared by every replica. Redis expires entries
+    itself; size limits are left to the server's maxmemory policy.
+    """
+
+    def __init__(self, url: str = CACHE_REDIS_URL, client=None):
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(
+                url, socket_timeout=CACHE_REDIS_TIMEOUT, socket_connect_timeout=CACHE_REDIS_TIMEOUT
+            )
+        self.client = client
+
+    def get(self, cache_key: str) -> Optional[CacheEntry]:
+        try:
+            with timed(CACHE_LATENCY, "redis", "get"):
+                value = self.client.get(CACHE_REDIS_PREFIX + cache_key)
+        except Exception as e:
+            # A cache outage should look like a miss, not an error
+            logger.error(f"Error reading from Redis: {e!r}")
+            return None
+        if value is None:
+            return None
+        return unpack_entry(value)
+
+    async def get_async(self, cache_key: str) -> Optional[CacheEntry]:
+        # The client is synchronous, it waits for the network on a worker thread
+        return await asyncio.to_thread(self.get, cache_key)
+
+    def set(self, cache_key: str, entry: CacheEntry):
+        lifetime = entry.ttl + (CACHE_STALE_TTL if entry.status == 200 else 0)
+        run_in_writer(
+            self.client.set,
+            CACHE_REDIS_PREFIX + cache_key,
+            pack_entry(entry),
+            max(1, int(lifetime - entry.age))
+        )
+
+
+def create_backend(name: str = CACHE_BACKEND) -> CacheBackend:
+    if name == "memory":
+        return MemoryBackend()
+    if name == "sqlite":
+        return SQLiteBackend()
+    if name == "redis":
+        return RedisBackend()
+    raise ValueError(f"Unknown CACHE_BACKEND: {name}. Must be one of: memory, sqlite, redis")
+
+
+def get_ttl(status: int) -> int:
+    if status == 200:
+        return CACHE_TTL
+    if status == 404:
+        return CACHE_NEGATIVE_TTL
+    return CACHE_ERROR_TTL
+
+
+async def get_cached(cache_key: str) -> Optional[CacheEntry]:
+    entry = await BACKEND.get_async(cache_key)
+    if entry is None or entry.is_expired():
+        CACHE_LOOKUPS.labels("miss").inc()
+        return None
+    if entry.status != 200:
+        CACHE_LOOKUPS.labels("negative").inc()
+    elif entry.is_stale():
+        CACHE_LOOKUPS.labels("stale").inc()
+    else:
+        CACHE_LOOKUPS.labels("hit").inc()
+    return entry
+
+
+def store_cached(cache_key: str, data: bytes, status: int = 200, ttl: Optional[int] = None) -> CacheEntry:
+    # Entries are stored compressed in every backend and sent as-is to clients accepting the encoding
+    data, encoding = compress(data)
+    entry = CacheEntry(data, time.time(), get_ttl(status) if ttl is None else ttl, status, encoding)
+    BACKEND.set(cache_key, entry)
+    return entry
+
+
+def persist_memory():
+    """
+    Write memory tier entries that are not on disk yet, e.g. without FILE_CACHE_WRITE_THROUGH.
+    Called on shutdown, before flush_cache.
+    """
+    if not isinstance(BACKEND, MemoryBackend):
+        return
+    for cache_key, entry in list(MEMORY_CACHE.items()):
+        on_disk = FILE_CACHE_INDEX.get(cache_key)
+        if on_disk is None or on_disk[1] < entry.stored_at:
+            store_in_file(cache_key, entry)
+
+
+def flush_cache():
+    """
+    Block until every queued backend write has finished.
+    """
+    CACHE_WRITER.submit(lambda: None).result()
+
+
+BACKEND = create_backend()
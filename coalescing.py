@@ -0,0 +1,97 @@
+import asyncio
+import os
+import logging
+from typing import Any, Awaitable, Callable, Dict, Set
+
+from fastapi import HTTPException
+
+logger = logging.getLogger("uvicorn")
+
+# Maximum time a coalesced request waits for the in-flight request it joined
+COALESCE_WAIT_TIMEOUT = float(os.getenv("COALESCE_WAIT_TIMEOUT", "30"))
+
+# { cache_key: future resolved with the leader's result or error }
+IN_FLIGHT: Dict[str, asyncio.Future] = {}
+
+# Strong references to background refreshes, the event loop only keeps weak ones
+BACKGROUND_TASKS: Set[asyncio.Task] = set()
+
+COALESCE_STATS = {
+    "leaders": 0,  # requests that actually went upstream
+    "coalesced": 0,  # requests that waited for a leader instead
+    "timeouts": 0,  # coalesced requests that gave up waiting
+}
+
+# The same for cover downloads, kept apart so they do not show up as searches
+COVERS_IN_FLIGHT: Dict[str, asyncio.Future] = {}
+COVER_COALESCE_STATS = dict.fromkeys(COALESCE_STATS, 0)
+
+
+def is_in_flight(cache_key: str) -> bool:
+    return cache_key in IN_FLIGHT
+
+
+async def coalesce(
+        cache_key: str,
+        fetch: Callable[[], Awaitable[Any]],
+        in_flight: Dict[str, asyncio.Future] = IN_FLIGHT,
+        stats: Dict[str, int] = COALESCE_STATS,
+) -> Any:
+    """
+    Run fetch() once per cache key. Concurrent callers with the same key wait
+    for the first caller's result (or error) instead of calling upstream again.
+    """
+    future = in_flight.get(cache_key)
+    if future is not None:
+        stats["coalesced"] += 1
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout=COALESCE_WAIT_TIMEOUT)
+        except asyncio.TimeoutError:
+            stats["timeouts"] += 1
+            logger.warning(f"Timed out waiting for in-flight request {cache_key}")
+            raise HTTPException(
+                status_code=504,
+                detail="Timed out waiting for upstream"
+            )
+
+    future = asyncio.get_running_loop().create_future()
+    in_flight[cache_key] = future
+    stats["leaders"] += 1
+    try:
+        result = await fetch()
+    except asyncio.CancelledError:
+        # The leader's client went away; do not cancel everyone waiting on it
+        future.set_exception(HTTPException(
+            status_code=503,
+            detail="Upstream request was cancelled"
+        ))
+        future.exception()
+        raise
+    except Exception as e:
+        future.set_exception(e)
+        # Mark the exception as retrieved so asyncio does not log it when nobody was waiting
+        future.exception()
+        raise
+    else:
+        future.set_result(result)
+        return result
+    finally:
+        in_flight.pop(cache_key, None)
+
+
+async def _log_errors(awaitable: Awaitable[Any]):
+    try:
+        await awaitable
+    except HTTPException as e:
+        logger.warning(f"Background refresh failed: {e.status_code} {e.detail}")
+    except Exception as e:
+        logger.error(f"Background refresh failed: {e!r}")
+
+
+def run_in_background(awaitable: Awaitable[Any]):
+    """
+    Run a refresh without a waiting client. Errors are logged, not raised.
+    """
+    task = asyncio.create_task(_log_errors(awaitable))
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(BACKGROUND_TASKS.discard)
@@ -0,0 +1,66 @@
+import gzip
+import os
+from typing import Set
+
+# Encoding cached entries are stored with: "gzip", "br" (needs the Brotli package) or "identity"
+CACHE_COMPRESSION = os.getenv("CACHE_COMPRESSION", "gzip").lower()
+CACHE_COMPRESSION_LEVEL = int(os.getenv("CACHE_COMPRESSION_LEVEL", "6"))
+# Entries smaller than this (e.g. cached errors) are not worth compressing
+CACHE_COMPRESSION_MIN_SIZE = int(os.getenv("CACHE_COMPRESSION_MIN_SIZE", "512"))
+
+ENCODINGS = ("identity", "gzip", "br")
+
+if CACHE_COMPRESSION not in ENCODINGS:
+    raise ValueError(f"Unknown CACHE_COMPRESSION: {CACHE_COMPRESSION}. Must be one of: {', '.join(ENCODINGS)}")
+
+
+def compress(data: bytes, encoding: str = CACHE_COMPRESSION) -> tuple[bytes, str]:
+    """
+    Returns the compressed bytes and the encoding that was actually used.
+    """
+    if encoding == "identity" or len(data) < CACHE_COMPRESSION_MIN_SIZE:
+        return data, "identity"
+    if encoding == "gzip":
+        # mtime=0 keeps the output identical for identical input
+        return gzip.compress(data, compresslevel=CACHE_COMPRESSION_LEVEL, mtime=0), "gzip"
+    if encoding == "br":
+        import brotli
+        return brotli.compress(data, quality=CACHE_COMPRESSION_LEVEL), "br"
+    raise ValueError(f"Unknown encoding: {encoding}")
+
+
+def decompress(data: bytes, encoding: str) -> bytes:
+    if encoding == "identity":
+        return data
+    if encoding == "gzip":
+        return gzip.decompress(data)
+    if encoding == "br":
+        import brotli
+        return brotli.decompress(data)
+    raise ValueError(f"Unknown encoding: {encoding}")
+
+
+def accepted_encodings(accept_encoding: str) -> Set[str]:
+    """
+    Parse an Accept-Encoding header into the set of codings the client accepts.
+    """
+    accepted = set()
+    for part in accept_encoding.split(","):
+        coding, _, params = part.partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if quality > 0:
+            accepted.add(coding)
+    if "x-gzip" in accepted:
+        accepted.add("gzip")
+    if "*" in accepted:
+        accepted.update(ENCODINGS)
+    return accepted
@@ -0,0 +1,290 @@
+"""
+Cover image proxy. With COVER_PROXY_URL set, search results link covers through /covers/{edition_id}
+instead of Hardcover's image host. Covers are fetched on first use and stored by their content hash,
+so editions sharing a cover share the file; thumbnails are made from the stored original.
+
+    objects/{sha256}.{ext}            original
+    objects/{sha256}-{width}.{ext}    thumbnail
+    editions/{edition_id}             symlink to the edition's original
+"""
+import os
+import asyncio
+import hashlib
+import importlib.util
+import io
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Optional
+from urllib.parse import urlsplit
+
+import httpx
+from fastapi import HTTPException
+
+from caching import FILE_CACHE_DIR, replacing, run_in_writer
+from metrics import CACHE_EVICTIONS
+from upstream import get_client
+
+logger = logging.getLogger("uvicorn")
+
+# Public URL of this service, e.g. https://provider.example/hardcover. Covers are only proxied when it is set.
+COVER_PROXY_URL = os.getenv("COVER_PROXY_URL", "").rstrip("/")
+COVER_CACHE_DIR = os.getenv("COVER_CACHE_DIR", os.path.join(FILE_CACHE_DIR, "covers"))
+# Bytes of originals and thumbnails kept on disk, least recently used go first
+COVER_CACHE_LIMIT = int(os.getenv("COVER_CACHE_LIMIT", str(2 * 1024 * 1024 * 1024)))
+# Thumbnail widths. Requested widths are rounded up to one of these, so there are only so many variants.
+COVER_WIDTHS = sorted({int(width) for width in os.getenv("COVER_WIDTHS", "160,320,640").split(",") if width})
+# Threads making thumbnails, Pillow releases the GIL while resizing
+COVER_WORKERS = int(os.getenv("COVER_WORKERS", "2"))
+# Larger upstream images are not stored
+COVER_MAX_BYTES = int(os.getenv("COVER_MAX_BYTES", str(10 * 1024 * 1024)))
+# Seconds clients may keep a cover. Edition covers rarely change, ETags make revalidating cheap.
+COVER_MAX_AGE = int(os.getenv("COVER_MAX_AGE", str(30 * 24 * 60 * 60)))
+
+# Upstream URLs of the covers of editions in recent search results
+COVER_URL_LIMIT = 100000
+JPEG_QUALITY = 85
+
+OBJECTS_DIR = os.path.join(COVER_CACHE_DIR, "objects")
+EDITIONS_DIR = os.path.join(COVER_CACHE_DIR, "editions")
+
+# Pillow is optional, without it the original is served for every width
+THUMBNAILS_AVAILABLE = importlib.util.find_spec("PIL") is not None
+
+# Leading bytes of the image formats Hardcover serves
+IMAGE_SIGNATURES = (
+    (b"\xff\xd8\xff", "jpg"),
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"GIF8", "gif"),
+)
+
+COVER_URLS = OrderedDict()  # { edition_id: upstream URL }
+# Originals no wider than some thumbnail width, served as they are instead of being opened again
+NARROW_ORIGINALS = OrderedDict()  # { object file name: image width }
+COVER_INDEX = OrderedDict()  # { object file name: size in bytes }, least recently used first
+COVER_CACHE_SIZE = 0  # running total of the sizes in COVER_INDEX
+COVER_LOCK = threading.Lock()
+
+THUMBNAILER = ThreadPoolExecutor(max_workers=COVER_WORKERS, thread_name_prefix="cover-thumbnails")
+
+
+def proxy_url(edition_id: int, upstream_url: Optional[str]) -> Optional[str]:
+    """
+    The cover URL search results link to, remembering where the cover really is.
+    """
+    if not COVER_PROXY_URL or not upstream_url:
+        return upstream_url
+    with COVER_LOCK:
+        COVER_URLS[edition_id] = upstream_url
+        COVER_URLS.move_to_end(edition_id)
+        if len(COVER_URLS) > COVER_URL_LIMIT:
+            COVER_URLS.popitem(last=False)
+    return f"{COVER_PROXY_URL}/covers/{edition_id}"
+
+
+def cover_is_known(edition_id: int) -> bool:
+    """
+    Whether the edition's cover can be served without asking the GraphQL API for its URL.
+    """
+    with COVER_LOCK:
+        if edition_id in COVER_URLS:
+            return True
+    return os.path.lexists(os.path.join(EDITIONS_DIR, str(edition_id)))
+
+
+def load_cover_index():
+    """
+    Rebuild the index of stored covers from disk. Only needed once at startup.
+    """
+    global COVER_CACHE_SIZE
+    os.makedirs(OBJECTS_DIR, exist_ok=True)
+    os.makedirs(EDITIONS_DIR, exist_ok=True)
+    entries = []
+    with os.scandir(OBJECTS_DIR) as it:
+        for entry in it:
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                stat = entry.stat()
+                entries.append((max(stat.st_atime, stat.st_mtime), entry.name, stat.st_size))
+    entries.sort()
+    with COVER_LOCK:
+        COVER_INDEX.clear()
+        for _, name, size in entries:
+            COVER_INDEX[name] = size
+        COVER_CACHE_SIZE = sum(size for _, _, size in entries)
+    logger.info(f"Loaded {len(entries)} cached covers ({COVER_CACHE_SIZE} bytes)")
+
+
+def object_path(name: str) -> str:
+    return os.path.join(OBJECTS_DIR, name)
+
+
+def use_object(name: str) -> bool:
+    """
+    Mark a stored file as recently used. False if it is not (or no longer) stored.
+    """
+    with COVER_LOCK:
+        if name not in COVER_INDEX:
+            return False
+        COVER_INDEX.move_to_end(name)
+    # Another worker process may have evicted it
+    if os.path.exists(object_path(name)):
+        return True
+    forget_object(name)
+    return False
+
+
+def forget_object(name: str):
+    global COVER_CACHE_SIZE
+    with COVER_LOCK:
+        COVER_CACHE_SIZE -= COVER_INDEX.pop(name, 0)
+
+
+def add_object(name: str, data: bytes):
+    global COVER_CACHE_SIZE
+    path = object_path(name)
+    with replacing(path) as tmp_path, open(tmp_path, "wb") as f:
+        f.write(data)
+    with COVER_LOCK:
+        COVER_CACHE_SIZE += len(data) - COVER_INDEX.pop(name, 0)
+        COVER_INDEX[name] = len(data)
+    run_in_writer(enforce_cover_limit)
+
+
+def enforce_cover_limit():
+    global COVER_CACHE_SIZE
+    while True:
+        with COVER_LOCK:
+            if COVER_CACHE_SIZE <= COVER_CACHE_LIMIT or not COVER_INDEX:
+                return
+            name, size = COVER_INDEX.popitem(last=False)
+            COVER_CACHE_SIZE -= size
+        CACHE_EVICTIONS.labels("covers").inc()
+        try:
+            os.remove(object_path(name))
+        except FileNotFoundError:
+            pass
+
+
+def image_extension(data: bytes) -> Optional[str]:
+    for signature, extension in IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            return extension
+    if data.startswith(b"RIFF") and data[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+
+def stored_original(edition_id: int) -> Optional[str]:
+    link = os.path.join(EDITIONS_DIR, str(edition_id))
+    try:
+        name = os.path.basename(os.readlink(link))
+    except OSError:
+        return None
+    if use_object(name):
+        return name
+    # The original was evicted, the link is fetched again
+    try:
+        os.remove(link)
+    except FileNotFoundError:
+        pass
+    return None
+
+
+def store_original(edition_id: int, data: bytes, extension: str) -> str:
+    name = f"{hashlib.sha256(data).hexdigest()}.{extension}"
+    if not use_object(name):
+        add_object(name, data)
+    link = os.path.join(EDITIONS_DIR, str(edition_id))
+    with replacing(link) as tmp_link:
+        os.symlink(os.path.join("..", "objects", name), tmp_link)
+    return name
+
+
+def thumbnail_width(width: Optional[int]) -> Optional[int]:
+    if not width or not COVER_WIDTHS or not THUMBNAILS_AVAILABLE:
+        return None
+    return next((known for known in COVER_WIDTHS if known >= width), COVER_WIDTHS[-1])
+
+
+def make_thumbnail(original: str, width: int) -> str:
+    """
+    Runs on THUMBNAILER. Returns the name of the thumbnail, or of the original if it is not wider than width.
+    """
+    from PIL import Image
+
+    digest, extension = original.rsplit(".", 1)
+    name = f"{digest}-{width}.{extension}"
+    with Image.open(object_path(original)) as image:
+        if image.width <= width:
+            with COVER_LOCK:
+                NARROW_ORIGINALS[original] = image.width
+                if len(NARROW_ORIGINALS) > COVER_URL_LIMIT:
+                    NARROW_ORIGINALS.popitem(last=False)
+            return original
+        image.thumbnail((width, image.height * width // image.width + 1))
+        if image.format != "PNG" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        buffer = io.BytesIO()
+        image.save(buffer, format={"jpg": "JPEG", "png": "PNG", "gif": "GIF", "webp": "WEBP"}[extension],
+                   quality=JPEG_QUALITY, optimize=True)
+    add_object(name, buffer.getvalue())
+    return name
+
+
+async def download(url: str) -> tuple[bytes, str]:
+    parts = urlsplit(url)
+    client = get_client(f"{parts.scheme}://{parts.netloc}")
+    path = parts.path + (f"?{parts.query}" if parts.query else "")
+    try:
+        async with client.stream("GET", path) as response:
+            if response.status_code == 404:
+                raise HTTPException(status_code=404, detail="Cover not found")
+            response.raise_for_status()
+            data = bytearray()
+            async for chunk in response.aiter_bytes():
+                data.extend(chunk)
+                if len(data) > COVER_MAX_BYTES:
+                    raise HTTPException(status_code=502, detail="Cover is too large")
+    except httpx.HTTPError as e:
+        logger.error(f"Error fetching cover {url}: {e!r}")
+        raise HTTPException(status_code=502, detail="Error fetching cover")
+    extension = image_extension(bytes(data[:12]))
+    if extension is None:
+        raise HTTPException(status_code=502, detail="Cover is not an image")
+    return bytes(data), extension
+
+
+async def get_cover(
+        edition_id: int,
+        width: Optional[int],
+        find_url: Callable[[int], Awaitable[Optional[str]]],
+) -> str:
+    """
+    Path of the edition's cover, fetching and resizing it first if needed.
+    find_url(edition_id) is asked for editions whose cover URL is not remembered.
+    """
+    original = await asyncio.to_thread(stored_original, edition_id)
+    if original is None:
+        with COVER_LOCK:
+            url = COVER_URLS.get(edition_id)
+        if url is None:
+            url = await find_url(edition_id)
+        if url is None:
+            raise HTTPException(status_code=404, detail="Cover not found")
+        data, extension = await download(url)
+        original = await asyncio.to_thread(store_original, edition_id, data, extension)
+
+    width = thumbnail_width(width)
+    if width is None:
+        return object_path(original)
+    with COVER_LOCK:
+        original_width = NARROW_ORIGINALS.get(original)
+    if original_width is not None and original_width <= width:
+        return object_path(original)
+    digest, extension = original.rsplit(".", 1)
+    name = f"{digest}-{width}.{extension}"
+    if not use_object(name):
+        loop = asyncio.get_running_loop()
+        name = await loop.run_in_executor(THUMBNAILER, make_thumbnail, original, width)
+    return object_path(name)
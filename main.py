@@ -1,34 +1,43 @@
-# file: main.py
+import os
+
 import uvicorn
 from app import create_app
-from rate_limit import clear_old_ips
-import threading
-import time
 import logging
 import dotenv
 
-from retreive_api_keys import ApiKeys
+from caching import FILE_CACHE_DIR
+from retreive_api_keys import get_api_keys
 
 logger = logging.getLogger("uvicorn")
 
-app = create_app()
-api_keys = ApiKeys()
+HOST = os.getenv("HOST", "0.0.0.0")
+PORT = int(os.getenv("PORT", "7790"))
+# Worker processes. With more than one, caches and rate limits default to the shared SQLite backends
+WORKERS = int(os.getenv("WORKERS", "1"))
+# Seconds in-flight requests get to finish on shutdown, before caches are flushed
+GRACEFUL_SHUTDOWN_TIMEOUT = int(os.getenv("GRACEFUL_SHUTDOWN_TIMEOUT", "30"))
 
-def hourly_cleanup():
-    """
-    A simple background thread to run clear_old_ips every hour.
-    """
-    while True:
-        clear_old_ips()
-        logger.info("Cleared old IPs from rate limit store.")
-        time.sleep(3600)  # 1 hour
+app = create_app()
 
 
 if __name__ == "__main__":
-    # Start the background cleanup thread
-    cleanup_thread = threading.Thread(target=hourly_cleanup, daemon=True)
-    cleanup_thread.start()
-
-    api_keys.generate_key()
-
-    uvicorn.run(app, host="0.0.0.0", port=7790)
+    # Only here, in the parent process: workers import this module without running this block
+    get_api_keys().generate_key()
+
+    if WORKERS > 1:
+        # Inherited by the workers, which read them on import. Per-process memory caches and
+        # rate limits would multiply the limits and split the cache between the workers.
+        os.environ.setdefault("CACHE_BACKEND", "sqlite")
+        os.environ.setdefault("RATE_LIMIT_BACKEND", "sqlite")
+        # Otherwise /metrics only shows the counters of whichever worker answers the scrape.
+        # Emptied first, the files of an earlier run would be added to this one's.
+        metrics_dir = os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", os.path.join(FILE_CACHE_DIR, "prometheus"))
+        os.makedirs(metrics_dir, exist_ok=True)
+        for name in os.listdir(metrics_dir):
+            if name.endswith(".db"):
+                os.remove(os.path.join(metrics_dir, name))
+        logger.info(f"Starting {WORKERS} workers")
+        uvicorn.run("main:app", host=HOST, port=PORT, workers=WORKERS,
+                    timeout_graceful_shutdown=GRACEFUL_SHUTDOWN_TIMEOUT)
+    else:
+        uvicorn.run(app, host=HOST, port=PORT, timeout_graceful_shutdown=GRACEFUL_SHUTDOWN_TIMEOUT)
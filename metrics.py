@@ -0,0 +1,121 @@
+import os
+import time
+from contextlib import contextmanager
+
+from prometheus_client import Counter, Histogram, CollectorRegistry, REGISTRY, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from prometheus_client.multiprocess import MultiProcessCollector
+
+# Set by main.py for more than one worker: every worker writes its counters and histograms there
+# and /metrics adds up those of all workers. The gauges of StateCollector are the answering worker's.
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+# Upstream calls take up to UPSTREAM_READ_TIMEOUT, cache lookups a few microseconds
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20)
+CACHE_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5)
+
+REQUEST_LATENCY = Histogram(
+    "hardcover_request_seconds", "Time to answer a request, by endpoint",
+    ["endpoint"], buckets=STAGE_BUCKETS
+)
+# typesense, local_index, author_match, graphql, parse, serialize, shape
+STAGE_LATENCY = Histogram(
+    "hardcover_stage_seconds", "Time spent in each stage of a search",
+    ["stage"], buckets=STAGE_BUCKETS
+)
+CACHE_LATENCY = Histogram(
+    "hardcover_cache_seconds", "Time per cache tier operation",
+    ["tier", "operation"], buckets=CACHE_BUCKETS
+)
+# hit, stale, negative (cached error) or miss
+CACHE_LOOKUPS = Counter("hardcover_cache_lookups_total", "Search result cache lookups", ["result"])
+CACHE_EVICTIONS = Counter("hardcover_cache_evictions_total", "Entries evicted from a cache tier", ["tier"])
+EDITION_CACHE_LOOKUPS = Counter("hardcover_edition_cache_lookups_total", "Edition cache lookups per book", ["result"])
+UPSTREAM_ERRORS = Counter("hardcover_upstream_errors_total", "Failed upstream calls", ["upstream"])
+UPSTREAM_RETRIES = Counter("hardcover_upstream_retries_total", "Upstream calls sent again after a failure", ["upstream"])
+UPSTREAM_HEDGES = Counter("hardcover_upstream_hedges_total", "Second upstream calls sent for slow first ones", ["upstream"])
+RATE_LIMITED = Counter("hardcover_rate_limited_total", "Requests rejected with 429", ["limit"])
+
+
+@contextmanager
+def timed(histogram: Histogram, *labels: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.labels(*labels).observe(time.perf_counter() - start)
+
+
+class StateCollector:
+    """
+    Values the app already keeps track of, read when /metrics is scraped instead of being
+    mirrored on every change.
+    """
+
+    def describe(self):
+        # Without this the registry calls collect() on registration, before the modules it reads exist
+        return []
+
+    def collect(self):
+        # Imported here, these modules import this one
+        import caching
+        from coalescing import COALESCE_STATS, COVER_COALESCE_STATS, COVERS_IN_FLIGHT, IN_FLIGHT
+        from retreive_api_keys import API_KEYS
+        from upstream import UPSTREAMS
+
+        requests = CounterMetricFamily(
+            "hardcover_coalesced_requests", "Requests by their role in request coalescing", labels=["role"]
+        )
+        for role, count in COALESCE_STATS.items():
+            requests.add_metric([role], count)
+        yield requests
+        yield GaugeMetricFamily("hardcover_in_flight_searches", "Distinct searches in flight", value=len(IN_FLIGHT))
+        cover_requests = CounterMetricFamily(
+            "hardcover_coalesced_cover_requests", "Cover requests by their role in request coalescing", labels=["role"]
+        )
+        for role, count in COVER_COALESCE_STATS.items():
+            cover_requests.add_metric([role], count)
+        yield cover_requests
+        yield GaugeMetricFamily("hardcover_in_flight_covers", "Distinct cover downloads in flight",
+                                value=len(COVERS_IN_FLIGHT))
+
+        cache_bytes = GaugeMetricFamily("hardcover_cache_bytes", "Bytes held by a cache tier", labels=["tier"])
+        cache_bytes.add_metric(["memory"], caching.MEMORY_CACHE_SIZE)
+        cache_bytes.add_metric(["file"], caching.FILE_CACHE_SIZE)
+        cache_bytes.add_metric(["editions"], caching.EDITION_CACHE_SIZE)
+        yield cache_bytes
+        cache_entries = GaugeMetricFamily("hardcover_cache_entries", "Entries held by a cache tier", labels=["tier"])
+        cache_entries.add_metric(["memory"], len(caching.MEMORY_CACHE))
+        cache_entries.add_metric(["file"], len(caching.FILE_CACHE_INDEX))
+        cache_entries.add_metric(["editions"], len(caching.EDITION_CACHE))
+        yield cache_entries
+
+        breakers = GaugeMetricFamily(
+            "hardcover_upstream_breaker_open", "1 while an upstream's circuit breaker is open", labels=["upstream"]
+        )
+        for upstream in UPSTREAMS:
+            breakers.add_metric([upstream.name], int(upstream.breaker.state == "open"))
+        yield breakers
+
+        if API_KEYS is not None:
+            yield GaugeMetricFamily(
+                "hardcover_api_key_capacity", "Hardcover API requests available right now across all keys",
+                value=API_KEYS.available_capacity()
+            )
+            yield GaugeMetricFamily("hardcover_api_keys", "Usable Hardcover API keys", value=len(API_KEYS.api_keys))
+
+
+STATE = StateCollector()
+REGISTRY.register(STATE)
+
+
+def render(registry: CollectorRegistry = REGISTRY) -> tuple[bytes, str]:
+    """
+    The Prometheus text exposition and its content type.
+    """
+    if PROMETHEUS_MULTIPROC_DIR and registry is REGISTRY:
+        # The default registry only sees this process
+        registry = CollectorRegistry()
+        MultiProcessCollector(registry)
+        registry.register(STATE)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -29,6 +29,18 @@ class BookMetadata(BaseModel):
 # Response model for the /search endpoint
 class SearchResponse(BaseModel):
     matches: List[BookMetadata]
+    # Matches are grouped by book, this many editions per book in order
+    editionsPerBook: Optional[List[int]] = None
+
+
+class BatchSearchItem(BaseModel):
+    query: str  # required
+    author: Optional[str] = None
+
+
+# Request model for the /batch/search endpoint
+class BatchSearchRequest(BaseModel):
+    items: List[BatchSearchItem]
 
 
 class ApiKey(BaseModel):
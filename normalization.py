@@ -0,0 +1,81 @@
+import re
+import unicodedata
+from typing import NamedTuple, Optional
+
+from caching import get_cache_key
+from queries import FORMAT_SETS
+from search_index import tokenize, normalize_identifier
+
+# Articles library sorting moves to the end ("Hobbit, The"), they are moved back to the front
+TRAILING_ARTICLE = re.compile(r"^(.+?)\s*,\s*(the|a|an|der|die|das|le|la|les|el|los|las)$")
+# Typesense drops symbols from words without splitting them ("spider-man" is "spiderman"),
+# so removing them here changes nothing about the results
+SYMBOLS = re.compile(r"[^\w\s]|_")
+WHITESPACE = re.compile(r"\s+")
+# Words joining the authors of a book, not part of their names
+AUTHOR_CONJUNCTIONS = {"and", "und", "et"}
+
+
+class SearchRequest(NamedTuple):
+    """
+    A search as the cache and the upstream calls see it: every spelling of the same search
+    is one SearchRequest with one cache key.
+    """
+    query: str  # sent to Typesense
+    author: Optional[str]  # author words, sorted
+    formats: tuple  # reading format ids of the editions
+    language: Optional[str]  # 2-letter code of the editions
+    identifier: Optional[str]  # ISBN-13/ASIN, if the query is one
+    text: str  # the query as sent, the local search index splits words at symbols instead
+    cache_key: str
+
+
+def normalize_query(query: str) -> str:
+    text = WHITESPACE.sub(" ", unicodedata.normalize("NFKC", query).casefold()).strip()
+    inverted = TRAILING_ARTICLE.match(text)
+    if inverted:
+        text = f"{inverted.group(2)} {inverted.group(1)}"
+    normalized = WHITESPACE.sub(" ", SYMBOLS.sub("", text)).strip()
+    # Nothing but symbols is still searched for as it was
+    return normalized or text
+
+
+def normalize_author(author: Optional[str]) -> Optional[str]:
+    """
+    Authors are matched by their words (see authors.py), so their order does not matter:
+    "Pratchett, Terry & Gaiman, Neil" is "Neil Gaiman and Terry Pratchett".
+    """
+    if not author:
+        return None
+    words = sorted(set(tokenize(unicodedata.normalize("NFKC", author))) - AUTHOR_CONJUNCTIONS)
+    return " ".join(words) or None
+
+
+def get_edition_filter(lang: Optional[str], type: Optional[str]) -> tuple[tuple, Optional[str]]:
+    """
+    Returns the reading formats and the 2-letter language editions are filtered by.
+    "book"/"abook" work in place of the language as well.
+    """
+    if (lang is not None and len(lang) > 2 and lang == "book") or type == "book":
+        formats = FORMAT_SETS["book"]
+    elif (lang is not None and len(lang) > 2 and lang == "abook") or type == "abook":
+        formats = FORMAT_SETS["abook"]
+    else:
+        formats = FORMAT_SETS[None]
+
+    language = lang.lower() if lang is not None and len(lang) == 2 else None
+    return formats, language
+
+
+def canonical_search(
+        query: str,
+        author: Optional[str],
+        lang_code: Optional[str],
+        content_type: Optional[str],
+) -> SearchRequest:
+    identifier = normalize_identifier(query)
+    normalized_query = identifier or normalize_query(query)
+    normalized_author = normalize_author(author)
+    formats, language = get_edition_filter(lang_code, content_type)
+    cache_key = get_cache_key(normalized_query, normalized_author or "", ",".join(map(str, formats)), language or "")
+    return SearchRequest(normalized_query, normalized_author, formats, language, identifier, query, cache_key)
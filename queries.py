@@ -0,0 +1,163 @@
+import os
+from typing import Iterable, Optional
+
+import orjson
+
+# Hardcover reading format ids per content type: 1 and 4 are books, 2 and 3 audiobooks
+FORMAT_SETS = {
+    "book": (1, 4),
+    "abook": (2, 3),
+    None: (1, 2, 3, 4),
+}
+
+SEARCH = {
+    "per_page": 30,
+    "prioritize_exact_match": True,
+    "num_typos": 5,
+    "query_by": "title,isbns,series_names,author_names,alternative_titles",
+    "sort_by": "users_count:desc,_text_match:desc",
+    "query_by_weights": "5,5,3,2,1",
+    "collection": "Book_production",
+    "page": 1,
+}
+
+# Editions fetched per book
+EDITIONS_PER_BOOK = int(os.getenv("EDITIONS_PER_BOOK", "25"))
+
+# Books found per looked up ISBN/ASIN. Editions of one book share an identifier only by mistake.
+BOOKS_PER_IDENTIFIER = 3
+
+# Only what parse_editions reads. Audio fields are only selected when audio formats are requested.
+EDITIONS_QUERY = """query %(operation)s(%(books_variable)s, $booksLimit: Int!, $limit: Int!, $formats: [Int!]!%(language_variable)s) {
+  books(where: %(books_filter)s, limit: $booksLimit, order_by: {users_count: desc}) {
+    id
+    title
+    description%(book_fields)s
+    contributions {
+      author {
+        name
+      }
+    }
+    editions(
+      where: {reading_format_id: {_in: $formats}%(language_filter)s}
+      order_by: {users_count: desc}
+      limit: $limit
+    ) {
+      id
+      title
+      asin
+      isbn13: isbn_13
+      releaseYear: release_year%(audio_fields)s
+      cachedImage: cached_image
+      language {
+        language
+      }
+      contributions {
+        author {
+          name
+        }
+      }
+      publisher {
+        name
+      }
+    }
+  }
+}
+"""
+
+AUDIO_FORMATS = {2, 3}
+
+
+IDENTIFIER_FILTER = "{_or: [{isbn_13: {_in: $identifiers}}, {asin: {_in: $identifiers}}]}"
+
+# operation, books variable, books filter, extra book fields
+BOOK_SELECTIONS = {
+    False: ("FindEditionsForBook", "$bookIds: [Int!]!", "{id: {_in: $bookIds}}", ""),
+    # The editions matching the identifiers are selected separately, the filtered editions may not contain them.
+    # users_count and the identifiers let the search index learn the book.
+    True: (
+        "FindEditionsByIdentifier", "$identifiers: [String!]!", "{editions: %s}" % IDENTIFIER_FILTER,
+        "\n    usersCount: users_count\n    identified: editions(where: %s) {\n      isbn13: isbn_13\n      asin\n    }"
+        % IDENTIFIER_FILTER,
+    ),
+}
+
+
+def prepare_editions_request(formats: tuple, by_language: bool, by_identifier: bool = False) -> dict:
+    operation, books_variable, books_filter, book_fields = BOOK_SELECTIONS[by_identifier]
+    language_variable = ", $language: String!" if by_language else ""
+    language_filter = ", language: {code2: {_eq: $language}}" if by_language else ""
+    audio_fields = "\n      audioSeconds: audio_seconds" if AUDIO_FORMATS.intersection(formats) else ""
+    return {
+        "operationName": operation,
+        "query": EDITIONS_QUERY % {
+            "operation": operation,
+            "books_variable": books_variable,
+            "books_filter": books_filter,
+            "book_fields": book_fields,
+            "language_variable": language_variable,
+            "language_filter": language_filter,
+            "audio_fields": audio_fields,
+        },
+        "variables": {
+            "formats": list(formats),
+            "limit": EDITIONS_PER_BOOK,
+        },
+    }
+
+
+# Every variant is built once here; requests only add the book ids and the language
+EDITIONS_REQUESTS = {
+    (formats, by_language): prepare_editions_request(formats, by_language)
+    for formats in FORMAT_SETS.values()
+    for by_language in (False, True)
+}
+IDENTIFIER_REQUESTS = {
+    (formats, by_language): prepare_editions_request(formats, by_language, by_identifier=True)
+    for formats in FORMAT_SETS.values()
+    for by_language in (False, True)
+}
+
+
+def build_search_body(queries: Iterable[str]) -> bytes:
+    """
+    Typesense multi_search body with one search per query.
+    """
+    return orjson.dumps({"searches": [{**SEARCH, "q": query} for query in queries]})
+
+
+def build_editions_body(book_ids: Iterable[int], formats: tuple, language: Optional[str]) -> bytes:
+    """
+    FindEditionsForBook body. Identical inputs always produce identical bytes.
+    """
+    request = EDITIONS_REQUESTS[(formats, language is not None)]
+    book_ids = sorted(book_ids)
+    variables = {**request["variables"], "bookIds": book_ids, "booksLimit": len(book_ids)}
+    if language is not None:
+        variables["language"] = language
+    return orjson.dumps({**request, "variables": variables})
+
+
+def build_identifier_body(identifiers: Iterable[str], formats: tuple, language: Optional[str]) -> bytes:
+    """
+    FindEditionsByIdentifier body: the books with an edition of one of the ISBN-13s/ASINs, with their editions.
+    """
+    request = IDENTIFIER_REQUESTS[(formats, language is not None)]
+    identifiers = sorted(identifiers)
+    variables = {**request["variables"], "identifiers": identifiers,
+                 "booksLimit": len(identifiers) * BOOKS_PER_IDENTIFIER}
+    if language is not None:
+        variables["language"] = language
+    return orjson.dumps({**request, "variables": variables})
+
+
+COVER_QUERY = """query FindEditionCover($id: Int!) {
+  editions(where: {id: {_eq: $id}}) {
+    cachedImage: cached_image
+  }
+}
+"""
+
+
+def build_cover_body(edition_id: int) -> bytes:
+    return orjson.dumps({"operationName": "FindEditionCover", "query": COVER_QUERY, "variables": {"id": edition_id}})
@@ -1,38 +1,250 @@
-# file: rate_limit.py
+import os
+import asyncio
+import math
+import sqlite3
 import time
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from fastapi import HTTPException
-from typing import Dict, List
+from typing import Optional
 
-# This stores the timestamps of requests for each IP
-# { ip: [timestamps_in_seconds] }
-REQUEST_LOG: Dict[str, List[float]] = {}
+from metrics import RATE_LIMITED
 
-limit = 15
+logger = logging.getLogger("uvicorn")
 
+# Requests per window for each IP and for each client API key (0 disables the key limit)
+limit = int(os.getenv("RATE_LIMIT_PER_IP", "15"))
+key_limit = int(os.getenv("RATE_LIMIT_PER_KEY", "0"))
+window = int(os.getenv("RATE_LIMIT_WINDOW", "60"))  # seconds
+# Uncached /batch/search items per window for each IP, counted separately from the requests above
+batch_item_limit = int(os.getenv("RATE_LIMIT_BATCH_ITEMS_PER_IP", "60"))
 
-def rate_limit_check(ip: str):
-    now = time.time()
-    timestamps = REQUEST_LOG.get(ip, [])
-    one_minute_ago = now - 60
-    # keep only the last minute's requests
-    timestamps = [t for t in timestamps if t > one_minute_ago]
-    if len(timestamps) >= limit:
-        raise HTTPException(
-            status_code=429,
-            detail=f"Rate limit exceeded ({limit} requests per minute). Please try again later."
+# "memory" (per process), "sqlite" (shared by every worker on the host) or "redis" (shared by every worker and replica)
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory").lower()
+RATE_LIMIT_SQLITE_PATH = os.getenv(
+    "RATE_LIMIT_SQLITE_PATH", os.path.join(os.getenv("FILE_CACHE_DIR", "file_cache"), "rate_limit.sqlite3")
+)
+RATE_LIMIT_REDIS_URL = os.getenv("RATE_LIMIT_REDIS_URL", os.getenv("CACHE_REDIS_URL", "redis://localhost:6379/0"))
+RATE_LIMIT_REDIS_PREFIX = os.getenv("RATE_LIMIT_REDIS_PREFIX", "hardcover:ratelimit:")
+# Seconds to wait for Redis, or for another worker's lock on the SQLite file, before letting the request through
+RATE_LIMIT_TIMEOUT = float(os.getenv("RATE_LIMIT_TIMEOUT", "0.25"))
+
+# Idle clients removed per check, so cleanup never needs a full scan
+CLEANUP_BATCH = 10
+
+
+class SlidingWindow:
+    """
+    Sliding window counter: the previous window's count, weighted by how much of it
+    still overlaps the last `window` seconds, plus the current window's count.
+    Fixed size per client, no matter how many requests it makes.
+    """
+    __slots__ = ("window_start", "current", "previous")
+
+    def __init__(self):
+        self.window_start = 0
+        self.current = 0
+        self.previous = 0
+
+    def advance(self, now: float):
+        start = int(now // window * window)
+        if start != self.window_start:
+            self.previous = self.current if start - self.window_start == window else 0
+            self.current = 0
+            self.window_start = start
+
+    def estimate(self, now: float) -> float:
+        self.advance(now)
+        weight = 1 - (now - self.window_start) / window
+        return self.previous * weight + self.current
+
+    def take(self, now: float, max_requests: int, hits: int) -> int:
+        granted = max(0, min(hits, math.ceil(max_requests - self.estimate(now))))
+        self.current += granted
+        return granted
+
+
+# { "ip:<ip>" | "key:<api key>": SlidingWindow }, least recently seen first
+REQUEST_LOG: "OrderedDict[str, SlidingWindow]" = OrderedDict()
+
+
+def cleanup_some(now: float):
+    """
+    Drop a few clients that have been idle for two windows (their counters are zero by then).
+    """
+    for _ in range(CLEANUP_BATCH):
+        if not REQUEST_LOG:
+            return
+        client, counter = next(iter(REQUEST_LOG.items()))
+        if counter.window_start > now - 2 * window:
+            return
+        del REQUEST_LOG[client]
+
+
+def granted_hits(previous: int, current: int, now: float, start: int, max_requests: int, hits: int) -> int:
+    """
+    How many of the hits just added to current fit into the limit.
+    """
+    weight = 1 - (now - start) / window
+    overflow = math.ceil(previous * weight + current - max_requests)
+    return hits - max(0, min(hits, overflow))
+
+
+async def memory_hit(client: str, max_requests: int, now: float, hits: int = 1) -> int:
+    counter = REQUEST_LOG.get(client)
+    if counter is None:
+        counter = REQUEST_LOG[client] = SlidingWindow()
+    else:
+        REQUEST_LOG.move_to_end(client)
+    granted = counter.take(now, max_requests, hits)
+    cleanup_some(now)
+    return granted
+
+
+REDIS_CLIENT = None
+
+
+async def redis_hit(client: str, max_requests: int, now: float, hits: int = 1) -> int:
+    global REDIS_CLIENT
+    if REDIS_CLIENT is None:
+        import redis.asyncio
+        REDIS_CLIENT = redis.asyncio.Redis.from_url(
+            RATE_LIMIT_REDIS_URL, socket_timeout=RATE_LIMIT_TIMEOUT, socket_connect_timeout=RATE_LIMIT_TIMEOUT
         )
-    timestamps.append(now)
-    REQUEST_LOG[ip] = timestamps
 
+    start = int(now // window * window)
+    current_key = f"{RATE_LIMIT_REDIS_PREFIX}{client}:{start}"
+    previous_key = f"{RATE_LIMIT_REDIS_PREFIX}{client}:{start - window}"
+    try:
+        pipeline = REDIS_CLIENT.pipeline()
+        pipeline.get(previous_key)
+        pipeline.incrby(current_key, hits)
+        pipeline.expire(current_key, 2 * window)
+        previous, current, _ = await pipeline.execute()
+        granted = granted_hits(int(previous or 0), current, now, start, max_requests, hits)
+        if granted < hits:
+            # Rejected hits are not counted, like in memory
+            await REDIS_CLIENT.decrby(current_key, hits - granted)
+    except Exception as e:
+        # Rather let requests through than fail them all while Redis is down
+        logger.error(f"Error checking rate limit in Redis: {e!r}")
+        return hits
+    return granted
 
-def clear_old_ips():
+
+SQLITE_CONNECTION = None
+SQLITE_HITS = 0
+# Waiting for the database lock must not block the event loop, the connection lives on this thread
+SQLITE_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rate-limit-sqlite")
+
+
+def sqlite_connection() -> sqlite3.Connection:
+    global SQLITE_CONNECTION
+    if SQLITE_CONNECTION is None:
+        connection = sqlite3.connect(RATE_LIMIT_SQLITE_PATH, timeout=RATE_LIMIT_TIMEOUT, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS rate_limit ("
+            "client TEXT NOT NULL, window_start INTEGER NOT NULL, count INTEGER NOT NULL, "
+            "PRIMARY KEY (client, window_start))"
+        )
+        SQLITE_CONNECTION = connection
+    return SQLITE_CONNECTION
+
+
+def sqlite_take(client: str, max_requests: int, now: float, hits: int) -> int:
     """
-    Remove IPs that have not had a request in the last minute.
-    This can be called periodically (e.g., every hour).
+    Runs on SQLITE_EXECUTOR.
+    """
+    global SQLITE_HITS
+    start = int(now // window * window)
+    try:
+        connection = sqlite_connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute(
+                "INSERT INTO rate_limit (client, window_start, count) VALUES (?, ?, ?) "
+                "ON CONFLICT (client, window_start) DO UPDATE SET count = count + excluded.count",
+                (client, start, hits)
+            )
+            counts = dict(connection.execute(
+                "SELECT window_start, count FROM rate_limit WHERE client = ? AND window_start IN (?, ?)",
+                (client, start, start - window)
+            ).fetchall())
+            granted = granted_hits(counts.get(start - window, 0), counts[start], now, start, max_requests, hits)
+            if granted < hits:
+                # Rejected hits are not counted, like in memory
+                connection.execute(
+                    "UPDATE rate_limit SET count = count - ? WHERE client = ? AND window_start = ?",
+                    (hits - granted, client, start)
+                )
+            SQLITE_HITS += 1
+            if SQLITE_HITS % 100 == 0:
+                connection.execute("DELETE FROM rate_limit WHERE window_start < ?", (start - window,))
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+    except Exception as e:
+        # Same as for Redis: let requests through rather than fail them all
+        logger.error(f"Error checking rate limit in SQLite: {e!r}")
+        return hits
+    return granted
+
+
+async def sqlite_hit(client: str, max_requests: int, now: float, hits: int = 1) -> int:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(SQLITE_EXECUTOR, sqlite_take, client, max_requests, now, hits)
+
+
+HIT_FUNCTIONS = {
+    "memory": memory_hit,
+    "sqlite": sqlite_hit,
+    "redis": redis_hit,
+}
+
+if RATE_LIMIT_BACKEND not in HIT_FUNCTIONS:
+    raise ValueError(f"Unknown RATE_LIMIT_BACKEND: {RATE_LIMIT_BACKEND}. Must be one of: {', '.join(HIT_FUNCTIONS)}")
+
+
+def too_many_requests(limit_name: str, detail: str) -> HTTPException:
+    RATE_LIMITED.labels(limit_name).inc()
+    return HTTPException(
+        status_code=429,
+        detail=f"{detail}. Please try again later.",
+        headers={"Retry-After": str(window)}
+    )
+
+
+async def key_limit_check(api_key: Optional[str], now: float):
+    if api_key and key_limit and not await HIT_FUNCTIONS[RATE_LIMIT_BACKEND](f"key:{api_key}", key_limit, now):
+        raise too_many_requests(
+            "key", f"Rate limit for this API key exceeded ({key_limit} requests per {window} seconds)"
+        )
+
+
+async def rate_limit_check(ip: str, api_key: Optional[str] = None):
+    now = time.time()
+    if not await HIT_FUNCTIONS[RATE_LIMIT_BACKEND](f"ip:{ip}", limit, now):
+        raise too_many_requests("ip", f"Rate limit exceeded ({limit} requests per {window} seconds)")
+    await key_limit_check(api_key, now)
+
+
+async def batch_items_check(ip: str, api_key: Optional[str], items: int) -> int:
+    """
+    A batch request with `items` distinct uncached searches: one request for the API key limit,
+    and up to `items` from the IP's batch quota. Returns how many items may be searched, raises 429 for none.
     """
     now = time.time()
-    one_minute_ago = now - 60
-    for ip, timestamps in list(REQUEST_LOG.items()):
-        # If all timestamps are older than 1 minute, remove them
-        if all(t < one_minute_ago for t in timestamps):
-            del REQUEST_LOG[ip]
+    await key_limit_check(api_key, now)
+    granted = await HIT_FUNCTIONS[RATE_LIMIT_BACKEND](f"batch:{ip}", batch_item_limit, now, items)
+    if not granted:
+        raise too_many_requests(
+            "batch", f"Batch rate limit exceeded ({batch_item_limit} uncached items per {window} seconds)"
+        )
+    if granted < items:
+        RATE_LIMITED.labels("batch").inc()
+    return granted
+
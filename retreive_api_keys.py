@@ -1,82 +1,280 @@
+import asyncio
+import fcntl
 import logging
+import os
 import re
 import time
+from contextlib import contextmanager
+from typing import Optional
 
-import requests
-from fake_useragent import UserAgent
+from fastapi import HTTPException
 
+from caching import FILE_CACHE_DIR, replacing
 from models import ApiKey
+from upstream import remaining_time, DeadlineExceeded
+from user_agents import get_user_agents
+
+API_KEYS_FILE = os.getenv("API_KEYS_FILE", os.path.join(FILE_CACHE_DIR, "api_keys.txt"))
+# How long a request waits for a key while every key is saturated
+KEY_WAIT_TIMEOUT = float(os.getenv("KEY_WAIT_TIMEOUT", "30"))
+# Number of keys to keep that are not about to expire
+KEY_POOL_SIZE = int(os.getenv("KEY_POOL_SIZE", "2"))
+# Keys expiring within this many seconds are replaced ahead of time
+KEY_ROTATE_BEFORE = int(os.getenv("KEY_ROTATE_BEFORE", str(2 * 24 * 60 * 60)))
+KEY_REFRESH_INTERVAL = int(os.getenv("KEY_REFRESH_INTERVAL", str(60 * 60)))
+# Every worker process gets an equal share of each key's rate, so together they never exceed it
+WORKERS = max(1, int(os.getenv("WORKERS", "1")))
+
+
+@contextmanager
+def keys_file_lock():
+    """
+    Held while the keys file is read, modified and written, by any process.
+    """
+    os.makedirs(os.path.dirname(API_KEYS_FILE) or ".", exist_ok=True)
+    with open(f"{API_KEYS_FILE}.lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def read_keys_file() -> list[ApiKey]:
+    keys = []
+    with open(API_KEYS_FILE, "r") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            key, uses, expires, cap = line.strip().split(",")
+            keys.append(ApiKey(
+                key=key,
+                uses=0,
+                expires=int(expires),
+                cap=int(cap),
+                resetTime=0
+            ))
+    return keys
+
+
+def write_keys_file(keys: list[ApiKey]):
+    with replacing(API_KEYS_FILE) as tmp_path, open(tmp_path, "w") as f:
+        for key in keys:
+            f.write(f"{key.key},{key.uses},{key.expires},{key.cap}\n")
+
+
+class TokenBucket:
+    """
+    Allows `capacity` uses per minute, refilled continuously instead of once per window.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def take(self) -> bool:
+        self.refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def wait_time(self) -> float:
+        """
+        Seconds until the next token is available.
+        """
+        self.refill()
+        return max(0.0, (1 - self.tokens) * 60 / self.capacity)
 
 
 class ApiKeys:
     def __init__(self):
         self.api_keys = []
+        self.buckets = {}  # { key: TokenBucket }
+        # Waiting callers are served first come, first served
+        self.waiters = asyncio.Lock()
+        self.rotating = asyncio.Lock()
         self.load_keys()
 
-    def add_key(self, key: ApiKey):
+    def add_key(self, key: ApiKey, save: bool = True):
+        # The bucket first, get_key expects one for every key in api_keys
+        self.buckets[key.key] = TokenBucket(max(1, key.cap // WORKERS))
         self.api_keys.append(key)
-        self.save_keys()
+        if save:
+            self.save_keys()
+
+    def merge_keys(self, keys: list[ApiKey]):
+        """
+        Add keys other processes have saved.
+        """
+        known = {key.key for key in self.api_keys}
+        for key in keys:
+            if key.key not in known:
+                self.add_key(key, save=False)
+        self.clear_expired_keys()
 
     def save_keys(self):
-        with open("./file_cache/api_keys.txt", "w") as f:
-            for key in self.api_keys:
-                f.write(f"{key.key},{key.uses},{key.expires},{key.cap}\n")
+        """
+        Merge this process's keys into the keys file, keeping the ones other processes added.
+        """
+        with keys_file_lock():
+            try:
+                keys = read_keys_file()
+            except FileNotFoundError:
+                keys = []
+            known = {key.key for key in keys}
+            keys.extend(key for key in self.api_keys if key.key not in known)
+            now = int(time.time())
+            write_keys_file([key for key in keys if key.expires > now])
 
     def load_keys(self):
         try:
-            with open("./file_cache/api_keys.txt", "r") as f:
-                for line in f:
-                    key, uses, expires, cap = line.strip().split(",")
-                    api_key = ApiKey(
-                        key=key,
-                        uses=0,
-                        expires=int(expires),
-                        cap=int(cap),
-                        resetTime=0
-                    )
-                    self.add_key(api_key)
-            self.clear_expired_keys()
+            self.merge_keys(read_keys_file())
         except FileNotFoundError:
-            logging.warning("No API keys found. Generating a new one.")
-            self.generate_key(force=True)
+            # The background refresh generates one
+            logging.warning("No API keys found.")
 
-    def get_key(self):
-        ### Gets the oldest key that has not expired and has not reached its cap
-        ### adds 1 to the uses and returns the key. If resetTime is reached then reset uses before and set resetTime to current time + 1 min
+    def get_key(self) -> Optional[ApiKey]:
+        """
+        Take a use from the least loaded key. Returns None if every key is saturated.
+        """
         self.clear_expired_keys()
-        for key in self.api_keys:
+        if not self.api_keys:
+            return None
+        for bucket in self.buckets.values():
+            bucket.refill()
+        key = max(self.api_keys, key=lambda k: self.buckets[k.key].tokens)
+        if not self.buckets[key.key].take():
+            return None
+        key.uses += 1
+        return key
+
+    async def acquire(self) -> ApiKey:
+        """
+        Like get_key, but waits for the next available key instead of failing.
+        """
+        # Waiting longer than the request has left is pointless
+        remaining = remaining_time()
+        if remaining is not None and remaining <= 0:
+            raise DeadlineExceeded("Request budget used up before an API key was taken")
+        deadline_first = remaining is not None and remaining < KEY_WAIT_TIMEOUT
+        try:
+            return await asyncio.wait_for(self._acquire(), timeout=remaining if deadline_first else KEY_WAIT_TIMEOUT)
+        except asyncio.TimeoutError:
+            if deadline_first:
+                raise DeadlineExceeded("Request budget used up waiting for an API key")
+            logging.error("Timed out waiting for an API key.")
+            raise HTTPException(
+                status_code=503,
+                detail="No API key available. Please try again later."
+            )
+
+    async def _acquire(self) -> ApiKey:
+        async with self.waiters:
+            while True:
+                key = self.get_key()
+                if key:
+                    return key
+                if not self.api_keys:
+                    await self.rotate_keys()
+                    if not self.api_keys:
+                        await asyncio.sleep(5)
+                    continue
+                await asyncio.sleep(min(bucket.wait_time() for bucket in self.buckets.values()))
+
+    def available_capacity(self) -> float:
+        """
+        Number of uses available right now across all keys.
+        """
+        for bucket in self.buckets.values():
+            bucket.refill()
+        return sum(bucket.tokens for bucket in self.buckets.values())
+
+    def clear_expired_keys(self) -> bool:
+        now = int(time.time())
+        if all(key.expires > now for key in self.api_keys):
+            return False
+        self.api_keys = [key for key in self.api_keys if key.expires > now]
+        self.buckets = {key.key: self.buckets[key.key] for key in self.api_keys}
+        return True
+
+    async def rotate_keys(self):
+        """
+        Generate a new key when fewer than KEY_POOL_SIZE keys are far enough from expiring.
+        """
+        async with self.rotating:
+            # File locking and scraping are blocking, keep them off the event loop
+            keys = await asyncio.to_thread(self.rotate_shared_keys)
+            self.merge_keys(keys)
 
-            if key.resetTime < int(time.time()):
-                key.uses = 1
-                key.resetTime = int(time.time()) + 60
-                return key
+    def rotate_shared_keys(self) -> list[ApiKey]:
+        """
+        Rotate the keys in the keys file, which every worker process shares. Whichever process
+        gets the lock first generates the key, the others find it in the file.
+        """
+        with keys_file_lock():
+            try:
+                keys = read_keys_file()
+            except FileNotFoundError:
+                keys = []
+            known = {key.key for key in keys}
+            keys.extend(key for key in self.api_keys if key.key not in known)
+            now = int(time.time())
+            keys = [key for key in keys if key.expires > now]
 
-            if key.uses < key.cap:
-                key.uses += 1
-                return key
+            rotate_at = now + KEY_ROTATE_BEFORE
+            if len([key for key in keys if key.expires > rotate_at]) < KEY_POOL_SIZE:
+                api_key = self.fetch_key()
+                if api_key:
+                    keys.append(api_key)
+            write_keys_file(keys)
+            return keys
 
-    def clear_expired_keys(self):
-        self.api_keys = [key for key in self.api_keys if key.expires > int(time.time())]
+    async def refresh_keys_forever(self):
+        while True:
+            try:
+                await self.rotate_keys()
+            except Exception as e:
+                logging.error(f"Failed to refresh API keys: {e!r}")
+            await asyncio.sleep(KEY_REFRESH_INTERVAL)
 
     def generate_key(self, force=False):
         if not force and self.api_keys and len(self.api_keys) > 1:
             return
 
+        api_key = self.fetch_key()
+        if api_key:
+            self.add_key(api_key)
+
+    def fetch_key(self) -> Optional[ApiKey]:
+        # Only needed when a key is generated, which most processes never do
+        import requests
+
         headers = {
-            "User-Agent": UserAgent().google
+            "User-Agent": get_user_agents().google()
         }
         logging.info("Generating API key...")
-        response = requests.get("https://hardcover.app", headers=headers)
-
         try:
+            response = requests.get("https://hardcover.app", headers=headers, timeout=30)
             response.raise_for_status()
-        except requests.HTTPError:
-            logging.error("Failed to generate API key.")
+        except requests.RequestException as e:
+            logging.error(f"Failed to generate API key: {e}")
+            return None
 
-        stripped_data = response.text[(response.text.index(r'\"token\":\"') + 12):]
+        try:
+            stripped_data = response.text[(response.text.index(r'\"token\":\"') + 12):]
 
-        index_1 = stripped_data.index(r'"])')
-        index_2 = stripped_data.index(r'\",')
+            index_1 = stripped_data.index(r'"])')
+            index_2 = stripped_data.index(r'\",')
+        except ValueError:
+            logging.error("Failed to generate API key: no token found.")
+            return None
 
         if index_1 < index_2:
             stripped_data = stripped_data[:index_1]
@@ -91,6 +289,18 @@ class ApiKeys:
             resetTime=int(time.time()) + 60
         )
 
-        self.add_key(api_key)
+        print(f"Generated API key: {api_key.key}")
+        return api_key
+
+
+API_KEYS: Optional[ApiKeys] = None
+
 
-        print(f"Generated API key: {self.api_keys[-1].key}")
+def get_api_keys() -> ApiKeys:
+    """
+    The key pool shared by everything in this process.
+    """
+    global API_KEYS
+    if API_KEYS is None:
+        API_KEYS = ApiKeys()
+    return API_KEYS
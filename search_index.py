@@ -0,0 +1,438 @@
+import os
+import re
+import bisect
+import fcntl
+import logging
+import mmap
+import struct
+import threading
+import unicodedata
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Iterable, Optional
+
+import orjson
+
+from caching import FILE_CACHE_DIR, replacing
+
+logger = logging.getLogger("uvicorn")
+
+# Answer searches for titles seen in earlier Typesense results locally, without calling Typesense
+SEARCH_INDEX_ENABLED = os.getenv("SEARCH_INDEX_ENABLED", "true").lower() in ("1", "true", "yes")
+SEARCH_INDEX_PATH = os.getenv("SEARCH_INDEX_PATH", os.path.join(FILE_CACHE_DIR, "search_index.bin"))
+# Most read books kept when the index is written to disk
+SEARCH_INDEX_LIMIT = int(os.getenv("SEARCH_INDEX_LIMIT", "200000"))
+# The index is rewritten (in the background) after this many new or updated books
+SEARCH_INDEX_SAVE_EVERY = int(os.getenv("SEARCH_INDEX_SAVE_EVERY", "1000"))
+# Hits returned for a local search, like Typesense's per_page
+SEARCH_INDEX_HITS = 30
+# Typo matching gives up on word prefixes shared by more known words than this
+FUZZY_SCAN_LIMIT = 5000
+
+# Saving rewrites the whole file, which must not hold up the cache writes queued on caching.CACHE_WRITER
+INDEX_WRITER = ThreadPoolExecutor(max_workers=1, thread_name_prefix="search-index-writer")
+
+# Document fields that are kept, the rest of the Typesense document is dropped
+DOCUMENT_FIELDS = ("id", "title", "author_names", "series_names", "alternative_titles", "isbns", "users_count")
+TEXT_FIELDS = ("title", "author_names", "series_names", "alternative_titles")
+
+# Identifier tokens cannot collide with words, since words never contain ":"
+IDENTIFIER_PREFIX = "id:"
+ISBN_PATTERN = re.compile(r"^(\d{9}[\dX]|\d{13})$")
+ASIN_PATTERN = re.compile(r"^B0[A-Z0-9]{8}$")
+TOKEN_PATTERN = re.compile(r"\w+")
+
+# File layout, all offsets are absolute:
+# header | documents (book id, offset, length), sorted by book id | tokens (offset, length, postings offset, count)
+# | document blobs (JSON) | token blobs (UTF-8, sorted) | postings (document numbers)
+MAGIC = b"HCSI"
+VERSION = 1
+HEADER = struct.Struct("!4sHIIQQQQQ")
+DOCUMENT = struct.Struct("!IQI")
+TOKEN = struct.Struct("!QHQI")
+POSTING = struct.Struct("!I")
+
+
+def tokenize(text: str) -> list[str]:
+    """
+    Lowercase words without diacritics.
+    """
+    text = unicodedata.normalize("NFKD", text.casefold())
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return TOKEN_PATTERN.findall(text)
+
+
+def isbn10_to_isbn13(isbn: str) -> str:
+    digits = "978" + isbn[:9]
+    check = (10 - sum(int(digit) * (3 if i % 2 else 1) for i, digit in enumerate(digits)) % 10) % 10
+    return digits + str(check)
+
+
+def normalize_identifier(value: str) -> Optional[str]:
+    """
+    ISBN-13 (ISBN-10 is converted) or ASIN, or None if the value is neither.
+    """
+    value = re.sub(r"[\s-]", "", value).upper()
+    if ISBN_PATTERN.match(value):
+        return isbn10_to_isbn13(value) if len(value) == 10 else value
+    if ASIN_PATTERN.match(value):
+        return value
+    return None
+
+
+def document_tokens(document: dict) -> set[str]:
+    tokens = set()
+    for field in TEXT_FIELDS:
+        values = document.get(field) or []
+        for value in [values] if isinstance(values, str) else values:
+            tokens.update(tokenize(value))
+    for value in document.get("isbns") or []:
+        identifier = normalize_identifier(value)
+        if identifier:
+            tokens.add(IDENTIFIER_PREFIX + identifier)
+    return tokens
+
+
+def merge_identifiers(document: dict, previous: dict) -> dict:
+    """
+    Typesense documents list only some of a book's ISBNs, the ones learned from its editions are kept.
+    """
+    isbns = list(dict.fromkeys([*(document.get("isbns") or []), *(previous.get("isbns") or [])]))
+    return {**document, "isbns": isbns} if isbns else document
+
+
+def edit_distance_at_most_one(a: str, b: str) -> bool:
+    if a == b:
+        return True
+    if abs(len(a) - len(b)) > 1:
+        return False
+    if len(a) > len(b):
+        a, b = b, a
+    for i in range(len(a)):
+        if a[i] != b[i]:
+            # Substitution, insertion or transposition
+            return (a[i + 1:] == b[i + 1:] or a[i:] == b[i + 1:]
+                    or (len(a) == len(b) and a[i] == b[i + 1] and a[i + 1] == b[i] and a[i + 2:] == b[i + 2:]))
+    return True
+
+
+class MappedIndex:
+    """
+    Read-only view of an index file. Lookups binary search the memory-mapped token table,
+    nothing but the header is read at startup.
+    """
+
+    def __init__(self, path: str):
+        self.file = open(path, "rb")
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.document_count, self.token_count,
+         self.documents_offset, self.tokens_offset, self.document_blobs_offset,
+         self.token_blobs_offset, self.postings_offset) = HEADER.unpack_from(self.mm)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError(f"Not a search index (version {VERSION}): {path}")
+
+    def close(self):
+        self.mm.close()
+        self.file.close()
+
+    def __len__(self) -> int:
+        return self.token_count
+
+    def __getitem__(self, i: int) -> str:
+        # Lets bisect search the token table directly
+        offset, length, _, _ = TOKEN.unpack_from(self.mm, self.tokens_offset + i * TOKEN.size)
+        start = self.token_blobs_offset + offset
+        return self.mm[start:start + length].decode("utf-8")
+
+    def postings(self, i: int) -> list[int]:
+        _, _, offset, count = TOKEN.unpack_from(self.mm, self.tokens_offset + i * TOKEN.size)
+        return list(struct.unpack_from(f"!{count}I", self.mm, self.postings_offset + offset))
+
+    def find(self, token: str) -> Optional[int]:
+        i = bisect.bisect_left(self, token)
+        if i < self.token_count and self[i] == token:
+            return i
+        return None
+
+    def prefix_range(self, prefix: str) -> range:
+        return range(bisect.bisect_left(self, prefix), bisect.bisect_left(self, prefix + "\U0010ffff"))
+
+    def book_id(self, number: int) -> int:
+        return DOCUMENT.unpack_from(self.mm, self.documents_offset + number * DOCUMENT.size)[0]
+
+    def number(self, book_id: int) -> Optional[int]:
+        low, high = 0, self.document_count
+        while low < high:
+            middle = (low + high) // 2
+            if self.book_id(middle) < book_id:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.document_count and self.book_id(low) == book_id:
+            return low
+        return None
+
+    def document(self, number: int) -> dict:
+        _, offset, length = DOCUMENT.unpack_from(self.mm, self.documents_offset + number * DOCUMENT.size)
+        start = self.document_blobs_offset + offset
+        return orjson.loads(self.mm[start:start + length])
+
+    def documents(self) -> Iterable[dict]:
+        for number in range(self.document_count):
+            yield self.document(number)
+
+
+def write_index(path: str, documents: list[dict]):
+    """
+    Write documents as an index file, atomically replacing the previous one.
+    """
+    documents = sorted(documents, key=lambda document: int(document["id"]))
+    postings = {}
+    for number, document in enumerate(documents):
+        for token in document_tokens(document):
+            postings.setdefault(token, []).append(number)
+    tokens = sorted(postings)
+
+    document_blobs = [orjson.dumps(document) for document in documents]
+    token_blobs = [token.encode("utf-8") for token in tokens]
+
+    documents_offset = HEADER.size
+    tokens_offset = documents_offset + len(documents) * DOCUMENT.size
+    document_blobs_offset = tokens_offset + len(tokens) * TOKEN.size
+    token_blobs_offset = document_blobs_offset + sum(len(blob) for blob in document_blobs)
+    postings_offset = token_blobs_offset + sum(len(blob) for blob in token_blobs)
+
+    with replacing(path) as tmp_path, open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(documents), len(tokens), documents_offset, tokens_offset,
+                            document_blobs_offset, token_blobs_offset, postings_offset))
+        offset = 0
+        for document, blob in zip(documents, document_blobs):
+            f.write(DOCUMENT.pack(int(document["id"]), offset, len(blob)))
+            offset += len(blob)
+        offset = posting_offset = 0
+        for token, blob in zip(tokens, token_blobs):
+            f.write(TOKEN.pack(offset, len(blob), posting_offset, len(postings[token])))
+            offset += len(blob)
+            posting_offset += len(postings[token]) * POSTING.size
+        for blob in document_blobs:
+            f.write(blob)
+        for blob in token_blobs:
+            f.write(blob)
+        for token in tokens:
+            f.write(struct.pack(f"!{len(postings[token])}I", *postings[token]))
+
+
+class SearchIndex:
+    """
+    Inverted index of the book documents Typesense returned so far.
+    The file on disk is memory-mapped; books learned since it was written are kept
+    in memory (and take precedence) until the next save.
+    """
+
+    def __init__(self, path: str = SEARCH_INDEX_PATH):
+        self.path = path
+        self.mapped: Optional[MappedIndex] = None
+        self.documents = {}  # { book_id: document } learned since the last save
+        self.tokens = {}  # { token: {book_id, ...} } for self.documents
+        self.unsaved = 0
+        self.lock = threading.Lock()  # guards swapping the mapped file
+        self.open()
+
+    def open(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            mapped = MappedIndex(self.path)
+        except (OSError, ValueError, struct.error) as e:
+            logger.error(f"Could not open search index {self.path}: {e!r}")
+            return
+        with self.lock:
+            previous, self.mapped = self.mapped, mapped
+        if previous:
+            previous.close()
+        logger.info(f"Loaded search index with {mapped.document_count} books")
+
+    def add(self, document: dict):
+        document = {field: document[field] for field in DOCUMENT_FIELDS if field in document}
+        book_id = int(document["id"])
+        with self.lock:
+            previous = self.documents.get(book_id)
+            in_memory = previous is not None
+            if not in_memory and self.mapped:
+                number = self.mapped.number(book_id)
+                previous = self.mapped.document(number) if number is not None else None
+            if previous:
+                document = merge_identifiers(document, previous)
+            if previous == document:
+                return
+            if in_memory:
+                self.forget(book_id, previous)
+            self.documents[book_id] = document
+            for token in document_tokens(document):
+                self.tokens.setdefault(token, set()).add(book_id)
+
+        self.unsaved += 1
+        if self.unsaved >= SEARCH_INDEX_SAVE_EVERY:
+            self.save()
+
+    def learn(self, result: dict):
+        """
+        Add the books of a Typesense search result.
+        """
+        for hit in result.get("hits") or []:
+            document = hit.get("document") or {}
+            if "id" in document and "title" in document:
+                self.add(document)
+
+    def learn_identifiers(self, book_id: int, identifiers: Iterable[Optional[str]], document: Optional[dict] = None):
+        """
+        Make a book findable by the ISBNs and ASINs of its editions. A book the index does not
+        know yet is only added if its document is given.
+        """
+        with self.lock:
+            known = self.documents.get(book_id)
+            if known is None and self.mapped:
+                number = self.mapped.number(book_id)
+                known = self.mapped.document(number) if number is not None else None
+        # A known document came from Typesense and has more fields than the given one
+        document = known or document
+        if document is None:
+            return
+        isbns = document.get("isbns") or []
+        new = {identifier for identifier in identifiers if identifier and identifier not in isbns}
+        if new:
+            self.add({**document, "isbns": [*isbns, *sorted(new)]})
+
+    def forget(self, book_id: int, document: dict):
+        for token in document_tokens(document):
+            book_ids = self.tokens.get(token)
+            if book_ids is not None:
+                book_ids.discard(book_id)
+                if not book_ids:
+                    del self.tokens[token]
+
+    def lookup(self, token: str) -> set[int]:
+        book_ids = set(self.tokens.get(token, ()))
+        if self.mapped:
+            i = self.mapped.find(token)
+            if i is not None:
+                book_ids.update(self.mapped.book_id(number) for number in self.mapped.postings(i))
+        return book_ids
+
+    def expand(self, token: str) -> set[str]:
+        """
+        The token itself if it is known, otherwise known tokens within one edit of it.
+        """
+        if token in self.tokens or (self.mapped and self.mapped.find(token) is not None):
+            return {token}
+        # Short words have too many neighbours to guess from, and numbers (volumes, years) are never typos
+        if len(token) < 5 or not token.isalpha():
+            return set()
+        prefix = token[:2]
+        candidates = [known for known in self.tokens if known.startswith(prefix)]
+        if self.mapped:
+            prefix_range = self.mapped.prefix_range(prefix)
+            if len(prefix_range) > FUZZY_SCAN_LIMIT:
+                return set()
+            candidates.extend(self.mapped[i] for i in prefix_range)
+        return {known for known in candidates if edit_distance_at_most_one(token, known)}
+
+    def get_document(self, book_id: int) -> Optional[dict]:
+        if book_id in self.documents:
+            return self.documents[book_id]
+        if self.mapped:
+            number = self.mapped.number(book_id)
+            if number is not None:
+                return self.mapped.document(number)
+        return None
+
+    def search(self, query: str) -> Optional[dict]:
+        """
+        A Typesense-shaped result ({"hits": [{"document": ...}]}) for a confident match,
+        or None if Typesense has to be asked.
+        A match is confident when the query is a known ISBN/ASIN, or when every query word
+        matches a book and the words of that book's title are all in the query, spelled as they are.
+        Typos are only forgiven in the rest of the query: "Shadow" is not answered with "Shadows",
+        that is left to Typesense's exact match ranking.
+        """
+        with self.lock:
+            identifier = normalize_identifier(query)
+            if identifier:
+                book_ids = self.lookup(IDENTIFIER_PREFIX + identifier)
+                return self.result(book_ids) if book_ids else None
+
+            words = tokenize(query)
+            if not words:
+                return None
+            book_ids = None
+            for word in dict.fromkeys(words):
+                matches = set()
+                for token in self.expand(word):
+                    matches.update(self.lookup(token))
+                book_ids = matches if book_ids is None else book_ids & matches
+                if not book_ids:
+                    return None
+
+            result = self.result(book_ids)
+            for hit in result["hits"]:
+                if set(tokenize(hit["document"]["title"])) <= set(words):
+                    return result
+            return None
+
+    def result(self, book_ids: set[int]) -> dict:
+        documents = [document for document in map(self.get_document, book_ids) if document]
+        documents.sort(key=lambda document: document.get("users_count", 0), reverse=True)
+        return {"hits": [{"document": document} for document in documents[:SEARCH_INDEX_HITS]]}
+
+    def save(self) -> Optional[Future]:
+        """
+        Merge the learned books into the file on INDEX_WRITER and map the new file.
+        """
+        if not self.unsaved:
+            return None
+        learned = dict(self.documents)
+        self.unsaved = 0
+
+        def write():
+            try:
+                merge()
+            except Exception as e:
+                logger.error(f"Could not save search index {self.path}: {e!r}")
+
+        def merge():
+            # Other worker processes save to the same file, merge with whatever is there now
+            with open(f"{self.path}.lock", "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                documents = dict(learned)
+                if os.path.exists(self.path):
+                    current = MappedIndex(self.path)
+                    for document in current.documents():
+                        book_id = int(document["id"])
+                        documents[book_id] = merge_identifiers(documents.get(book_id, document), document)
+                    current.close()
+                ordered = sorted(documents.values(), key=lambda document: document.get("users_count", 0), reverse=True)
+                write_index(self.path, ordered[:SEARCH_INDEX_LIMIT])
+                fcntl.flock(lock, fcntl.LOCK_UN)
+            self.open()
+            # Whatever was learned while writing stays in memory for the next save
+            with self.lock:
+                for book_id, document in learned.items():
+                    if self.documents.get(book_id) is document:
+                        del self.documents[book_id]
+                        self.forget(book_id, document)
+            logger.info(f"Saved search index with {min(len(ordered), SEARCH_INDEX_LIMIT)} books")
+
+        return INDEX_WRITER.submit(write)
+
+
+SEARCH_INDEX: Optional[SearchIndex] = None
+
+
+def get_search_index() -> Optional[SearchIndex]:
+    """
+    The index shared by everything in this process, or None if it is disabled.
+    """
+    global SEARCH_INDEX
+    if SEARCH_INDEX is None and SEARCH_INDEX_ENABLED:
+        SEARCH_INDEX = SearchIndex()
+    return SEARCH_INDEX
@@ -0,0 +1,154 @@
+"""
+Views of a cached /search result for the limit, offset, max_editions_per_book, dedupe and fields
+parameters. The full result is cached once per search; shaped responses are cut from its parsed
+form per request and are not cached themselves.
+"""
+import os
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+
+import orjson
+from fastapi import HTTPException, Query
+
+from caching import CacheEntry, get_cache_key
+from compression import decompress
+from metrics import timed, STAGE_LATENCY
+from models import BookMetadata
+
+# Parsed results kept for shaping, so paging through a result does not parse it every time.
+# Bytes of their JSON; as Python objects they take a few times as much.
+SHAPE_CACHE_BYTES = int(os.getenv("SHAPE_CACHE_BYTES", str(8 * 1024 * 1024)))
+
+FIELDS = tuple(BookMetadata.model_fields)
+
+PARSED_RESULTS = OrderedDict()  # { cache_key: (stored_at, matches, editions per book, JSON size) }
+PARSED_RESULTS_SIZE = 0  # running total of the JSON sizes in PARSED_RESULTS
+
+
+class Shape(NamedTuple):
+    limit: Optional[int] = None
+    offset: int = 0
+    max_editions_per_book: Optional[int] = None
+    dedupe: bool = False
+    fields: Optional[tuple] = None
+
+    @property
+    def key(self) -> str:
+        return get_cache_key(*map(str, self))[:12]
+
+
+# The cached result as it is
+FULL = Shape()
+
+
+def get_shape(
+        limit: Optional[int] = Query(None, ge=1, description="Number of editions to return"),
+        offset: int = Query(0, ge=0, description="Number of editions to skip"),
+        max_editions_per_book: Optional[int] = Query(None, ge=1, description="Editions to return per book"),
+        dedupe: bool = Query(False, description="Leave out editions with the same ISBN/ASIN, or the same title, "
+                                                "language and format as an earlier edition of the book"),
+        fields: Optional[str] = Query(None, description="Comma separated fields of the editions to return, "
+                                                        "title is always included"),
+) -> Shape:
+    selected = None
+    if fields:
+        selected = tuple(dict.fromkeys(field.strip() for field in fields.split(",") if field.strip()))
+        unknown = [field for field in selected if field not in BookMetadata.model_fields]
+        if unknown:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Unknown fields: {', '.join(unknown)}. Must be some of: {', '.join(FIELDS)}"
+            )
+        if "title" not in selected:
+            selected = ("title",) + selected
+    return Shape(limit, offset, max_editions_per_book, dedupe, selected)
+
+
+def group_by_author(matches: list[dict]) -> list[int]:
+    # Results cached before editionsPerBook existed: a book's editions follow each other and share authors
+    counts = []
+    previous = object()
+    for match in matches:
+        if counts and match.get("author") == previous:
+            counts[-1] += 1
+        else:
+            counts.append(1)
+        previous = match.get("author")
+    return counts
+
+
+def parsed_result(cache_key: str, entry: CacheEntry) -> tuple[list[dict], list[int]]:
+    global PARSED_RESULTS_SIZE
+    cached = PARSED_RESULTS.get(cache_key)
+    if cached is not None and cached[0] == entry.stored_at:
+        PARSED_RESULTS.move_to_end(cache_key)
+        return cached[1], cached[2]
+
+    data = decompress(entry.data, entry.encoding)
+    result = orjson.loads(data)
+    matches = result["matches"]
+    counts = result.get("editionsPerBook") or group_by_author(matches)
+    if cached is not None:
+        PARSED_RESULTS_SIZE -= PARSED_RESULTS.pop(cache_key)[3]
+    if len(data) <= SHAPE_CACHE_BYTES:
+        PARSED_RESULTS[cache_key] = (entry.stored_at, matches, counts, len(data))
+        PARSED_RESULTS_SIZE += len(data)
+        while PARSED_RESULTS_SIZE > SHAPE_CACHE_BYTES:
+            PARSED_RESULTS_SIZE -= PARSED_RESULTS.popitem(last=False)[1][3]
+    return matches, counts
+
+
+def unique_editions(editions: list[dict]) -> list[dict]:
+    kept = []
+    identifiers = set()
+    descriptions = set()
+    for edition in editions:
+        edition_identifiers = {edition.get("isbn"), edition.get("asin")} - {None}
+        # Only audiobooks have a duration
+        description = (
+            (edition.get("title") or "").casefold(), (edition.get("subtitle") or "").casefold(),
+            edition.get("language"), edition.get("duration") is not None,
+        )
+        if identifiers & edition_identifiers or description in descriptions:
+            continue
+        identifiers |= edition_identifiers
+        descriptions.add(description)
+        kept.append(edition)
+    return kept
+
+
+def shape_result(cache_key: str, entry: CacheEntry, shape: Shape) -> bytes:
+    """
+    The response for shape, from a successful cache entry.
+    """
+    with timed(STAGE_LATENCY, "shape"):
+        matches, counts = parsed_result(cache_key, entry)
+
+        editions = []  # (book index, edition)
+        start = 0
+        for book, count in enumerate(counts):
+            book_editions = matches[start:start + count]
+            start += count
+            if shape.dedupe:
+                book_editions = unique_editions(book_editions)
+            if shape.max_editions_per_book is not None:
+                book_editions = book_editions[:shape.max_editions_per_book]
+            editions.extend((book, edition) for edition in book_editions)
+
+        end = shape.offset + shape.limit if shape.limit is not None else None
+        editions = editions[shape.offset:end]
+
+        editions_per_book = []
+        previous = None
+        for book, _ in editions:
+            if book == previous:
+                editions_per_book[-1] += 1
+            else:
+                editions_per_book.append(1)
+            previous = book
+
+        if shape.fields is not None:
+            page = [{field: edition.get(field) for field in shape.fields} for _, edition in editions]
+        else:
+            page = [edition for _, edition in editions]
+        return orjson.dumps({"matches": page, "editionsPerBook": editions_per_book})
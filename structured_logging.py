@@ -0,0 +1,73 @@
+import os
+import logging
+import queue
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+import orjson
+
+# "text" keeps uvicorn's format, "json" writes one JSON object per line
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+
+# Loggers whose handlers are moved behind a queue
+QUEUED_LOGGERS = ("", "uvicorn", "uvicorn.access")
+
+LISTENERS = []  # [(logger, original handlers, QueueListener)]
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per record. Request logs pass their fields with extra={"fields": {...}}.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return orjson.dumps(entry, default=str).decode("utf-8")
+
+
+class RecordQueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The queue never leaves the process, so the record is passed as it is
+        # and even formatting the message happens on the listener thread
+        return record
+
+
+def setup_logging():
+    """
+    Put a queue in front of the configured handlers, so logging in a request only
+    appends to a queue and the writes to stderr happen on a background thread.
+    Called once uvicorn has configured its loggers.
+    """
+    if LISTENERS:
+        return
+    for name in QUEUED_LOGGERS:
+        logger = logging.getLogger(name)
+        handlers = list(logger.handlers)
+        if not handlers:
+            continue
+        if LOG_FORMAT == "json":
+            for handler in handlers:
+                handler.setFormatter(JsonFormatter())
+        log_queue = queue.SimpleQueue()
+        listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+        logger.handlers = [RecordQueueHandler(log_queue)]
+        listener.start()
+        LISTENERS.append((logger, handlers, listener))
+
+
+def stop_logging():
+    """
+    Write out everything still queued and log directly again.
+    """
+    while LISTENERS:
+        logger, handlers, listener = LISTENERS.pop()
+        listener.stop()
+        logger.handlers = handlers
@@ -0,0 +1,7 @@
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# caching creates its file tier directory (and loads its index) on import
+os.environ.setdefault("FILE_CACHE_DIR", tempfile.mkdtemp(prefix="hardcover-tests-"))
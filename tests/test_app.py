@@ -0,0 +1,46 @@
+import asyncio
+
+import app
+from models import BookMetadata
+from normalization import canonical_search
+from search_index import SearchIndex
+
+HOBBIT = {"id": 1, "title": "The Hobbit", "author_names": ["J.R.R. Tolkien"], "isbns": ["9780547928227"],
+          "users_count": 100}
+
+
+def fake_upstream(monkeypatch, tmp_path) -> list[list[str]]:
+    """
+    A local index that knows the Hobbit, and a Typesense that answers it. Returns the queries sent to Typesense.
+    """
+    index = SearchIndex(str(tmp_path / "index.bin"))
+    index.learn({"hits": [{"document": HOBBIT}]})
+    searches = []
+
+    async def run_searches(queries: list[str], headers: dict) -> list[dict]:
+        searches.append(queries)
+        return [{"hits": [{"document": HOBBIT}]} for _ in queries]
+
+    async def load_editions(ids, formats, language, headers) -> dict[int, list[BookMetadata]]:
+        return {book_id: [BookMetadata(title="The Hobbit", isbn="9780547928227")] for book_id in ids}
+
+    monkeypatch.setattr(app, "get_search_index", lambda: index)
+    monkeypatch.setattr(app, "run_searches", run_searches)
+    monkeypatch.setattr(app, "load_editions", load_editions)
+    return searches
+
+
+def test_search_answered_by_local_index(monkeypatch, tmp_path):
+    searches = fake_upstream(monkeypatch, tmp_path)
+    search = canonical_search("The Hobbit", None, None, None)
+    entry = asyncio.run(app.search_and_store(search))
+    assert entry.status == 200
+    assert searches == []
+
+
+def test_refresh_asks_typesense(monkeypatch, tmp_path):
+    searches = fake_upstream(monkeypatch, tmp_path)
+    search = canonical_search("The Hobbit", None, None, None)
+    entry = asyncio.run(app.search_and_store(search, has_stale=True))
+    assert entry.status == 200
+    assert searches == [[search.query]]
@@ -0,0 +1,40 @@
+from normalization import canonical_search, normalize_author, normalize_query
+
+
+def test_spellings_share_a_cache_key():
+    keys = {canonical_search(query, None, None, None).cache_key
+            for query in ("The Hobbit", "Hobbit, The", "the  hobbit", " THE HOBBIT ")}
+    assert len(keys) == 1
+    assert canonical_search("Hobbit, The", None, None, None).query == "the hobbit"
+
+
+def test_filters_are_part_of_the_key():
+    plain = canonical_search("The Hobbit", None, None, None)
+    assert canonical_search("The Hobbit", "Tolkien", None, None).cache_key != plain.cache_key
+    assert canonical_search("The Hobbit", None, "de", None).cache_key != plain.cache_key
+    assert canonical_search("The Hobbit", None, None, "abook").cache_key != plain.cache_key
+
+
+def test_symbols():
+    # Typesense drops symbols from words, so "C++" and "C" are the same search
+    assert normalize_query("C++ Primer") == "c primer"
+    assert normalize_query("Spider-Man") == "spiderman"
+    assert canonical_search("C++ Primer", None, None, None).cache_key == \
+        canonical_search("C Primer", None, None, None).cache_key
+    # The text the local index splits into words keeps them
+    assert canonical_search("C++ Primer", None, None, None).text == "C++ Primer"
+    # Nothing but symbols is searched for as it was
+    assert normalize_query("?!") == "?!"
+
+
+def test_identifiers():
+    search = canonical_search("978-0-547-92822-7", None, None, None)
+    assert search.identifier == "9780547928227"
+    assert search.query == "9780547928227"
+    assert canonical_search("9780547928227", None, None, None).cache_key == search.cache_key
+
+
+def test_author_word_order():
+    assert normalize_author("Pratchett, Terry & Gaiman, Neil") == normalize_author("Neil Gaiman and Terry Pratchett")
+    assert normalize_author("") is None
+    assert normalize_author("and") is None
@@ -0,0 +1,109 @@
+import asyncio
+
+import pytest
+
+import rate_limit
+from rate_limit import SlidingWindow, granted_hits, window
+
+START = 1_000 * window
+
+
+def test_window_limits_requests():
+    counter = SlidingWindow()
+    assert counter.take(START + 1, 10, 8) == 8
+    # Only what fits is granted, and only that is counted
+    assert counter.take(START + 2, 10, 5) == 2
+    assert counter.take(START + 3, 10, 1) == 0
+    assert counter.current == 10
+
+
+def test_window_holds_across_the_boundary():
+    counter = SlidingWindow()
+    assert counter.take(START + window - 1, 10, 10) == 10
+    # A fixed window would allow another 10 right away
+    assert counter.take(START + window, 10, 10) == 0
+    # Half of the previous window still overlaps the last `window` seconds
+    assert counter.take(START + window * 1.5, 10, 10) == 5
+    # Two windows later nothing is left of it
+    assert counter.take(START + window * 3, 10, 10) == 10
+
+
+def test_granted_hits():
+    assert granted_hits(0, 5, START, START, 10, 5) == 5
+    assert granted_hits(0, 12, START, START, 10, 5) == 3
+    assert granted_hits(20, 1, START + window / 2, START, 10, 1) == 0
+
+
+@pytest.fixture
+def sqlite_backend(monkeypatch, tmp_path):
+    monkeypatch.setattr(rate_limit, "RATE_LIMIT_SQLITE_PATH", str(tmp_path / "rate_limit.sqlite3"))
+    monkeypatch.setattr(rate_limit, "SQLITE_CONNECTION", None)
+    yield
+    # The connection belongs to SQLITE_EXECUTOR's thread
+    rate_limit.SQLITE_EXECUTOR.submit(rate_limit.sqlite_connection().close).result()
+
+
+def test_sqlite_rejected_hits_are_not_counted(sqlite_backend):
+    async def hits():
+        return [await rate_limit.sqlite_hit("ip:1", 10, START + 1, 8),
+                await rate_limit.sqlite_hit("ip:1", 10, START + 2, 5),
+                await rate_limit.sqlite_hit("ip:1", 10, START + 3, 1),
+                await rate_limit.sqlite_hit("ip:2", 10, START + 3, 1),
+                await rate_limit.sqlite_hit("ip:1", 10, START + window * 1.5, 10)]
+
+    assert asyncio.run(hits()) == [8, 2, 0, 1, 5]
+    count = rate_limit.SQLITE_EXECUTOR.submit(lambda: rate_limit.sqlite_connection().execute(
+        "SELECT count FROM rate_limit WHERE client = 'ip:1' AND window_start = ?", (START,)
+    ).fetchone()[0]).result()
+    assert count == 10
+
+
+class FakeRedis:
+    """
+    The few commands redis_hit uses.
+    """
+
+    def __init__(self):
+        self.values = {}
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+    async def decrby(self, key: str, amount: int):
+        self.values[key] -= amount
+
+
+class FakePipeline:
+    def __init__(self, redis: FakeRedis):
+        self.redis = redis
+        self.commands = []
+
+    def get(self, key: str):
+        self.commands.append(lambda: self.redis.values.get(key))
+
+    def incrby(self, key: str, amount: int):
+        def incrby():
+            self.redis.values[key] = self.redis.values.get(key, 0) + amount
+            return self.redis.values[key]
+        self.commands.append(incrby)
+
+    def expire(self, key: str, seconds: int):
+        self.commands.append(lambda: True)
+
+    async def execute(self):
+        return [command() for command in self.commands]
+
+
+def test_redis_rejected_hits_are_not_counted(monkeypatch):
+    redis = FakeRedis()
+    monkeypatch.setattr(rate_limit, "REDIS_CLIENT", redis)
+
+    async def hits():
+        return [await rate_limit.redis_hit("ip:1", 10, START + 1, 8),
+                await rate_limit.redis_hit("ip:1", 10, START + 2, 5),
+                await rate_limit.redis_hit("ip:1", 10, START + 3, 1),
+                await rate_limit.redis_hit("ip:1", 10, START + window * 1.5, 10)]
+
+    assert asyncio.run(hits()) == [8, 2, 0, 5]
+    assert redis.values[f"{rate_limit.RATE_LIMIT_REDIS_PREFIX}ip:1:{START}"] == 10
+    assert redis.values[f"{rate_limit.RATE_LIMIT_REDIS_PREFIX}ip:1:{START + window}"] == 5
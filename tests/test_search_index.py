@@ -0,0 +1,103 @@
+import pytest
+
+from search_index import MappedIndex, SearchIndex, write_index, IDENTIFIER_PREFIX
+
+HOBBIT = {"id": 1, "title": "The Hobbit", "author_names": ["J.R.R. Tolkien"], "isbns": ["9780547928227"],
+          "users_count": 100}
+SHADOWS = {"id": 2, "title": "Shadows", "author_names": ["Ann Smith"], "users_count": 10}
+CARRIER = {"id": 3, "title": "Carrier", "author_names": ["Tom Jones"], "users_count": 5}
+
+
+def typesense_result(*documents: dict) -> dict:
+    return {"hits": [{"document": document} for document in documents]}
+
+
+def test_index_file_round_trip(tmp_path):
+    path = str(tmp_path / "index.bin")
+    write_index(path, [SHADOWS, HOBBIT])
+    mapped = MappedIndex(path)
+    try:
+        assert mapped.document_count == 2
+        # Documents are sorted by book id
+        assert [mapped.book_id(number) for number in range(2)] == [1, 2]
+        assert mapped.number(2) == 1
+        assert mapped.number(5) is None
+        assert mapped.document(mapped.number(1)) == HOBBIT
+
+        i = mapped.find("hobbit")
+        assert [mapped.book_id(number) for number in mapped.postings(i)] == [1]
+        assert mapped.find(IDENTIFIER_PREFIX + "9780547928227") is not None
+        assert mapped.find("hobbits") is None
+        assert [mapped[i] for i in mapped.prefix_range("sh")] == ["shadows"]
+    finally:
+        mapped.close()
+
+
+def test_rejects_other_files(tmp_path):
+    path = tmp_path / "index.bin"
+    path.write_bytes(b"XXXX" + bytes(100))
+    with pytest.raises(ValueError):
+        MappedIndex(str(path))
+
+
+def test_answers_exact_titles_and_identifiers(tmp_path):
+    index = SearchIndex(str(tmp_path / "index.bin"))
+    index.learn(typesense_result(HOBBIT, SHADOWS))
+    assert index.search("The Hobbit")["hits"][0]["document"]["id"] == 1
+    assert index.search("978-0-547-92822-7")["hits"][0]["document"]["id"] == 1
+    # The title is not covered by the query
+    assert index.search("Hobbit") is None
+
+
+def test_expand():
+    index = SearchIndex("/nonexistent/index.bin")
+    index.learn(typesense_result(SHADOWS, {"id": 4, "title": "Volume 12345", "users_count": 1}))
+    assert index.expand("shadows") == {"shadows"}
+    assert index.expand("shadow") == {"shadows"}
+    assert index.expand("shdaows") == {"shadows"}
+    # Too short to guess from, and numbers are never typos
+    assert index.expand("shad") == set()
+    assert index.expand("12346") == set()
+
+
+def test_typos_are_not_forgiven_in_titles(tmp_path):
+    index = SearchIndex(str(tmp_path / "index.bin"))
+    index.learn(typesense_result(SHADOWS, CARRIER))
+    assert index.search("Shadow") is None
+    assert index.search("Carrie") is None
+    # Typos in the rest of the query still find the book
+    assert index.search("Shadows Ann Smiht")["hits"][0]["document"]["id"] == 2
+
+
+def test_save_merges_with_the_file(tmp_path):
+    path = str(tmp_path / "index.bin")
+    first = SearchIndex(path)
+    first.learn(typesense_result(HOBBIT))
+    first.save().result()
+    assert not first.documents and first.mapped.document_count == 1
+
+    # Another worker process saving to the same file keeps what is there
+    second = SearchIndex(path)
+    second.learn(typesense_result(SHADOWS))
+    second.save().result()
+
+    reopened = SearchIndex(path)
+    assert sorted(document["id"] for document in reopened.mapped.documents()) == [1, 2]
+    assert reopened.search("shadows")["hits"][0]["document"] == SHADOWS
+
+
+def test_search_results_keep_learned_identifiers(tmp_path):
+    index = SearchIndex(str(tmp_path / "index.bin"))
+    index.learn(typesense_result(SHADOWS))
+    index.learn_identifiers(2, ["9781234567897", None])
+    assert index.search("9781234567897")["hits"][0]["document"]["id"] == 2
+
+    # Typesense returns the book again, without the edition's ISBN
+    index.learn(typesense_result(SHADOWS))
+    assert index.search("9781234567897")["hits"][0]["document"]["id"] == 2
+
+    # Also once the book is only in the file
+    index.save().result()
+    index.learn(typesense_result(SHADOWS))
+    assert not index.documents
+    assert index.search("9781234567897")["hits"][0]["document"]["id"] == 2
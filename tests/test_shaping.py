@@ -0,0 +1,75 @@
+import time
+
+import orjson
+import pytest
+from fastapi import HTTPException
+
+from caching import CacheEntry
+from compression import compress
+from shaping import FULL, Shape, get_shape, shape_result, unique_editions
+
+
+def cached_result(*books: list[dict]) -> CacheEntry:
+    data = orjson.dumps({
+        "matches": [edition for editions in books for edition in editions],
+        "editionsPerBook": [len(editions) for editions in books],
+    })
+    data, encoding = compress(data, "gzip")
+    return CacheEntry(data, time.time(), encoding=encoding)
+
+
+def editions(book: str, count: int) -> list[dict]:
+    return [{"title": f"{book} {number}", "isbn": f"{book}-{number}", "author": book} for number in range(count)]
+
+
+def shaped(entry: CacheEntry, shape: Shape) -> dict:
+    # Parsed results are kept per cache key, every result gets its own
+    return orjson.loads(shape_result(str(hash(entry.data)), entry, shape))
+
+
+def test_full_shape_keeps_the_result():
+    entry = cached_result(editions("a", 2), editions("b", 1))
+    assert shaped(entry, FULL) == {
+        "matches": editions("a", 2) + editions("b", 1),
+        "editionsPerBook": [2, 1],
+    }
+
+
+def test_pages_count_editions_of_their_books():
+    entry = cached_result(editions("a", 3), editions("b", 3), editions("c", 3))
+    page = shaped(entry, Shape(limit=3, offset=2, max_editions_per_book=2))
+    # Two editions per book: a0 a1 b0 b1 c0 c1, of which the third to fifth
+    assert [edition["title"] for edition in page["matches"]] == ["b 0", "b 1", "c 0"]
+    assert page["editionsPerBook"] == [2, 1]
+
+    assert shaped(entry, Shape(offset=6, max_editions_per_book=2)) == {"matches": [], "editionsPerBook": []}
+
+
+def test_fields():
+    entry = cached_result(editions("a", 1))
+    assert shaped(entry, Shape(fields=("title", "isbn")))["matches"] == [{"title": "a 0", "isbn": "a-0"}]
+
+
+def test_unique_editions():
+    kept = unique_editions([
+        {"title": "The Hobbit", "isbn": "1", "language": "English"},
+        {"title": "The Hobbit", "isbn": "2", "asin": "B1", "language": "English"},  # same description
+        {"title": "the hobbit", "isbn": "3", "language": "German"},
+        {"title": "Der Hobbit", "asin": "B2", "isbn": "1", "language": "German"},  # same ISBN
+        {"title": "The Hobbit", "language": "English", "duration": 600},  # audiobook
+    ])
+    assert [edition.get("isbn") or edition.get("duration") for edition in kept] == ["1", "3", 600]
+
+
+def test_dedupe_counts_what_is_left():
+    entry = cached_result([{"title": "x", "isbn": "1"}, {"title": "x", "isbn": "1"}, {"title": "y"}],
+                          editions("b", 1))
+    assert shaped(entry, Shape(dedupe=True))["editionsPerBook"] == [2, 1]
+
+
+def test_get_shape_checks_fields():
+    assert get_shape(None, 0, None, False, "isbn, title,isbn").fields == ("isbn", "title")
+    assert get_shape(None, 0, None, False, "isbn").fields == ("title", "isbn")
+    with pytest.raises(HTTPException) as e:
+        get_shape(None, 0, None, False, "isbn,colour")
+    assert e.value.status_code == 400
@@ -0,0 +1,97 @@
+import asyncio
+
+import httpx
+import pytest
+
+import upstream
+from upstream import BREAKER_FAILURES, CircuitBreaker, Upstream, UpstreamUnavailable
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """
+    The monotonic time the circuit breaker sees, moved by hand.
+    """
+    now = [1000.0]
+    monkeypatch.setattr(upstream.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_breaker_opens_after_consecutive_failures(clock):
+    breaker = CircuitBreaker("test")
+    for _ in range(BREAKER_FAILURES - 1):
+        breaker.record_failure()
+    breaker.record_success()
+    for _ in range(BREAKER_FAILURES - 1):
+        breaker.record_failure()
+    assert breaker.state == "closed"
+    breaker.record_failure()
+    assert breaker.state == "open"
+    with pytest.raises(UpstreamUnavailable):
+        breaker.check()
+
+
+def test_breaker_lets_one_trial_call_through(clock):
+    breaker = CircuitBreaker("test")
+    for _ in range(BREAKER_FAILURES):
+        breaker.record_failure()
+    clock[0] += upstream.BREAKER_OPEN_SECONDS
+    assert breaker.state == "half-open"
+    assert breaker.check() is True
+    with pytest.raises(UpstreamUnavailable):
+        breaker.check()
+
+    # A failed trial opens the breaker again right away
+    breaker.record_failure()
+    assert breaker.state == "open"
+
+    clock[0] += upstream.BREAKER_OPEN_SECONDS
+    assert breaker.check() is True
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.check() is False
+
+
+def mock_upstream(monkeypatch, statuses: list[int]) -> tuple[Upstream, list[httpx.Request]]:
+    """
+    An upstream answering with statuses, in order. Returns it and the requests it got.
+    """
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        return httpx.Response(statuses[min(len(requests), len(statuses)) - 1])
+
+    base_url = "http://upstream.test"
+    monkeypatch.setattr(upstream, "UPSTREAM_RETRY_BACKOFF", 0.001)
+    monkeypatch.setitem(upstream.CLIENTS, base_url, httpx.AsyncClient(
+        base_url=base_url, transport=httpx.MockTransport(handler)
+    ))
+    return Upstream("test", base_url), requests
+
+
+def test_retries_count_as_one_failure(monkeypatch):
+    test_upstream, requests = mock_upstream(monkeypatch, [503])
+    response = asyncio.run(test_upstream.post("/"))
+    assert response.status_code == 503
+    assert len(requests) == upstream.UPSTREAM_RETRIES + 1
+    assert test_upstream.breaker.failures == 1
+
+
+def test_success_after_a_retry_resets_failures(monkeypatch):
+    test_upstream, requests = mock_upstream(monkeypatch, [503, 200])
+    test_upstream.breaker.failures = BREAKER_FAILURES - 1
+    assert asyncio.run(test_upstream.post("/")).status_code == 200
+    assert len(requests) == 2
+    assert test_upstream.breaker.failures == 0
+
+
+def test_trial_call_is_not_retried(monkeypatch, clock):
+    test_upstream, requests = mock_upstream(monkeypatch, [503, 200])
+    for _ in range(BREAKER_FAILURES):
+        test_upstream.breaker.record_failure()
+    clock[0] += upstream.BREAKER_OPEN_SECONDS
+    assert asyncio.run(test_upstream.post("/")).status_code == 503
+    assert len(requests) == 1
+    assert test_upstream.breaker.state == "open"
+    assert not test_upstream.breaker.trial_running
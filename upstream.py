@@ -0,0 +1,323 @@
+import os
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+import httpx
+
+from metrics import UPSTREAM_RETRIES as RETRIES_SENT, UPSTREAM_HEDGES as HEDGES_SENT
+
+logger = logging.getLogger("uvicorn")
+
+SEARCH_BASE_URL = os.getenv("HARDCOVER_SEARCH_URL", "https://search.hardcover.app")
+SEARCH_API_KEY = os.getenv("HARDCOVER_SEARCH_API_KEY", "cf0jYiqkIXNYh2EnJr1RqHIYJbKOGoGk")
+GRAPHQL_BASE_URL = os.getenv("HARDCOVER_GRAPHQL_URL", "https://api.hardcover.app")
+
+# Connection pool settings, shared by every upstream host
+UPSTREAM_HTTP2 = os.getenv("UPSTREAM_HTTP2", "true").lower() in ("1", "true", "yes")
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "100"))
+UPSTREAM_MAX_KEEPALIVE = int(os.getenv("UPSTREAM_MAX_KEEPALIVE", "20"))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", "60"))
+
+# Timeouts in seconds
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "5"))
+UPSTREAM_READ_TIMEOUT = float(os.getenv("UPSTREAM_READ_TIMEOUT", "20"))
+UPSTREAM_WRITE_TIMEOUT = float(os.getenv("UPSTREAM_WRITE_TIMEOUT", "5"))
+UPSTREAM_POOL_TIMEOUT = float(os.getenv("UPSTREAM_POOL_TIMEOUT", "10"))
+
+# Time all upstream calls of one search may take together, retries and hedges included
+UPSTREAM_REQUEST_BUDGET = float(os.getenv("UPSTREAM_REQUEST_BUDGET", "25"))
+# Retries of failures that are safe to retry, see RETRY_ERRORS and RETRY_STATUSES
+UPSTREAM_RETRIES = int(os.getenv("UPSTREAM_RETRIES", "2"))
+UPSTREAM_RETRY_BACKOFF = float(os.getenv("UPSTREAM_RETRY_BACKOFF", "0.2"))  # seconds, doubled per retry
+# Upstreams that get a second request when the first one is slower than their p95 latency.
+# Only search by default: GraphQL requests count against the API key limits.
+UPSTREAM_HEDGE = {name for name in os.getenv("UPSTREAM_HEDGE", "typesense").lower().split(",") if name}
+UPSTREAM_HEDGE_MIN_DELAY = float(os.getenv("UPSTREAM_HEDGE_MIN_DELAY", "0.05"))
+# Consecutive failures that open a host's circuit breaker, and how long it stays open
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))
+BREAKER_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", "30"))
+
+# Failures where the request never reached Hardcover, or Hardcover said to try again.
+# Both calls only read, so sending them twice is harmless.
+RETRY_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout, httpx.RemoteProtocolError)
+RETRY_STATUSES = {502, 503, 504}
+
+# Latencies kept per upstream for the hedging threshold
+LATENCY_SAMPLES = 200
+LATENCY_MIN_SAMPLES = 20
+
+# Monotonic time by which the current request's upstream calls have to be done
+DEADLINE: ContextVar[Optional[float]] = ContextVar("upstream_deadline", default=None)
+
+# One long-lived client (and therefore one connection pool) per upstream host
+CLIENTS: Dict[str, httpx.AsyncClient] = {}
+
+
+def get_client(base_url: str) -> httpx.AsyncClient:
+    client = CLIENTS.get(base_url)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            base_url=base_url,
+            http2=UPSTREAM_HTTP2,
+            limits=httpx.Limits(
+                max_connections=UPSTREAM_MAX_CONNECTIONS,
+                max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE,
+                keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(
+                connect=UPSTREAM_CONNECT_TIMEOUT,
+                read=UPSTREAM_READ_TIMEOUT,
+                write=UPSTREAM_WRITE_TIMEOUT,
+                pool=UPSTREAM_POOL_TIMEOUT,
+            ),
+        )
+        CLIENTS[base_url] = client
+    return client
+
+
+class UpstreamUnavailable(Exception):
+    """
+    The upstream's circuit breaker is open, the call was not attempted.
+    """
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"{name} is unavailable, retry in {retry_after:.0f}s")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+@contextmanager
+def request_budget(seconds: float = UPSTREAM_REQUEST_BUDGET):
+    """
+    Set the deadline for the upstream calls made inside. Nested budgets keep the outer deadline.
+    """
+    token = DEADLINE.set(time.monotonic() + seconds) if DEADLINE.get() is None else None
+    try:
+        yield
+    finally:
+        if token is not None:
+            DEADLINE.reset(token)
+
+
+def remaining_time() -> Optional[float]:
+    deadline = DEADLINE.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+class CircuitBreaker:
+    """
+    Opens after BREAKER_FAILURES consecutive failures. Once BREAKER_OPEN_SECONDS have passed,
+    a single trial call is let through: its success closes the breaker, its failure opens it again.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial_running = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < BREAKER_OPEN_SECONDS:
+            return "open"
+        return "half-open"
+
+    def fail_fast(self):
+        """
+        Raise UpstreamUnavailable if a call would be refused right now, without claiming the trial call.
+        """
+        state = self.state
+        if state == "open" or (state == "half-open" and self.trial_running):
+            retry_after = max(1.0, BREAKER_OPEN_SECONDS - (time.monotonic() - self.opened_at))
+            raise UpstreamUnavailable(self.name, retry_after)
+
+    def check(self) -> bool:
+        """
+        Raise UpstreamUnavailable unless the call may go out. True if it is the half-open trial call.
+        """
+        self.fail_fast()
+        if self.state == "half-open":
+            self.trial_running = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.trial_running or self.failures >= BREAKER_FAILURES:
+            if self.opened_at is None or self.trial_running:
+                logger.warning(f"Circuit breaker for {self.name} opened after {self.failures} failures")
+            self.opened_at = time.monotonic()
+            self.trial_running = False
+
+
+class LatencyTracker:
+    def __init__(self):
+        self.samples = deque(maxlen=LATENCY_SAMPLES)
+        self.p95: Optional[float] = None
+
+    def add(self, seconds: float):
+        self.samples.append(seconds)
+        # Sorting 200 floats is cheap, but not worth doing on every call
+        if len(self.samples) >= LATENCY_MIN_SAMPLES and len(self.samples) % 10 == 0:
+            ordered = sorted(self.samples)
+            self.p95 = ordered[int(len(ordered) * 0.95) - 1]
+
+    def hedge_delay(self) -> Optional[float]:
+        if self.p95 is None:
+            return None
+        return max(self.p95, UPSTREAM_HEDGE_MIN_DELAY)
+
+
+class Upstream:
+    """
+    Policy around one upstream host: circuit breaker, deadline, retries with jittered backoff, hedging.
+    """
+
+    def __init__(self, name: str, base_url: str):
+        self.name = name
+        self.base_url = base_url
+        self.breaker = CircuitBreaker(name)
+        self.latencies = LatencyTracker()
+        self.hedge = name in UPSTREAM_HEDGE
+
+    def timeout(self) -> httpx.Timeout:
+        remaining = remaining_time()
+        if remaining is None:
+            return httpx.Timeout(connect=UPSTREAM_CONNECT_TIMEOUT, read=UPSTREAM_READ_TIMEOUT,
+                                 write=UPSTREAM_WRITE_TIMEOUT, pool=UPSTREAM_POOL_TIMEOUT)
+        if remaining <= 0:
+            raise DeadlineExceeded(f"No time left to call {self.name}")
+        return httpx.Timeout(
+            connect=min(UPSTREAM_CONNECT_TIMEOUT, remaining),
+            read=min(UPSTREAM_READ_TIMEOUT, remaining),
+            write=min(UPSTREAM_WRITE_TIMEOUT, remaining),
+            pool=min(UPSTREAM_POOL_TIMEOUT, remaining),
+        )
+
+    async def post(self, path: str, **kwargs) -> httpx.Response:
+        trial = self.breaker.check()
+        try:
+            return await self.post_with_retries(path, trial, **kwargs)
+        finally:
+            # A cancelled trial call decided nothing, the next call gets to try
+            if trial and self.breaker.trial_running:
+                self.breaker.trial_running = False
+
+    async def post_with_retries(self, path: str, trial: bool = False, **kwargs) -> httpx.Response:
+        attempt = 0
+        # The breaker counts calls, not attempts: a failure is recorded once the retries are used up
+        while True:
+            try:
+                response = await self.send(path, **kwargs)
+            except RETRY_ERRORS:
+                if not self.may_retry(attempt, trial):
+                    self.breaker.record_failure()
+                    raise
+            except httpx.TransportError:
+                # Read timeouts and the like: the request may be running upstream, hedging covers slowness
+                self.breaker.record_failure()
+                raise
+            else:
+                if response.status_code < 500:
+                    self.breaker.record_success()
+                    return response
+                if response.status_code not in RETRY_STATUSES or not self.may_retry(attempt, trial):
+                    self.breaker.record_failure()
+                    return response
+
+            attempt += 1
+            RETRIES_SENT.labels(self.name).inc()
+            # Full jitter, so clients failing together do not retry together
+            await asyncio.sleep(random.uniform(0, UPSTREAM_RETRY_BACKOFF * 2 ** attempt))
+            self.breaker.fail_fast()
+
+    def may_retry(self, attempt: int, trial: bool = False) -> bool:
+        # The half-open trial call decides on its first attempt, a retry would be refused by the breaker
+        if trial or attempt >= UPSTREAM_RETRIES:
+            return False
+        remaining = remaining_time()
+        return remaining is None or remaining > UPSTREAM_RETRY_BACKOFF * 2 ** (attempt + 1)
+
+    async def send(self, path: str, **kwargs) -> httpx.Response:
+        client = get_client(self.base_url)
+        start = time.monotonic()
+        timeout = self.timeout()
+        delay = self.latencies.hedge_delay() if self.hedge else None
+        remaining = remaining_time()
+        if delay is None or (remaining is not None and delay >= remaining):
+            response = await client.post(path, timeout=timeout, **kwargs)
+            self.latencies.add(time.monotonic() - start)
+            return response
+
+        first = asyncio.ensure_future(client.post(path, timeout=timeout, **kwargs))
+        tasks = {first}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                # Slower than 95% of calls: a second request often overtakes it
+                HEDGES_SENT.labels(self.name).inc()
+                tasks.add(asyncio.ensure_future(client.post(path, timeout=self.timeout(), **kwargs)))
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        self.latencies.add(time.monotonic() - start)
+                        return task.result()
+                    error = error or task.exception()
+            raise error
+        finally:
+            for task in (first, *tasks):
+                if not task.done():
+                    task.cancel()
+
+
+SEARCH_UPSTREAM = Upstream("typesense", SEARCH_BASE_URL)
+GRAPHQL_UPSTREAM = Upstream("graphql", GRAPHQL_BASE_URL)
+UPSTREAMS = (SEARCH_UPSTREAM, GRAPHQL_UPSTREAM)
+
+
+def is_available() -> bool:
+    """
+    False while any upstream's circuit breaker is open.
+    """
+    return all(upstream.breaker.state != "open" for upstream in UPSTREAMS)
+
+
+async def close_clients():
+    """
+    Close every pooled upstream connection. Called on application shutdown.
+    """
+    for base_url, client in list(CLIENTS.items()):
+        await client.aclose()
+        del CLIENTS[base_url]
+
+
+async def post_search(body: bytes, headers: Optional[dict] = None) -> httpx.Response:
+    return await SEARCH_UPSTREAM.post(
+        "/multi_search",
+        params={"x-typesense-api-key": SEARCH_API_KEY},
+        headers=headers,
+        content=body,
+    )
+
+
+async def post_graphql(payload: bytes, headers: Optional[dict] = None) -> httpx.Response:
+    return await GRAPHQL_UPSTREAM.post("/v1/graphql", headers=headers, content=payload)
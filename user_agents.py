@@ -0,0 +1,94 @@
+"""
+User-Agent headers for upstream requests.
+
+fake_useragent rebuilds its list from a ~10k line dataset on every UserAgent() and filters it again
+on every .random, which cost more CPU per search than the rest of a cache miss. The list is built
+once per process here instead, or read from a precomputed file:
+
+    python user_agents.py > user_agents.tsv    # then USER_AGENTS_FILE=user_agents.tsv
+"""
+import os
+import itertools
+import random
+import threading
+from collections import Counter
+from typing import Optional
+
+# Precomputed "weight<TAB>browser<TAB>user agent" lines, fake_useragent is not imported at all when it is set
+USER_AGENTS_FILE = os.getenv("USER_AGENTS_FILE", "")
+
+# { (browser, user agent): weight }
+Agents = dict[tuple[str, str], int]
+
+
+class UserAgents:
+    """
+    Picks user agents as often as they occur in the dataset, like UserAgent().random.
+    """
+
+    def __init__(self, agents: Agents):
+        self.agents = [agent for _, agent in agents]
+        self.cum_weights = list(itertools.accumulate(agents.values()))
+        # The Google app, which fetching API keys from hardcover.app presents itself as
+        self.google_agents = [agent for browser, agent in agents if browser == "Google"] or self.agents
+
+    def random(self) -> str:
+        return random.choices(self.agents, cum_weights=self.cum_weights)[0]
+
+    def google(self) -> str:
+        return random.choice(self.google_agents)
+
+
+def read_user_agents(path: str) -> Agents:
+    agents = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            weight, browser, agent = line.rstrip("\n").split("\t", 2)
+            agents[(browser, agent)] = int(weight)
+    return agents
+
+
+def dataset_user_agents() -> Agents:
+    """
+    The user agents UserAgent().random picks from, with the library's default filters.
+    The dataset lists popular user agents many times, each is kept once with its count.
+    """
+    from fake_useragent import UserAgent
+
+    defaults = UserAgent()
+    return dict(Counter(
+        (entry["browser"], entry["useragent"])
+        for entry in defaults.data_browsers
+        if entry["browser"] in defaults.browsers
+        and entry["os"] in defaults.os
+        and entry["type"] in defaults.platforms
+        and entry["percent"] >= defaults.min_percentage
+        and entry["browser_version_major_minor"] >= defaults.min_version
+    ))
+
+
+USER_AGENTS: Optional[UserAgents] = None
+USER_AGENTS_LOCK = threading.Lock()  # API keys are fetched from a worker thread
+
+
+def get_user_agents() -> UserAgents:
+    """
+    The user agents shared by everything in this process, loaded on first use.
+    """
+    global USER_AGENTS
+    if USER_AGENTS is not None:
+        return USER_AGENTS
+    with USER_AGENTS_LOCK:
+        if USER_AGENTS is None:
+            agents = read_user_agents(USER_AGENTS_FILE) if USER_AGENTS_FILE else {}
+            USER_AGENTS = UserAgents(agents or dataset_user_agents())
+    return USER_AGENTS
+
+
+def random_user_agent() -> str:
+    return get_user_agents().random()
+
+
+if __name__ == "__main__":
+    for (browser, agent), weight in dataset_user_agents().items():
+        print(f"{weight}\t{browser}\t{agent}")
@@ -0,0 +1,184 @@
+"""
+Cache warm-up after a (re)start.
+
+Run by the app's lifespan: loads the most recently used file tier entries and the most
+searched queries of a recorded query log into memory, and optionally refreshes popular
+entries that are missing or stale. /ready answers 503 until the configured share of it is done.
+
+Also usable on its own, to prefetch a query log into the cache before a deploy:
+
+    python warmup.py queries.log --refresh-budget 200
+"""
+import os
+import argparse
+import asyncio
+import json
+import logging
+from collections import Counter
+from typing import Awaitable, Callable, Optional
+
+import caching
+from caching import get_cached
+from normalization import SearchRequest, canonical_search
+
+logger = logging.getLogger("uvicorn")
+
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "true").lower() in ("1", "true", "yes")
+# Share of MEMORY_CACHE_LIMIT filled from the file tier, most recently used entries first
+WARMUP_MEMORY_SHARE = float(os.getenv("WARMUP_MEMORY_SHARE", "0.8"))
+# Recorded searches: LOG_FORMAT=json output, or one JSON object / plain query per line
+WARMUP_QUERY_LOG = os.getenv("WARMUP_QUERY_LOG", "")
+# Most searched queries of the log that are warmed up
+WARMUP_QUERIES = int(os.getenv("WARMUP_QUERIES", "1000"))
+# Popular queries whose entries are missing or stale get searched again, at most this many
+WARMUP_REFRESH_BUDGET = int(os.getenv("WARMUP_REFRESH_BUDGET", "0"))
+# Refreshing pauses while fewer Hardcover API requests than this are available, so requests always come first
+WARMUP_KEY_RESERVE = float(os.getenv("WARMUP_KEY_RESERVE", "40"))
+# Share of the planned loads that has to be done before /ready reports ready
+WARMUP_READY_THRESHOLD = float(os.getenv("WARMUP_READY_THRESHOLD", "1.0"))
+
+# Entries loaded between yields to the event loop, so requests are served during warm-up
+LOAD_BATCH = 50
+
+WARMUP_STATE = {
+    "planned": 0,
+    "loaded": 0,
+    "refreshed": 0,
+    "done": not WARMUP_ENABLED,
+}
+
+# (query, author, lang_code, content_type)
+Search = tuple[str, Optional[str], Optional[str], Optional[str]]
+
+
+def is_ready() -> bool:
+    if WARMUP_STATE["done"]:
+        return True
+    if not WARMUP_STATE["planned"]:
+        return False
+    return WARMUP_STATE["loaded"] / WARMUP_STATE["planned"] >= WARMUP_READY_THRESHOLD
+
+
+def read_query_log(path: str, limit: int = WARMUP_QUERIES) -> list[Search]:
+    """
+    The most frequent searches of a query log, most frequent first.
+    """
+    counts = Counter()
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if not line.startswith("{"):
+                counts[(line, None, None, None)] += 1
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            # JSON request logs contain other events as well
+            if not isinstance(record, dict) or record.get("event", "search") != "search":
+                continue
+            search = (record.get("query"), record.get("author"), record.get("lang_code"), record.get("content_type"))
+            # Malformed records are skipped, not searched for
+            if not isinstance(search[0], str) or not all(value is None or isinstance(value, str) for value in search[1:]):
+                continue
+            counts[search] += 1
+    return [search for search, _ in counts.most_common(limit)]
+
+
+def file_tier_keys() -> list[str]:
+    """
+    Most recently used file tier entries that fit into the memory share, most recent first.
+    """
+    budget = caching.MEMORY_CACHE_LIMIT * WARMUP_MEMORY_SHARE
+    keys = []
+    with caching.FILE_CACHE_LOCK:
+        for cache_key, (size, _, _) in reversed(caching.FILE_CACHE_INDEX.items()):
+            if size > budget:
+                break
+            budget -= size
+            keys.append(cache_key)
+    return keys
+
+
+async def warm_up(refresh: Optional[Callable[[SearchRequest], Awaitable]] = None, query_log: str = WARMUP_QUERY_LOG):
+    """
+    refresh(search) searches again and stores the result, it is only
+    called within WARMUP_REFRESH_BUDGET.
+    """
+    try:
+        await load_and_refresh(refresh, query_log)
+    except Exception as e:
+        logger.error(f"Warm-up failed: {e!r}")
+    finally:
+        # /ready must not wait for a warm-up that is not running anymore
+        WARMUP_STATE["done"] = True
+
+
+async def load_and_refresh(refresh: Optional[Callable[[SearchRequest], Awaitable]], query_log: str):
+    from retreive_api_keys import get_api_keys
+
+    searches = []
+    if query_log:
+        try:
+            searches = [canonical_search(*search) for search in read_query_log(query_log)]
+        except OSError as e:
+            logger.error(f"Could not read query log {query_log}: {e!r}")
+
+    # Only the memory backend has a tier to warm, the shared backends are warm already
+    file_keys = file_tier_keys() if isinstance(caching.BACKEND, caching.MemoryBackend) else []
+    # Logged searches go first: they are popular, the file tier order is only recency
+    keys = list(dict.fromkeys([search.cache_key for search in searches] + file_keys))
+    WARMUP_STATE["planned"] = len(keys)
+    logger.info(f"Warming up {len(keys)} cache entries ({len(searches)} from the query log)")
+
+    # Spellings of the same search share their entry, the most searched one is kept
+    missing = {}
+    for search in searches:
+        missing.setdefault(search.cache_key, search)
+    for start in range(0, len(keys), LOAD_BATCH):
+        for cache_key in keys[start:start + LOAD_BATCH]:
+            # For the memory backend, reading a file tier entry moves it into memory
+            entry = await get_cached(cache_key)
+            if entry is not None and not entry.is_stale():
+                missing.pop(cache_key, None)
+            WARMUP_STATE["loaded"] += 1
+        await asyncio.sleep(0)
+    logger.info(f"Warm-up loaded {WARMUP_STATE['loaded']} entries, {len(missing)} popular ones are missing or stale")
+
+    if refresh is not None and WARMUP_REFRESH_BUDGET > 0:
+        api_keys = get_api_keys()
+        for search in list(missing.values())[:WARMUP_REFRESH_BUDGET]:
+            while api_keys.api_keys and api_keys.available_capacity() < WARMUP_KEY_RESERVE:
+                await asyncio.sleep(1)
+            try:
+                await refresh(search)
+                WARMUP_STATE["refreshed"] += 1
+            except Exception as e:
+                logger.warning(f"Warm-up refresh of {search.text!r} failed: {e!r}")
+        logger.info(f"Warm-up refreshed {WARMUP_STATE['refreshed']} entries")
+
+
+def main():
+    global WARMUP_REFRESH_BUDGET
+    parser = argparse.ArgumentParser(description="Prefetch the most searched queries of a query log into the cache.")
+    parser.add_argument("query_log")
+    parser.add_argument("--refresh-budget", type=int, default=max(WARMUP_REFRESH_BUDGET, 100),
+                        help="Most searches to send upstream")
+    args = parser.parse_args()
+    WARMUP_REFRESH_BUDGET = args.refresh_budget
+
+    # Imported here, the app imports this module
+    from app import search_and_store
+    from caching import flush_cache
+
+    async def run():
+        await warm_up(search_and_store, args.query_log)
+        flush_cache()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()